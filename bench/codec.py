@@ -0,0 +1,80 @@
+"""
+Compare the JSON backends of cpm.codec on large lorebooks.
+
+    python bench/codec.py --entries 20000
+
+For each backend: decoding and encoding a lorebook, and a full compile
+(parsing the lorebooks into fragments and merging them) with one process
+and with --workers processes.
+"""
+import argparse
+import io
+import json
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+from cpm import codec, compiler  # pylint: disable=C0413
+from server import lorebook  # pylint: disable=C0413,E0401
+
+
+def timed(func, repeat: int) -> float:
+    """Best wall time of `repeat` runs"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return round(best, 4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--entries", type=int, default=20000, help="Entries per lorebook")
+    parser.add_argument("--lorebooks", type=int, default=4, help="Lorebooks per compile")
+    parser.add_argument("--workers", type=int, default=4, help="Processes for the parallel compile")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for index in range(args.lorebooks):
+            path = Path(tmp) / f"{index}.lorebook"
+            path.write_bytes(lorebook(f"lorebook {index}", args.entries))
+            paths.append(path)
+        raw = paths[0].read_bytes()
+        data = json.loads(raw)
+
+        for name in codec.BACKENDS:
+            codec.use(name)
+
+            def compile_all(workers=1):
+                with tempfile.TemporaryDirectory(dir=tmp) as cache:
+                    compiler.compile_lorebooks(
+                        paths[0],
+                        paths,
+                        io.BytesIO(),
+                        compiler.FragmentCache(cache),
+                        workers=workers,
+                    )
+
+            result = {
+                "backend": name,
+                "bytes": len(raw),
+                "loads": timed(lambda: codec.loads(raw), args.repeat),
+                "dumps": timed(lambda: codec.dumps(data), args.repeat),
+                "compile": timed(compile_all, args.repeat),
+                "compile_workers": timed(lambda: compile_all(args.workers), args.repeat),
+            }
+            results.append(result)
+            print(json.dumps(result), file=sys.stderr)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Benchmarks for the CLI against a local stand-in server (see server.py).
+
+Each scenario runs `python -m cpm ...` in a fresh process and records the wall time,
+the number of requests and bytes served and the peak RSS of the process.
+Results are printed as JSON and can be compared with a previous run:
+
+    python bench/run.py --output baseline.json
+    python bench/run.py --compare baseline.json  # exits with 1 on regressions
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from server import Repository, graph, serve  # pylint: disable=E0401
+
+ROOT = Path(__file__).parent.parent
+SHAPES = ("wide", "deep", "diamond")
+
+
+def run_cli(argv, env, cwd) -> dict:
+    """Run the CLI, return its wall time and peak RSS (KB on Linux, bytes on macOS)"""
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "cpm", *argv],
+        env=env,
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        rss = usage.ru_maxrss
+    else:
+        proc.wait()
+        rss = None
+    wall = time.perf_counter() - start
+    stderr = proc.stderr.read().decode("utf-8", "replace")
+    proc.stderr.close()
+    if proc.returncode:
+        raise RuntimeError(f"cpm {' '.join(argv)} failed:\n{stderr}")
+    return {"wall": round(wall, 4), "peak_rss": rss}
+
+
+def scenarios(args, root, workdir):
+    card = Path(workdir) / "card.yaml"
+    card.write_text(
+        "name: uploaded card\ntags: bench\ndeps: root\ndesc: A card\n"
+        "file: https://files.catbox.moe/fwefw22\n"
+    )
+    jobs = ["--jobs", str(args.jobs)]
+    return [
+        ("search", ["search", "--all", *jobs], False),
+        ("download", ["download", root, *jobs], False),
+        ("download-warm", ["download", root, *jobs], True),
+        ("compile", ["compile", root, "-f", "compiled.lorebook", *jobs], False),
+        ("upload", ["upload", "-f", str(card)], False),
+    ]
+
+
+def bench(args) -> list:
+    results = []
+    for shape in args.shapes:
+        repo = Repository(args.latency, args.bandwidth, args.bulk)
+        server = serve(repo)
+        root = graph(repo, shape, args.size, args.entries, args.image)
+        with tempfile.TemporaryDirectory() as workdir:
+            env = dict(
+                os.environ,
+                PYTHONPATH=str(ROOT / "src"),
+                CPM_URL=repo.url,
+                CPM_CACHE_DIR=str(Path(workdir) / "cache"),
+            )
+            env.pop("CPM_DEBUG", None)
+            for name, argv, warm in scenarios(args, root, workdir):
+                cwd = Path(workdir) / name
+                cwd.mkdir()
+                if not warm:
+                    # cold cache, but keep the scheme check out of the numbers
+                    for path in (Path(workdir) / "cache").glob("*"):
+                        if path.name == "scheme.json":
+                            continue
+                        if path.is_dir():
+                            shutil.rmtree(path)
+                        else:
+                            path.unlink()
+                repo.reset_counters()
+                result = run_cli(argv, env, cwd)
+                result.update(
+                    scenario=name,
+                    shape=shape,
+                    size=args.size,
+                    requests=repo.requests,
+                    bytes=repo.bytes,
+                )
+                results.append(result)
+                print(json.dumps(result), file=sys.stderr)
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def compare(results, baseline, threshold) -> list:
+    """Scenarios that got slower (or made more requests) than `threshold` times the baseline"""
+    old = {(r["scenario"], r["shape"], r["size"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        before = old.get((result["scenario"], result["shape"], result["size"]))
+        if not before:
+            continue
+        for metric in ("wall", "requests", "bytes", "peak_rss"):
+            if before.get(metric) and result.get(metric) is not None:
+                if result[metric] > before[metric] * threshold:
+                    regressions.append(
+                        f"{result['scenario']}/{result['shape']}: {metric} "
+                        f"{before[metric]} -> {result[metric]}"
+                    )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--shapes", nargs="+", default=SHAPES, choices=SHAPES)
+    parser.add_argument("--size", type=int, default=40, help="Packages in the graph")
+    parser.add_argument("--entries", type=int, default=100, help="Entries per lorebook")
+    parser.add_argument("--image", type=int, default=200000, help="Bytes per image")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per request")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Bytes/s per response")
+    parser.add_argument("--bulk", action="store_true", help="Serve the /bulk endpoint")
+    parser.add_argument("--jobs", type=int, default=8)
+    parser.add_argument("--output", "-o", help="Write the results to this file")
+    parser.add_argument("--compare", help="Results of a previous run")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    args = parser.parse_args()
+
+    results = bench(args)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    else:
+        print(text)
+
+    if args.compare:
+        regressions = compare(results, json.loads(Path(args.compare).read_text()), args.threshold)
+        for line in regressions:
+            print("REGRESSION", line, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
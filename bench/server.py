@@ -0,0 +1,244 @@
+"""
+Local stand-in for the repository server and the file hosts, for benchmarks.
+
+Serves the same HTTP surface `Client` uses:
+    GET  /docs              item scheme (and /bulk if enabled)
+    GET  /?page=N&name=...  catalog, 10 items per page. Tags go as a bare "a b" argument
+    GET  /<name>            package metadata
+    POST /                  create a package
+    POST /<name>            update a package
+    POST /bulk              metadata of many packages ({"names": [...]}), optional
+    GET  /files/<file>      lorebooks and images, with Range support
+
+Latency (per request) and bandwidth (per response) are configurable.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+import time
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+SCHEME = {
+    "id": "",
+    "name": "",
+    "deps": [],
+    "tags": [],
+    "image": "",
+    "desc": "",
+    "file": "",
+    "service": "NAI",
+    "date_created": "",
+    "date_updated": "",
+}
+PAGE_SIZE = 10
+
+
+def lorebook(name: str, entries: int) -> bytes:
+    """A lorebook with `entries` entries of about 1KB each"""
+    data = {
+        "lorebookVersion": 4,
+        "entries": [
+            {
+                "text": f"{name} {index} " + "lorem ipsum " * 80,
+                "displayName": f"{name} {index}",
+                "keys": [name, str(index)],
+                "enabled": True,
+            }
+            for index in range(entries)
+        ],
+        "settings": {"orderByKeyLocations": False},
+        "categories": [{"name": name, "enabled": True}],
+    }
+    return json.dumps(data).encode("utf-8")
+
+
+class Repository:
+    """Catalog, files and counters shared by the handler threads"""
+
+    def __init__(self, latency: float = 0.0, bandwidth: float = None, bulk: bool = False):
+        self.latency = latency
+        self.bandwidth = bandwidth  # bytes/s, None for unlimited
+        self.bulk = bulk
+        self.items = {}
+        self.files = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.url = None  # set by `serve`
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes = 0
+
+    def add(self, name: str, deps=(), tags=(), entries: int = 10, image: int = 0):
+        """Add a package with a lorebook (and an image of `image` bytes)"""
+        self.files[f"{name}.lorebook"] = lorebook(name, entries)
+        if image:
+            self.files[f"{name}.png"] = random.Random(name).randbytes(image)
+        self.items[name] = {
+            "id": len(self.items) + 1,
+            "name": name,
+            "deps": list(deps),
+            "tags": list(tags),
+            "image": f"{self.url}files/{name}.png" if image else "",
+            "desc": f"The {name} package",
+            "file": f"{self.url}files/{name}.lorebook",
+            "service": "NAI",
+            "date_created": "2022-08-02T10:00:00",
+            "date_updated": "2022-08-02T10:00:00",
+        }
+
+
+def graph(repo: Repository, shape: str, size: int, entries: int = 10, image: int = 0) -> str:
+    """
+    Fill the repository with a dependency graph and return the name of the root.
+        wide: the root depends on `size` leaves
+        deep: a chain of `size` packages
+        diamond: the root depends on `size` packages that all depend on the same base
+    """
+    if shape == "wide":
+        leaves = [f"leaf {n}" for n in range(size)]
+        for leaf in leaves:
+            repo.add(leaf, tags=["wide"], entries=entries, image=image)
+        repo.add("root", leaves, ["wide"], entries, image)
+    elif shape == "deep":
+        for n in range(size):
+            deps = [f"link {n + 1}"] if n + 1 < size else []
+            repo.add(f"link {n}", deps, ["deep"], entries, image)
+        repo.add("root", ["link 0"], ["deep"], entries, image)
+    elif shape == "diamond":
+        repo.add("base", tags=["diamond"], entries=entries, image=image)
+        middles = [f"middle {n}" for n in range(size)]
+        for middle in middles:
+            repo.add(middle, ["base"], ["diamond"], entries, image)
+        repo.add("root", middles, ["diamond"], entries, image)
+    else:
+        raise ValueError(shape)
+    return "root"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    repo: Repository = None
+
+    def log_message(self, *args):  # pylint: disable=W0221
+        pass
+
+    def _send(self, status: int, body: bytes, content_type="application/json", headers=None):
+        if self.repo.latency:
+            time.sleep(self.repo.latency)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command == "HEAD":
+            body = b""
+        chunk = 16 * 1024
+        for start in range(0, len(body), chunk):
+            self.wfile.write(body[start : start + chunk])
+            if self.repo.bandwidth:
+                time.sleep(min(chunk, len(body) - start) / self.repo.bandwidth)
+        with self.repo.lock:
+            self.repo.requests += 1
+            self.repo.bytes += len(body)
+
+    def _json(self, data, status=200):
+        self._send(status, json.dumps(data).encode("utf-8"))
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_HEAD(self):  # pylint: disable=C0103
+        self.do_GET()
+
+    def do_GET(self):  # pylint: disable=C0103
+        parts = urlsplit(self.path)
+        path = unquote(parts.path).strip("/")
+        if path == "docs":
+            urls = {"/": {"scheme": dict(SCHEME)}}
+            if self.repo.bulk:
+                urls["/bulk"] = {}
+            self._json({"urls": urls})
+        elif path.startswith("files/"):
+            self._file(path[len("files/") :])
+        elif path:
+            if path not in self.repo.items:
+                self._json({"error": "not found"}, 404)
+            else:
+                self._json(self.repo.items[path])
+        else:
+            self._list(parts.query)
+
+    def _list(self, query: str):
+        page = 0
+        name = None
+        tags = []
+        for arg in query.split("&") if query else []:
+            if "=" in arg:
+                key, value = parse_qsl(arg)[0]
+                if key == "page":
+                    page = int(value)
+                elif key == "name":
+                    name = value
+            else:
+                tags.extend(unquote(arg).split())
+        items = [
+            item
+            for item in self.repo.items.values()
+            if (name is None or name.lower() in item["name"].lower())
+            and all(tag in item["tags"] for tag in tags)
+        ]
+        self._json(items[page * PAGE_SIZE : (page + 1) * PAGE_SIZE])
+
+    def _file(self, name: str):
+        if name not in self.repo.files:
+            self._send(404, b"not found", "text/plain")
+            return
+        body = self.repo.files[name]
+        content_type = "image/png" if name.endswith(".png") else "application/json"
+        ranges = self.headers.get("Range", "")
+        if ranges.startswith("bytes=") and ranges.endswith("-"):
+            start = int(ranges[len("bytes=") : -1])
+            if start >= len(body):
+                self._send(416, b"", "text/plain")
+                return
+            self._send(
+                206,
+                body[start:],
+                content_type,
+                {"Content-Range": f"bytes {start}-{len(body) - 1}/{len(body)}"},
+            )
+            return
+        self._send(200, body, content_type)
+
+    def do_POST(self):  # pylint: disable=C0103
+        path = unquote(urlsplit(self.path).path).strip("/")
+        data = self._body()
+        if path == "bulk" and self.repo.bulk:
+            self._json([self.repo.items[name] for name in data["names"] if name in self.repo.items])
+        elif not path:
+            data.setdefault("deps", [])
+            data.setdefault("tags", [])
+            item = dict(SCHEME, **data, id=len(self.repo.items) + 1)
+            self.repo.items[item["name"]] = item
+            self._json(item, 201)
+        elif path in self.repo.items:
+            self.repo.items[path].update(data)
+            self._json(self.repo.items[path])
+        else:
+            self._json({"error": "not found"}, 404)
+
+
+def serve(repo: Repository, port: int = 0) -> ThreadingHTTPServer:
+    """Start the server on a background thread. `repo.url` is set to its address"""
+    handler = type("RepositoryHandler", (Handler,), {"repo": repo})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    repo.url = f"http://127.0.0.1:{server.server_address[1]}/"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
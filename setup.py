@@ -18,6 +18,7 @@ setuptools.setup(
      url="https://github.com/Moist-Cat/cpm",
      scripts=["cpm", "cpm.bin"],
      install_requires=REQUIREMENTS,
+     extras_require={"fast": ["orjson"]},
      include_package_data=True,
      package_dir={"":"src"},
      packages=setuptools.find_packages(where="src"),
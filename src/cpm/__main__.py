@@ -5,7 +5,7 @@ import argparse
 from typing import List
 import sys
 
-from cpm import command
+from cpm import command, settings, transfer
 
 
 def get_command(argv: List[str] = sys.argv[1:]): # pylint: disable=W0102
@@ -15,6 +15,18 @@ def get_command(argv: List[str] = sys.argv[1:]): # pylint: disable=W0102
 
     subparsers = parser.add_subparsers()
 
+    cache_parser = argparse.ArgumentParser(add_help=False)
+    cache_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't read or write the local metadata cache",
+    )
+    cache_parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Revalidate cached metadata with the server even if it's fresh",
+    )
+
     search_parser = subparsers.add_parser("search", help=command.search.__doc__)
     search_parser.set_defaults(func=command.search)
     search_parser.add_argument(
@@ -35,29 +47,99 @@ def get_command(argv: List[str] = sys.argv[1:]): # pylint: disable=W0102
         default=None,
         type=str,
     )
+    search_parser.add_argument(
+        "--offline",
+        "-o",
+        action="store_true",
+        help="Search the local catalog (see `cpm sync`) instead of the server",
+    )
+    search_parser.add_argument(
+        "--query",
+        "-q",
+        default=None,
+        type=str,
+        help="Words to look for in the name, description and tags (offline only)",
+    )
+
+    search_parser.add_argument(
+        "--all",
+        "-a",
+        action="store_true",
+        help="Fetch every page at once and print the results without pausing",
+    )
+    search_parser.add_argument(
+        "--json",
+        action="store_true",
+        help="With --all, print the full metadata of each package as JSON Lines",
+    )
+    search_parser.add_argument(
+        "--jobs",
+        "-j",
+        default=settings.JOBS,
+        type=int,
+        help="Number of pages to fetch at the same time with --all",
+    )
 
-    info_parser = subparsers.add_parser("info", help=command.info.__doc__)
+    sync_parser = subparsers.add_parser("sync", help=command.sync.__doc__)
+    sync_parser.set_defaults(func=command.sync)
+    sync_parser.add_argument(
+        "--jobs",
+        "-j",
+        default=settings.JOBS,
+        type=int,
+        help="Number of pages to fetch at the same time",
+    )
+
+    info_parser = subparsers.add_parser(
+        "info", help=command.info.__doc__, parents=[cache_parser]
+    )
     info_parser.set_defaults(func=command.info)
     info_parser.add_argument(
         "name",
         type=str,
     )
 
-    upload_parser = subparsers.add_parser("upload", help=command.upload.__doc__)
+    publish_parser = argparse.ArgumentParser(add_help=False)
+    publish_parser.add_argument(
+        "--dir",
+        "-d",
+        type=str,
+        help="Publish every .yaml/.yml file in this directory",
+    )
+    publish_parser.add_argument(
+        "--jobs",
+        "-j",
+        default=settings.JOBS,
+        type=int,
+        help="Number of packages to send at the same time",
+    )
+    publish_parser.add_argument(
+        "--retries",
+        default=1,
+        type=int,
+        help="Times to send again the packages that failed",
+    )
+
+    upload_parser = subparsers.add_parser(
+        "upload", help=command.upload.__doc__, parents=[publish_parser]
+    )
     upload_parser.set_defaults(func=command.upload)
     upload_parser.add_argument(
         "--file",
         "-f",
         type=str,
-        help="YAML file to fetch the data from.",
+        help="YAML file to fetch the data from (- for stdin). Can have many documents.",
     )
 
-    update_parser = subparsers.add_parser("update", help=command.update.__doc__)
+    update_parser = subparsers.add_parser(
+        "update", help=command.update.__doc__, parents=[cache_parser, publish_parser]
+    )
     update_parser.set_defaults(func=command.update)
     update_parser.add_argument(
         "name",
         type=str,
-        help="Item name",
+        nargs="?",
+        help="Item name. Without it, each document of --file/--dir updates the package it names",
     )
     update_parser.add_argument(
         "--file",
@@ -66,17 +148,65 @@ def get_command(argv: List[str] = sys.argv[1:]): # pylint: disable=W0102
         help="yaml file to fetch the data from.",
     )
 
-    download_parser = subparsers.add_parser("download", help=command.download.__doc__)
+    deps_parser = subparsers.add_parser(
+        "deps", help=command.deps.__doc__, parents=[cache_parser]
+    )
+    deps_parser.set_defaults(func=command.deps)
+    deps_parser.add_argument(
+        "name",
+        type=str,
+        help="Item name (or comma separated names)",
+    )
+    deps_output = deps_parser.add_mutually_exclusive_group()
+    deps_output.add_argument(
+        "--tree",
+        action="store_true",
+        help="Show the dependency tree instead of the download plan",
+    )
+    deps_output.add_argument(
+        "--json",
+        action="store_true",
+        help="Print the plan, the cycles and the metadata of every package as JSON",
+    )
+    deps_parser.add_argument(
+        "--jobs",
+        "-j",
+        default=settings.JOBS,
+        type=int,
+        help="Number of metadata requests at the same time",
+    )
+
+    download_parser = subparsers.add_parser(
+        "download", help=command.download.__doc__, parents=[cache_parser]
+    )
     download_parser.set_defaults(func=command.download)
     download_parser.add_argument(
         "name",
         type=str,
         help="Item name",
     )
+    download_parser.add_argument(
+        "--jobs",
+        "-j",
+        default=settings.JOBS,
+        type=int,
+        help="Number of packages to fetch at the same time",
+    )
+    download_parser.add_argument(
+        "--limit-rate",
+        type=transfer.parse_rate,
+        help="Cap the download speed of all the files together (like 500k or 2M per second)",
+    )
+    download_parser.add_argument(
+        "--frozen",
+        action="store_true",
+        help="Reproduce exactly the packages and files of the lockfile",
+    )
 
     compile_parser = subparsers.add_parser(
         "compile",
         help=command.compile.__doc__,
+        parents=[cache_parser],
     )
     compile_parser.set_defaults(func=command.compile)
     compile_parser.add_argument(
@@ -84,6 +214,23 @@ def get_command(argv: List[str] = sys.argv[1:]): # pylint: disable=W0102
         type=str,
         help="Item name",
     )
+    compile_parser.add_argument(
+        "--jobs",
+        "-j",
+        default=settings.JOBS,
+        type=int,
+        help="Number of packages to fetch at the same time",
+    )
+    compile_parser.add_argument(
+        "--limit-rate",
+        type=transfer.parse_rate,
+        help="Cap the download speed of all the files together (like 500k or 2M per second)",
+    )
+    compile_parser.add_argument(
+        "--frozen",
+        action="store_true",
+        help="Reproduce exactly the packages and files of the lockfile",
+    )
     compile_parser.add_argument(
         "--file",
         "-f",
@@ -91,12 +238,110 @@ def get_command(argv: List[str] = sys.argv[1:]): # pylint: disable=W0102
         default="compiled.lorebook",
         help="Place the output in this file",
     )
+    compile_parser.add_argument(
+        "--workers",
+        "-w",
+        default=1,
+        type=int,
+        help="Number of processes parsing the lorebooks (for very large compiles)",
+    )
+    compile_parser.add_argument(
+        "--conflicts",
+        choices=("first", "last", "report"),
+        default=settings.CONFLICT_POLICY,
+        help="Which one to keep when entries with the same keys or categories"
+        " with the same name differ. `report` lists them and compiles nothing",
+    )
+
+    mirror_parser = subparsers.add_parser("mirror", help=command.mirror.__doc__)
+    mirror_parser.set_defaults(func=command.mirror)
+    mirror_parser.add_argument(
+        "--dir",
+        "-d",
+        default=settings.MIRROR_DIR,
+        type=str,
+        help="Where to keep the mirror",
+    )
+    mirror_parser.add_argument(
+        "--jobs",
+        "-j",
+        default=settings.JOBS,
+        type=int,
+        help="Number of files to fetch at the same time",
+    )
+    mirror_parser.add_argument(
+        "--limit-rate",
+        type=transfer.parse_rate,
+        help="Cap the download speed of all the files together (like 500k or 2M per second)",
+    )
+
+    serve_parser = subparsers.add_parser("serve", help=command.serve.__doc__)
+    serve_parser.set_defaults(func=command.serve)
+    serve_parser.add_argument(
+        "--dir",
+        "-d",
+        default=settings.MIRROR_DIR,
+        type=str,
+        help="Mirror made with `cpm mirror`",
+    )
+    serve_parser.add_argument(
+        "--host",
+        default=settings.SERVE_HOST,
+        type=str,
+        help="Address to listen on",
+    )
+    serve_parser.add_argument(
+        "--port",
+        "-p",
+        default=settings.SERVE_PORT,
+        type=int,
+        help="Port to listen on",
+    )
+    serve_parser.add_argument(
+        "--url",
+        type=str,
+        help="URL the clients reach the mirror at (http://mirror.lan:5050/). "
+        "Taken from each request by default",
+    )
+
+    stats_parser = subparsers.add_parser("stats", help=command.stats.__doc__)
+    stats_parser.set_defaults(func=command.stats)
+    stats_parser.add_argument(
+        "--reset",
+        action="store_true",
+        help="Forget all the recorded metrics",
+    )
 
     debug_parser = subparsers.add_parser(
         "debug",
         help=command.debug.__doc__
     )
     debug_parser.set_defaults(func=command.debug)
+    debug_parser.add_argument(
+        "--level",
+        "-l",
+        type=str.upper,
+        choices=("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"),
+        help="Only records of this level or above",
+    )
+    debug_parser.add_argument(
+        "--logger",
+        type=str,
+        help="Only records of this logger and its children (audit.client, audit.command...)",
+    )
+    debug_parser.add_argument(
+        "--lines",
+        "-n",
+        default=200,
+        type=int,
+        help="Number of records to show",
+    )
+    debug_parser.add_argument(
+        "--follow",
+        "-f",
+        action="store_true",
+        help="Keep printing new records as they are written",
+    )
 
     args = parser.parse_args(argv)
     args.func(args)
@@ -0,0 +1,149 @@
+"""
+On-disk cache for package metadata. Entries are keyed by package name,
+expire after a TTL and get revalidated with conditional requests.
+"""
+from datetime import datetime, timezone
+from email.utils import format_datetime
+import hashlib
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Optional
+
+from cpm.logging import get_logger
+from cpm import codec, disk, settings
+
+logger = get_logger("audit.cache")
+
+
+class MetadataCache:
+    """
+    One JSON file per package holding the metadata and the validators
+    (ETag, Last-Modified) the server sent with it.
+    The least recently used files are evicted once the cache is over `max_bytes`.
+    """
+
+    def __init__(self, path: Path = None, ttl: float = None, max_bytes: int = None):
+        self.path = Path(path or settings.CACHE_DIR / "meta")
+        self.ttl = settings.CACHE_TTL if ttl is None else ttl
+        self.max_bytes = max_bytes or settings.CACHE_MAX_BYTES
+        self.enabled = True
+        self.refresh = False  # revalidate everything regardless of the TTL
+        self.stats = {"hits": 0, "misses": 0, "revalidated": 0}
+        self._lock = threading.Lock()
+
+    def _file(self, name: str) -> Path:
+        return self.path / (hashlib.sha1(name.encode("utf-8")).hexdigest() + ".json")
+
+    def _count(self, key: str, name: str):
+        with self._lock:
+            self.stats[key] += 1
+        logger.debug("Metadata cache %s: %s", key, name)
+
+    def load(self, name: str) -> Optional[dict]:
+        """The cached entry for the package or None"""
+        if not self.enabled:
+            return None
+        try:
+            with open(self._file(name), "rb") as file:
+                return codec.loads(file.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def fresh(self, entry: dict) -> bool:
+        return not self.refresh and time.time() - entry["fetched"] < self.ttl
+
+    def hit(self, name: str, entry: dict) -> dict:
+        """Use a cached entry without asking the server"""
+        self._count("hits", name)
+        try:
+            os.utime(self._file(name))  # LRU
+        except FileNotFoundError:
+            pass
+        return entry["data"]
+
+    def miss(self, name: str):
+        self._count("misses", name)
+
+    @staticmethod
+    def validators(entry: Optional[dict]) -> dict:
+        """Headers for a conditional request"""
+        headers = {}
+        if not entry:
+            return headers
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        elif not headers and entry["data"].get("date_updated"):
+            try:
+                date = datetime.fromisoformat(entry["data"]["date_updated"])
+            except (TypeError, ValueError):
+                return headers
+            if date.tzinfo is None:
+                date = date.replace(tzinfo=timezone.utc)
+            headers["If-Modified-Since"] = format_datetime(date, usegmt=True)
+        return headers
+
+    def revalidated(self, name: str, entry: dict) -> dict:
+        """The server answered 304, the entry is good for another TTL"""
+        self._count("revalidated", name)
+        return self._renew(name, entry)
+
+    def _renew(self, name: str, entry: dict) -> dict:
+        entry["fetched"] = time.time()
+        self._write(name, entry)
+        return entry["data"]
+
+    def put(self, name: str, data: dict, headers: dict = None):
+        headers = headers or {}
+        if not self.enabled:
+            return
+        cached = self.load(name)
+        if (
+            cached
+            and not headers.get("ETag")
+            and not headers.get("Last-Modified")
+            and data.get("date_updated")
+            and cached["data"].get("date_updated") == data.get("date_updated")
+        ):
+            # the server has no validators but date_updated didn't change
+            self._renew(name, cached)
+            return
+        self._write(
+            name,
+            {
+                "fetched": time.time(),
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"),
+                "data": data,
+            },
+        )
+        self.evict()
+
+    def discard(self, name: str):
+        disk.remove(self._file(name))
+
+    def _write(self, name: str, entry: dict):
+        self.path.mkdir(parents=True, exist_ok=True)
+        file = self._file(name)
+        tmp = file.with_suffix(f".{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as jfile:
+            jfile.write(codec.dumps(entry))
+        os.replace(tmp, file)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in `max_bytes`"""
+        for file in disk.evict(self.path.glob("*.json"), self.max_bytes):
+            logger.debug("Evicted %s from the metadata cache", file.name)
+
+    def report(self):
+        if not any(self.stats.values()):
+            return
+        logger.info(
+            "Metadata cache: %d hits, %d misses, %d revalidated",
+            self.stats["hits"],
+            self.stats["misses"],
+            self.stats["revalidated"],
+        )
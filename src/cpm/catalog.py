@@ -0,0 +1,157 @@
+"""
+Local index of the catalog metadata (SQLite + FTS5) so searches don't need the server.
+"""
+from pathlib import Path
+import sqlite3
+from typing import Iterable, List, Tuple
+
+from cpm.logging import get_logger
+from cpm import codec, settings, transfer
+
+logger = get_logger("audit.catalog")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS packages (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    date_updated TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tags (
+    package INTEGER NOT NULL REFERENCES packages(id) ON DELETE CASCADE,
+    tag TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tags_tag ON tags(tag);
+CREATE VIRTUAL TABLE IF NOT EXISTS packages_fts USING fts5(name, desc, tags);
+"""
+
+
+def _match(tokens: Iterable[str], column: str = None) -> str:
+    """FTS5 query that matches every token as a prefix"""
+    prefix = f"{column} : " if column else ""
+    return " AND ".join(
+        prefix + '"' + token.replace('"', '""') + '"*' for token in tokens
+    )
+
+
+class Catalog:
+    """
+    Mirror of the catalog metadata.
+    `sync` pages through the server and only rewrites the packages whose
+    `date_updated` changed, `search` answers queries locally.
+    """
+
+    def __init__(self, path: Path = None):
+        self.path = Path(path or settings.CATALOG_FILE)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM packages").fetchone()[0]
+
+    def _upsert(self, item: dict):
+        row = self.db.execute(
+            "SELECT id FROM packages WHERE name = ?", (item["name"],)
+        ).fetchone()
+        if row:
+            self.db.execute("DELETE FROM packages WHERE id = ?", row)
+            self.db.execute("DELETE FROM packages_fts WHERE rowid = ?", row)
+        cursor = self.db.execute(
+            "INSERT INTO packages (name, date_updated, data) VALUES (?, ?, ?)",
+            (item["name"], item.get("date_updated"), codec.dumps(item)),
+        )
+        tags = item.get("tags") or []
+        self.db.executemany(
+            "INSERT INTO tags (package, tag) VALUES (?, ?)",
+            [(cursor.lastrowid, tag.lower()) for tag in tags],
+        )
+        self.db.execute(
+            "INSERT INTO packages_fts (rowid, name, desc, tags) VALUES (?, ?, ?, ?)",
+            (cursor.lastrowid, item["name"], item.get("desc") or "", " ".join(tags)),
+        )
+
+    def update(self, items: Iterable[dict]) -> Tuple[int, int]:
+        """
+        Bring the index up to date with the full list of items of the catalog.
+        Returns the number of packages (re)written and removed.
+        """
+        known = dict(self.db.execute("SELECT name, date_updated FROM packages"))
+        seen = set()
+        written = 0
+        with self.db:
+            for item in items:
+                seen.add(item["name"])
+                if (
+                    item["name"] in known
+                    and item.get("date_updated")
+                    and known[item["name"]] == item["date_updated"]
+                ):
+                    continue
+                self._upsert(item)
+                written += 1
+            gone = [name for name in known if name not in seen]
+            for name in gone:
+                row = self.db.execute(
+                    "SELECT id FROM packages WHERE name = ?", (name,)
+                ).fetchone()
+                self.db.execute("DELETE FROM packages_fts WHERE rowid = ?", row)
+                self.db.execute("DELETE FROM packages WHERE id = ?", row)
+        logger.info("Catalog synced. %d packages written, %d removed", written, len(gone))
+        return written, len(gone)
+
+    def sync(self, client, jobs: int = 1) -> Tuple[int, int]:
+        """Crawl the catalog of the server (`jobs` pages at a time) and update the index"""
+        items = (
+            item
+            for page in transfer.pages(client.list_item, jobs=jobs)
+            for item in page
+        )
+        return self.update(items)
+
+    def search(
+        self, query: str = None, tags: List[str] = None, name: str = None, limit: int = None
+    ) -> List[dict]:
+        """
+        Packages matching all the criteria:
+            query: words in the name, description or tags (prefixes are enough)
+            tags: exact tags (AND)
+            name: words in the name
+        Ranked by relevance (bm25) when there are words to match, by name otherwise.
+        """
+        match = " AND ".join(
+            filter(
+                None,
+                (
+                    _match(query.split()) if query else None,
+                    _match(name.split(), "name") if name else None,
+                ),
+            )
+        )
+        sql = "SELECT packages.data FROM packages"
+        where = []
+        params = []
+        if match:
+            sql += " JOIN packages_fts ON packages_fts.rowid = packages.id"
+            where.append("packages_fts MATCH ?")
+            params.append(match)
+        if tags:
+            tags = [tag.strip().lower() for tag in tags]
+            where.append(
+                "packages.id IN (SELECT package FROM tags WHERE tag IN (%s)"
+                " GROUP BY package HAVING COUNT(DISTINCT tag) = ?)"
+                % ", ".join("?" * len(tags))
+            )
+            params.extend(tags)
+            params.append(len(set(tags)))
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY " + ("bm25(packages_fts)" if match else "packages.name")
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [codec.loads(data) for (data,) in self.db.execute(sql, params)]
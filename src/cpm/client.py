@@ -1,31 +1,49 @@
 """Module containing the http client with basic methods to interact with the server"""
+import atexit
 import inspect
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
+import threading
 import time
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
 
 import requests
+import requests.adapters
 
+from cpm.cache import MetadataCache
+from cpm.endpoints import Endpoints
 from cpm.logging import logged
-from cpm import settings
+from cpm.metrics import METRICS
+from cpm import codec, retry, settings
+
+
+class _Arguments:
+    """Arguments of a call, only formatted if the record is written"""
+
+    __slots__ = ("names", "values")
+
+    def __init__(self, names, values):
+        self.names = names
+        self.values = values
+
+    def __str__(self):
+        return str([f"{name}={value}" for name, value in zip(self.names, self.values)])
 
 
 def loggedmethod(method):
     """Log a CRUD method and confirm its successful execution"""
+    arg_names = inspect.getfullargspec(method).args[1:]  # without self
+    method_type = method.__name__.split("_")[0].upper()
+
     @wraps(method)
     def wrapper(self, *args, **kwargs):
-        method_data = inspect.getfullargspec(method)
-        method_type = method.__name__.split("_")[0].upper()
-        # + 1 because of self
-        self.logger.info(
-            "%s %s",
-            method_type,
-            [
-                f"{method_data.args[index + 1]}={value}"
-                for index, value in enumerate(args)
-            ],
-        )
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info("%s %s", method_type, _Arguments(arg_names, args))
 
-        res = method(self, *args, *kwargs)
+        res = method(self, *args, **kwargs)
 
         self.logger.info("%s --success--", method_type)
         return res
@@ -33,53 +51,131 @@ def loggedmethod(method):
     return wrapper
 
 
+def _size(response, stream: bool) -> int:
+    """Bytes in the body of the response, without reading it if it's streamed"""
+    try:
+        return int(response.headers["Content-Length"])
+    except (KeyError, TypeError, ValueError):
+        pass
+    if stream:
+        return 0
+    return len(response.content)
+
+
+_READS = ("GET", "HEAD")  # safe to send again or to another endpoint
+
+
+def _failover(session, method: str, url: str) -> Optional[str]:
+    """
+    `url` on the next repository endpoint, if the session has more than one.
+    Only for reads, writes must reach the primary.
+    """
+    endpoints = getattr(session, "endpoints", None)
+    if not endpoints or method.upper() not in _READS:
+        return None
+    return endpoints.failover(url)
+
+
 def check_errors(request):
     """
-    VERSION: 1.0.1
+    VERSION: 1.1.0
     Properly handles HTTP and other comms related errors.
+    Connection errors and 429/503 responses are retried with backoff while the
+    retry budget allows it. Hosts that keep failing are skipped by the circuit breaker.
     """
 
     @wraps(request)
     def inner_func(cls, method, url, **kwargs):
-        request_success = False
+        host = urlsplit(url).netloc
         retries = 0
-        while not request_success:
+        while True:
+            if not cls.breaker.allow(host):
+                cls.logger_error.error("Server URL: %s, host %s is down. Skipping.", url, host)
+                alternative = _failover(cls, method, url)
+                if alternative is None:
+                    raise retry.CircuitOpenError(f"{host} failed too many times in a row")
+                url, host = alternative, urlsplit(alternative).netloc
+                continue
+            start = time.perf_counter()
             try:
                 response = request(cls, method, url, **kwargs)
+                METRICS.record(
+                    method,
+                    url,
+                    response.status_code,
+                    time.perf_counter() - start,
+                    0 if method == "HEAD" else _size(response, kwargs.get("stream")),
+                    retried=retries > 0,
+                )
                 response.raise_for_status()
             except (
                 requests.exceptions.ConnectionError,
                 requests.exceptions.SSLError,
+                requests.exceptions.Timeout,
             ) as exc:
+                METRICS.record(
+                    method,
+                    url,
+                    type(exc).__name__,
+                    time.perf_counter() - start,
+                    retried=retries > 0,
+                )
+                cls.breaker.failure(host)
                 cls.logger_error.exception(exc)
 
-                cls.logger.info("Network unstable. Retrying...")
                 cls.logger_error.error(
                     "Server URL: %s, failed while trying to connect.", url
                 )
-                if retries > settings.RETRIES:
+                timed_out = isinstance(exc, requests.exceptions.ReadTimeout)
+                if timed_out and method.upper() not in _READS:
+                    raise exc  # the server may have applied it already
+                # another endpoint can answer right away, don't wait for this one
+                alternative = _failover(cls, method, url)
+                if alternative is not None:
+                    url, host = alternative, urlsplit(alternative).netloc
+                    continue
+                cls.logger.info("Network unstable. Retrying...")
+                if retries >= settings.RETRIES or not cls.budget.spend():
                     raise exc
+                delay = retry.backoff(retries)
 
             except requests.exceptions.HTTPError as exc:
-                try:
-                    payload = kwargs["data"]
-                except KeyError:
-                    payload = "none"
-                error_message = f"""
-                    Server URL: {response.url}, 
-                    failed with status code ({response.status_code}).
-                    Raw response: {response.content[:50]} 
-                    Request payload: {payload}
-                """
-                cls.logger.error(error_message)
-                with open(settings.BASE_DIR / "logs/debug.html", "w+b") as file:
-                    file.write(response.content)
-                raise exc
+                delay = None
+                if response.status_code in retry.RETRY_STATUS:
+                    if response.status_code == 503:
+                        cls.breaker.failure(host)
+                    delay = retry.retry_after(response)
+                    if delay is None:
+                        delay = retry.backoff(retries)
+                if (
+                    delay is not None
+                    and delay <= settings.BACKOFF_MAX
+                    and retries < settings.RETRIES
+                    and cls.budget.spend()
+                ):
+                    cls.logger.info(
+                        "Server busy (%d). Retrying in %.1fs...", response.status_code, delay
+                    )
+                else:
+                    try:
+                        payload = kwargs["data"]
+                    except KeyError:
+                        payload = "none"
+                    error_message = f"""
+                        Server URL: {response.url}, 
+                        failed with status code ({response.status_code}).
+                        Raw response: {response.content[:50]} 
+                        Request payload: {payload}
+                    """
+                    cls.logger.error(error_message)
+                    with open(settings.BASE_DIR / "logs/debug.html", "w+b") as file:
+                        file.write(response.content)
+                    raise exc
             else:
-                request_success = True
-            time.sleep(1)
+                cls.breaker.success(host)
+                return response
+            time.sleep(delay)
             retries += 1
-        return response
 
     return inner_func
 
@@ -88,31 +184,101 @@ def check_errors(request):
 class Client(requests.Session):
     """Main client for the Card Package Manager. Handles a basic CRUD for packages"""
 
-    URL: str = settings.URL
     SCHEME: dict = settings.ITEM_SCHEME
     _last_response: requests.Response = None  # for testing and debugging
 
-    DOCS_URL = URL + "docs"
-
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.logger.info("##### INIT ######")
+        self.endpoints = Endpoints()
+        self.endpoints.start()
         self.headers["Authorization"] = settings.get_keys()
+        self.pool_size = 0
+        self.mount_pools(settings.JOBS)
+        self.bulk = False  # the server has a bulk endpoint for metadata
+        self.budget = retry.RetryBudget()
+        self.breaker = retry.CircuitBreaker()
+        self.cache = MetadataCache()
+        atexit.register(self._report)
 
         if not settings.DEBUG:
             self._test_scheme()
 
+    @property
+    def URL(self) -> str:  # pylint: disable=C0103
+        """The fastest endpoint that is up"""
+        return self.endpoints.current
+
+    @property
+    def DOCS_URL(self) -> str:  # pylint: disable=C0103
+        return self.URL + "docs"
+
+    @property
+    def BULK_URL(self) -> str:  # pylint: disable=C0103
+        return self.URL + "bulk"
+
+    def _report(self):
+        self.cache.report()
+        if any(self.cache.stats.values()):
+            METRICS.record_cache(self.URL, self.cache.stats)
+        METRICS.save()
+
     @check_errors
     def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", settings.TIMEOUT)
         res = super().request(*args, **kwargs)
-        _last_response = res
+        self._last_response = res
         return res
 
+    def post_json(self, url: str, data, **kwargs):
+        """POST `data` encoded with the fast codec (requests' `json=` uses the stdlib)"""
+        headers = {**(kwargs.pop("headers", None) or {}), "Content-Type": "application/json"}
+        return self.post(url, data=codec.dumps(data), headers=headers, **kwargs)
+
+    def mount_pools(self, size: int):
+        """
+        Size the connection pools so `size` workers can share the client
+        without discarding connections. Pools are never shrunk.
+        """
+        if size <= self.pool_size:
+            return
+        self.pool_size = size
+        adapter = requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def _last_scheme_check(self) -> Optional[dict]:
+        """The last scheme check against this server, if it's recent"""
+        try:
+            with open(settings.SCHEME_FILE) as file:
+                check = json.load(file)[self.URL]
+            if time.time() - check["checked"] < settings.SCHEME_TTL:
+                return check
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    def _save_scheme_check(self):
+        try:
+            with open(settings.SCHEME_FILE) as file:
+                checks = json.load(file)
+        except (FileNotFoundError, ValueError):
+            checks = {}
+        checks[self.URL] = {"checked": time.time(), "bulk": self.bulk}
+        settings.SCHEME_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(settings.SCHEME_FILE, "w") as file:
+            json.dump(checks, file)
+
     def _test_scheme(self):
         """
         Tests the internal item scheme against the server's (also checking if it's up).
-        Doesn't chech types.
+        Doesn't chech types. Skipped if it was checked less than SCHEME_TTL seconds ago.
         """
+        check = self._last_scheme_check()
+        if check:
+            self.bulk = check["bulk"]
+            self.logger.info("Item scheme checked recently. Skipping.")
+            return
         try:
             res = self.get(self.DOCS_URL)
         except (
@@ -125,7 +291,8 @@ class Client(requests.Session):
             return
         self.logger.info("Server up and running.")
         try:
-            scheme = res.json()["urls"]["/"]["scheme"]
+            urls = codec.loads(res.content)["urls"]
+            scheme = urls["/"]["scheme"]
         except KeyError as exc:
             msg = "The item scheme has been updated. Upgrade the client accordingly."
             self.logger.critical(msg)
@@ -136,6 +303,8 @@ class Client(requests.Session):
             set(self.SCHEME)
         )
         self.logger.info("Item scheme versions match.")
+        self.bulk = "/bulk" in urls
+        self._save_scheme_check()
 
 
     @loggedmethod
@@ -161,13 +330,66 @@ class Client(requests.Session):
 
         res = self.get(url)
 
-        return res.json()
+        return codec.loads(res.content)
 
     @loggedmethod
     def get_item(self, name):
-        """Get the details of a package"""
-        res = self.get(self.URL + name)
-        return res.json()
+        """
+        Get the details of a package.
+        Served from the metadata cache while it's fresh, revalidated with the server otherwise.
+        """
+        return self._get_item(name)
+
+    def _get_item(self, name):
+        entry = self.cache.load(name)
+        if entry and self.cache.fresh(entry):
+            return self.cache.hit(name, entry)
+
+        res = self.get(self.URL + name, headers=self.cache.validators(entry))
+        if entry and res.status_code == 304:
+            return self.cache.revalidated(name, entry)
+
+        self.cache.miss(name)
+        data = codec.loads(res.content)
+        self.cache.put(name, data, res.headers)
+        return data
+
+    @loggedmethod
+    def get_items(self, names: List[str], jobs: int = None) -> Dict[str, dict]:
+        """
+        Get the details of many packages at once (name -> details, in the order of `names`).
+        Fresh entries come from the cache. The rest are fetched with a single
+        request if the server has a bulk endpoint, or with up to `jobs`
+        concurrent requests otherwise.
+        """
+        items = {}
+        missing = []
+        for name in dict.fromkeys(names):
+            entry = self.cache.load(name)
+            if entry and self.cache.fresh(entry):
+                items[name] = self.cache.hit(name, entry)
+            else:
+                missing.append(name)
+        if self.bulk and len(missing) > 1:
+            res = self.post_json(self.BULK_URL, {"names": missing})
+            for data in codec.loads(res.content):
+                self.cache.miss(data["name"])
+                self.cache.put(data["name"], data)
+                items[data["name"]] = data
+            # whatever the server didn't send gets a proper error (or answer) below
+            missing = [name for name in missing if name not in items]
+
+        jobs = min(jobs or settings.JOBS, len(missing))
+        if jobs <= 1:
+            items.update((name, self._get_item(name)) for name in missing)
+        else:
+            self.mount_pools(jobs)
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                items.update(zip(missing, pool.map(self._get_item, missing)))
+        # in the order they were asked for, wherever they came from
+        ordered = {name: items[name] for name in dict.fromkeys(names) if name in items}
+        ordered.update(items)  # names the server spelled differently, last
+        return ordered
 
     @loggedmethod
     def create_item(self, data: dict):
@@ -175,8 +397,8 @@ class Client(requests.Session):
         for key in data.keys():
             assert key in self.SCHEME.keys(), key
 
-        res = self.post(self.URL, json=data)
-        return res.json()
+        res = self.post_json(self.endpoints.primary, data)
+        return codec.loads(res.content)
 
     @loggedmethod
     def update_item(self, data: dict, name: str):
@@ -187,6 +409,83 @@ class Client(requests.Session):
         """
         for key in data.keys():
             assert key in self.SCHEME.keys(), key
-        res = self.post(self.URL + name, json=data)
-        assert any(res.json()["tags"])
-        return res.json()
+        res = self.post_json(self.endpoints.primary + name, data)
+        self.cache.discard(name)
+        data = codec.loads(res.content)
+        assert any(data["tags"])
+        return data
+
+
+@logged
+class FileSession(requests.Session):
+    """
+    Session for the files of a single host. It has the same retries and circuit
+    breaker as the client but none of its credentials.
+    """
+
+    endpoints = None
+
+    def __init__(self, size: int, budget: retry.RetryBudget, breaker: retry.CircuitBreaker):
+        super().__init__()
+        self.budget = budget
+        self.breaker = breaker
+        self.pool_size = 0
+        self.mount_pools(size)
+
+    @check_errors
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", settings.TIMEOUT)
+        return super().request(*args, **kwargs)
+
+    def mount_pools(self, size: int):
+        """Room for `size` connections to the host. Pools are never shrunk"""
+        if size <= self.pool_size:
+            return
+        self.pool_size = size
+        # a single host, so a single pool
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+
+class Files:
+    """
+    Fetches the files of the packages (catbox, imgur...) with a session per host,
+    so they neither take the connections of the API nor see its credentials.
+    Connections are kept alive and reused across packages.
+    Safe to share between the transfer workers.
+    """
+
+    def __init__(self, size: int = None):
+        self.size = size or settings.JOBS
+        self.budget = retry.RetryBudget()
+        self.breaker = retry.CircuitBreaker()
+        self._sessions: Dict[str, FileSession] = {}
+        self._lock = threading.Lock()
+        atexit.register(METRICS.save)
+
+    def session(self, url: str) -> FileSession:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._sessions:
+                self._sessions[host] = FileSession(self.size, self.budget, self.breaker)
+            return self._sessions[host]
+
+    def mount_pools(self, size: int):
+        """Size the pool of every host for `size` workers"""
+        with self._lock:
+            self.size = max(self.size, size)
+            for session in self._sessions.values():
+                session.mount_pools(self.size)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.session(url).get(url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        return self.session(url).head(url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
@@ -0,0 +1,75 @@
+"""
+JSON codec. Uses orjson when it's installed and the standard library otherwise.
+Works on bytes (UTF-8, compact) so responses and files don't go through str first.
+"""
+import json
+
+from cpm import settings
+
+try:
+    import orjson
+except ImportError:  # optional
+    orjson = None
+
+
+class Json:
+    """The standard library, tuned to produce the same output as orjson"""
+
+    name = "json"
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+    @staticmethod
+    def dumps(obj, sort_keys: bool = False) -> bytes:
+        return json.dumps(
+            obj, sort_keys=sort_keys, ensure_ascii=False, separators=(",", ":")
+        ).encode("utf-8")
+
+
+class Orjson:
+    """
+    orjson. What it refuses (NaN, integers over 64 bits...) goes through
+    the standard library instead, so both backends accept the same documents.
+    """
+
+    name = "orjson"
+
+    @staticmethod
+    def loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(data)
+
+    @staticmethod
+    def dumps(obj, sort_keys: bool = False) -> bytes:
+        option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(obj, option=option)
+        except TypeError:
+            return Json.dumps(obj, sort_keys)
+
+
+BACKENDS = {"json": Json}
+if orjson is not None:
+    BACKENDS["orjson"] = Orjson
+
+
+def use(name: str = None):
+    """Switch the backend. The fastest one installed by default"""
+    global BACKEND, loads, dumps  # pylint: disable=W0603
+    if name is None:
+        name = "orjson" if "orjson" in BACKENDS else "json"
+    if name not in BACKENDS:
+        raise ValueError(f"The {name} JSON backend is not installed")
+    BACKEND = BACKENDS[name].name
+    loads = BACKENDS[name].loads
+    dumps = BACKENDS[name].dumps
+
+
+BACKEND = loads = dumps = None
+use(settings.JSON_BACKEND)
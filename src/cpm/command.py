@@ -2,30 +2,42 @@
 CLI commands go here.
 """
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import os
-import json
-import zipfile
-
-import yaml
-
-from cpm.client import Client
-from cpm.logging import get_logger
-from cpm import settings
+import sys
+import time
+
+from cpm.catalog import Catalog
+from cpm.lazy import Lazy, lazy_import
+from cpm.lock import Lockfile, LockError
+from cpm.store import BlobStore
+from cpm.logging import format_record, get_logger
+from cpm.logging import matches as log_matches, parse as parse_log
+from cpm import codec, compiler, metrics, resolver, settings, transfer
+
+# only the commands that need them pay for these
+yaml = lazy_import("yaml")
+zipfile = lazy_import("zipfile")
+server = lazy_import("cpm.server")
 
 logger = get_logger("audit.command")
 logger_user = get_logger("user_info.command")
 logger_err = get_logger("error.command")
 
-client = Client()
+client = Lazy(lambda: lazy_import("cpm.client").Client())
+files = Lazy(lambda: lazy_import("cpm.client").Files())
+store = BlobStore()
+fragments = compiler.FragmentCache()
+meter = transfer.Meter()
 
 
-def _compile(template: dict, packages: dict):
-    compiled = template
-    for lore in packages.values():
-        lore = json.loads(lore)
-        compiled["entries"].extend(lore["entries"])
-        compiled["categories"].extend(lore["categories"])
-    return compiled
+def _configure_cache(args):
+    """Apply the cache switches of the command line"""
+    client.cache.enabled = not getattr(args, "no_cache", False)
+    client.cache.refresh = getattr(args, "refresh", False)
+    store.enabled = client.cache.enabled and not client.cache.refresh
+    fragments.enabled = store.enabled
 
 
 def _display(data):
@@ -45,60 +57,159 @@ def _display(data):
     )
 
 
-def _dump_file(url, filename):
+def _dump_file(url, version=None):
     """
-    Dump a file specified on a package metadata to the filesystem.
-    In case of failure, warn and exit.
+    Stream a file specified on a package metadata into the local store
+    (resuming interrupted downloads). Files already in the store aren't downloaded again.
+    In case of failure, warn and return None.
+    Safe to call from the transfer workers.
+    `version` (the date_updated of the package) tells apart files re-uploaded to the same url.
+
+    Returns the path of the file in the store.
     """
     if not url or not url.startswith("http"):
         logger.warning("%s is not a valid url", url)
         return None
-    try:
-        res = client.get(url)
-    except Exception as exc:
-        logger_err.error(exc)
-        return None
-    if not res.ok:
-        return None
-
-    with open(filename, "w+b") as file:
-        file.write(res.content)
-    return res.content  # res.text is too slow and json.load accepts bytes
+    with store.lock(url):
+        blob = store.lookup(url, version)
+        if blob is None:
+            part = store.partial(url)
+            try:
+                digest = transfer.download(files, url, part, meter)
+            except Exception as exc:
+                logger_err.error(exc)
+                return None
+            if digest is None:
+                return None
+            blob = store.commit(url, part, digest, version)
+        else:
+            logger.info("%s found in the local store", url)
+    return blob
 
 
-def _download(name, packages=None):
-    """Low level implementation of download."""
+def _fetch_package(name, data, expected=None):
+    """
+    Fetch the files of a single package and zip them straight from the store.
+    Runs on the transfer workers, so the archives of different packages
+    are built concurrently.
+    With `expected` digests (url -> sha256), files that don't match raise a LockError.
+    Returns the lorebook and the digests of the files.
+    """
     logger.info("Downloading the %s package.", name)
     logger_user.info("Downloading the %s package.", name)
 
-    packages = packages or {}
-    data = client.get_item(name)
-
     image_url = data["image"]
     file_url = data["file"]
     name = data["name"]
-    files = []
+    entries = []
+    digests = {}
+
+    def dump(url):
+        blob = _dump_file(url, data.get("date_updated"))
+        if blob:
+            digests[url] = store.digest(blob)
+        if expected is not None and digests.get(url) != expected.get(url):
+            raise LockError(f"{url} of {name} doesn't match the lockfile")
+        return blob
 
     if image_url:
-        image_name = name + "." + image_url.split(".")[-1]
-        if _dump_file(image_url, image_name):  # in case it gets deleted or bad url
-            files.append(image_name)
-    file_name = name + ".lorebook"
-    json_name = name + ".json"
-    files.extend((file_name, json_name))
-
-    with open(json_name, "w") as jfile:
-        json.dump(data, jfile)
-    packages[name] = _dump_file(file_url, file_name)
-
-    _package(files, name + ".zip")
-
-    for dep in data["deps"]:
-        if dep not in packages.keys() and dep != name:
-            packages.update(_download(dep, packages))
-        else:
-            logger.info("Found duplicate dependency %s. Ignoring...", dep)
-    return packages
+        image = dump(image_url)
+        if image:  # in case it gets deleted or bad url
+            entries.append((name + "." + image_url.split(".")[-1], image))
+    lore = dump(file_url)
+    if lore:
+        entries.append((name + ".lorebook", lore))
+    entries.append((name + ".json", codec.dumps(data)))
+
+    _package(entries, name + ".zip")
+    return lore, digests
+
+
+def _sync_package(name, data, lockfile=None, frozen=False):
+    """
+    Fetch a package unless the lockfile says its archive and files are already here.
+    Returns the lorebook.
+    """
+    archive = data["name"] + ".zip"
+    entry = lockfile.current(name, data, archive) if lockfile else None
+    if entry:
+        blobs = {url: store.get(digest) for url, digest in entry["digests"].items()}
+        if all(blobs.values()):
+            logger.info("%s is up to date", name)
+            return blobs.get(data["file"])
+    expected = lockfile.packages[name]["digests"] if frozen else None
+    lore, digests = _fetch_package(name, data, expected)
+    if lockfile and not frozen:
+        lockfile.record(name, data, digests, archive)
+    return lore
+
+
+def _largest_first(metadata, jobs=1):
+    """
+    Names of the packages in `metadata`, the ones with the most to download first,
+    so a big file starts early instead of holding up the end of the download.
+    The sizes are asked to the server (HEAD) for the files that aren't in the store
+    and count in the total of the progress report.
+    """
+    urls = {
+        name: [url for url in (data["image"], data["file"]) if url and url.startswith("http")]
+        for name, data in metadata.items()
+    }
+    missing = [
+        url
+        for name, found in urls.items()
+        for url in found
+        if store.lookup(url, metadata[name].get("date_updated")) is None
+    ]
+    with ThreadPoolExecutor(max_workers=max(min(jobs, len(missing)), 1)) as pool:
+        sizes = dict(zip(missing, pool.map(lambda url: transfer.probe(files, url), missing)))
+    for url, size in sizes.items():
+        meter.expect(url, size)
+    size = lambda name: sum(sizes.get(url) or 0 for url in urls[name])
+    return sorted(metadata, key=size, reverse=True)
+
+
+def _graph(jobs=1):
+    """An empty dependency graph that asks the server for the metadata of each level"""
+    return resolver.Graph(lambda level: client.get_items(level, jobs))
+
+
+def _download(names, jobs=1, lockfile=None):
+    """
+    Low level implementation of download.
+    The metadata of each level of the dependency graph is fetched in one wave
+    and the files are downloaded concurrently while the next level is resolved.
+    Packages shared by several roots are resolved and fetched once.
+    Packages that match the lockfile aren't fetched again.
+    Returns the lorebooks in the order a depth-first walk of the graph would find them.
+    """
+    graph = _graph(jobs)
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        futures = {}
+
+        def fetch(level):
+            for name in _largest_first(level, jobs):
+                futures[name] = pool.submit(_sync_package, name, level[name], lockfile)
+
+        graph.resolve(names, fetch)
+        lorebooks = {name: future.result() for name, future in futures.items()}
+
+    _, cycles = graph.plan(names)
+    for cycle in cycles:
+        logger_user.warning("Dependency cycle: %s", " -> ".join(cycle))
+    # keyed by the names the packages were asked for, like the lockfile
+    return {name: lorebooks[name] for name in graph.preorder(names)}
+
+
+def _download_frozen(names, lockfile, jobs=1):
+    """Download exactly the locked packages, without asking the server for metadata"""
+    metadata = lockfile.resolve(names)
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        futures = {
+            name: pool.submit(_sync_package, name, metadata[name], lockfile, True)
+            for name in _largest_first(metadata, jobs)
+        }
+        return {name: futures[name].result() for name in metadata}
 
 
 def _get_data(file):
@@ -116,10 +227,14 @@ def _get_data(file):
             "file": input("file url: ").strip(),
             "service": input("service: ").strip(),
         }
-    if "tags" in data and data["tags"]:
-        data["tags"] = [tag.strip() for tag in data["tags"].split(",")]
-    if "deps" in data and data["deps"]:
-        data["deps"] = [dep.strip() for dep in data["deps"].split(",")]
+    return _sanitize(data)
+
+
+def _sanitize(data):
+    """Split comma separated tags and dependencies and drop empty values"""
+    for key in ("tags", "deps"):
+        if key in data and isinstance(data[key], str) and data[key]:
+            data[key] = [value.strip() for value in data[key].split(",")]
 
     logger.debug("%d keys before purging empty values", len(data.keys()))
     for key, val in data.copy().items():
@@ -130,62 +245,250 @@ def _get_data(file):
     return data
 
 
-def _package(files, filename):
-    """Compress files, delete them afterwards"""
-    logger.info("Zipping %s into a package", files)
-    logger_user.info("Zipping %s into a package", files)
-    with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as zfile:
-        for name in files:
-            zfile.write(name)
-            os.remove(name)
+def _documents(path):
+    """
+    (label, data) for every YAML document in a file, every .yaml/.yml file
+    of a directory or stdin (-). Files can have many documents (--- separated).
+    """
+    if path == "-":
+        sources = [("<stdin>", sys.stdin)]
+    elif os.path.isdir(path):
+        sources = [
+            (os.path.join(path, name), None)
+            for name in sorted(os.listdir(path))
+            if name.endswith((".yaml", ".yml"))
+        ]
+    else:
+        sources = [(path, None)]
+
+    documents = []
+    for label, stream in sources:
+        if stream is None:
+            with open(label) as yfile:
+                found = [data for data in yaml.safe_load_all(yfile) if data is not None]
+        else:
+            found = [data for data in yaml.safe_load_all(stream) if data is not None]
+        for index, data in enumerate(found):
+            documents.append((label if len(found) == 1 else f"{label}#{index + 1}", data))
+    return documents
+
+
+def _validate(documents):
+    """
+    Sanitize every document and check it against the item scheme before anything is sent.
+    Returns the documents by name and the list of errors.
+    """
+    items = {}
+    errors = []
+    for label, data in documents:
+        if not isinstance(data, dict):
+            errors.append(f"{label}: not a mapping")
+            continue
+        data = _sanitize(data)
+        for key, value in data.items():
+            if key not in settings.ITEM_SCHEME:
+                errors.append(f"{label}: unknown key {key}")
+            elif not isinstance(value, type(settings.ITEM_SCHEME[key])):
+                expected = type(settings.ITEM_SCHEME[key]).__name__
+                errors.append(f"{label}: {key} should be a {expected}")
+        name = data.get("name")
+        if not isinstance(name, str) or not name:
+            errors.append(f"{label}: the name is missing")
+        elif name in items:
+            errors.append(f"{label}: {name} is repeated")
+        else:
+            items[name] = data
+    return items, errors
+
+
+def _rejected(exc):
+    """The server refused the item itself (4xx), sending it again won't help"""
+    status = getattr(getattr(exc, "response", None), "status_code", None)
+    return isinstance(status, int) and 400 <= status < 500 and status != 429
+
+
+def _publish(items, send, jobs=1, retries=1):
+    """
+    Call `send(name, data)` for every item on up to `jobs` workers.
+    Items that failed are sent again, up to `retries` more times,
+    unless the server rejected them.
+    Returns name -> (attempts, response data or the exception).
+    """
+    results = {}
+    pending = list(items.items())
+    client.mount_pools(jobs)
+    for attempt in range(1, retries + 2):
+        with ThreadPoolExecutor(max_workers=max(min(jobs, len(pending)), 1)) as pool:
+            futures = [(name, data, pool.submit(send, name, data)) for name, data in pending]
+        failed = []
+        for name, data, future in futures:
+            try:
+                results[name] = (attempt, future.result())
+            except Exception as exc:
+                logger_err.error("%s: %s", name, exc)
+                results[name] = (attempt, exc)
+                if not _rejected(exc):
+                    failed.append((name, data))
+        if not failed or attempt > retries:
+            break
+        logger_user.info("Retrying %d failed packages...", len(failed))
+        pending = failed
+    return results
+
+
+def _summary(results):
+    """Print the result of every item. Exits with an error if any failed"""
+    failed = 0
+    for name, (attempts, res) in results.items():
+        tries = f" ({attempts} attempts)" if attempts > 1 else ""
+        if isinstance(res, Exception):
+            failed += 1
+            print(f"  FAILED  {name}{tries}: {res}")
+        else:
+            print(f"  OK      {name}{tries}")
+    logger_user.info("%d published, %d failed", len(results) - failed, failed)
+    if failed:
+        raise SystemExit(1)
+
+
+def _check(documents):
+    """The valid documents by name. If any is invalid, list the errors and send nothing"""
+    items, errors = _validate(documents)
+    if errors:
+        for error in errors:
+            logger_user.error(error)
+        logger_user.error("Nothing was sent. Fix the errors above and try again.")
+        raise SystemExit(1)
+    return items
+
+
+def _compression(name):
+    """Media is already compressed, deflating it again is wasted work"""
+    if name.lower().endswith(settings.ZIP_STORED):
+        return zipfile.ZIP_STORED, None
+    return zipfile.ZIP_DEFLATED, settings.ZIP_LEVEL
+
+
+def _package(entries, filename):
+    """
+    Write a package archive. `entries` are (name, source) pairs where
+    the source is a path (streamed into the archive) or bytes.
+    """
+    logger.info("Zipping %s into a package", [name for name, _ in entries])
+    logger_user.info("Zipping %s into a package", [name for name, _ in entries])
+    part = filename + ".part"
+    with zipfile.ZipFile(part, "w") as zfile:
+        for name, source in entries:
+            compress_type, level = _compression(name)
+            if isinstance(source, bytes):
+                zfile.writestr(name, source, compress_type, level)
+            else:
+                zfile.write(source, name, compress_type, level)
+    os.replace(part, filename)
+
+
+def _search_offline(args):
+    catalog = Catalog()
+    if not len(catalog):
+        logger_user.warning("The local catalog is empty. Run `cpm sync` first.")
+    tags = args.tags.split(",") if args.tags else None
+    for item in catalog.search(args.query, tags, args.name):
+        print(item["name"])
+    catalog.close()
 
-def _tail(name):
-    with open(name) as file:
-        eof = file.seek(0, 2) # end
-        file.seek(0)
-        if eof - 50*200 > 0: # ~ 200 entries 
-            file.seek(eof - 50*200)
-        return file.read()
+
+def _search_all(args, tags):
+    """Crawl every page of the results and stream them to stdout"""
+    fetch = lambda page: client.list_item(page, tags, args.name)
+    for data in transfer.pages(fetch, args.page, args.jobs):
+        for item in data:
+            line = codec.dumps(item).decode("utf-8") if args.json else item["name"]
+            print(line, flush=True)
 
 
 def search(args):
     """Search packages on the repository"""
-    page = args.page
+    if args.offline or args.query:
+        _search_offline(args)
+        return
     tags = args.tags.split(",") if args.tags else None
+    if args.all:
+        _search_all(args, tags)
+        return
     name = args.name
-    while True:
-        data = client.list_item(page, tags, name)
+    # the next page is fetched while the user reads this one
+    fetch = lambda page: client.list_item(page, tags, name)
+    for data in transfer.pages(fetch, args.page, jobs=2):
         for item in data:
             print(item["name"])
-        if len(data) < 10:
+        if len(data) < settings.PAGE_SIZE:
             break
         print("======================================")
         try:
             input("Press enter to see the next page...")
         except KeyboardInterrupt:
             break
-        page +=1
+
+
+def sync(args):
+    """Mirror the catalog metadata into the local index used by `search --offline`"""
+    catalog = Catalog()
+    written, removed = catalog.sync(client, args.jobs)
+    logger_user.info(
+        "%d packages in the local catalog (%d updated, %d removed)",
+        len(catalog),
+        written,
+        removed,
+    )
+    catalog.close()
 
 
 def info(args):
-    """Display information about a package"""
-    data = client.get_item(args.name)
-    _display(data)
+    """Display information about one or more packages"""
+    _configure_cache(args)
+    names = [_.strip() for _ in args.name.split(",")]
+    for data in client.get_items(names).values():
+        _display(data)
 
 
 def upload(args):
-    """Upload metadata about a package to the repository"""
-    data = {}
-    file = args.file
+    """Upload metadata about one or more packages to the repository"""
+    if not args.dir and not args.file:
+        _display(client.create_item(_get_data(None)))
+        return
+
+    items = _check(_documents(args.dir or args.file))
+    results = _publish(
+        items, lambda name, data: client.create_item(data), args.jobs, args.retries
+    )
+    if len(results) == 1 and not args.dir:
+        ((_, res),) = results.values()
+        if not isinstance(res, Exception):
+            _display(res)
+            return
+    _summary(results)
 
-    data = _get_data(file)
-    res = client.create_item(data)
 
-    _display(res)
+def _update_item(name, data, current=None):
+    current = dict(current or client.get_item(name))
+    current.update(data)
+    current.pop("id", None)
+    return client.update_item(current, name)
 
 
 def update(args):
-    """Update the metadata of a package"""
+    """
+    Update the metadata of a package. Without a name, update every package
+    in the --dir or --file (YAML documents with the name of the package)
+    """
+    _configure_cache(args)
+    client.cache.refresh = True  # never edit stale metadata
+    if args.dir or not args.name:
+        if not args.dir and not args.file:
+            logger_user.error("Give the name of the package, a --file or a --dir")
+            raise SystemExit(1)
+        _update_many(args)
+        return
     data = client.get_item(args.name)
     file = args.file
 
@@ -196,26 +499,180 @@ def update(args):
     _display(res)
 
 
+def _update_many(args):
+    items = _check(_documents(args.dir or args.file))
+    try:
+        # a single request if the server has the bulk endpoint
+        current = client.get_items(list(items), args.jobs)
+    except Exception as exc:  # fetched one by one below, with proper errors
+        logger.info("Couldn't fetch the packages at once: %s", exc)
+        current = {}
+    results = _publish(
+        items,
+        lambda name, data: _update_item(name, data, current.get(name)),
+        args.jobs,
+        args.retries,
+    )
+    _summary(results)
+
+
+def mirror(args):
+    """Copy the catalog and every file it references into a local mirror (see serve)"""
+    client.mount_pools(args.jobs)
+    meter.reset(args.limit_rate)
+    local = server.Mirror(args.dir)
+    files.mount_pools(args.jobs)
+    written, fetched, failed = local.sync(client, files, args.jobs, meter)
+    meter.report(final=True)
+    logger_user.info(
+        "Mirror at %s: %d packages updated, %d files downloaded", local.path, written, fetched
+    )
+    if failed:
+        logger_user.warning(
+            "%d files couldn't be downloaded. Run `cpm mirror` again to retry.", failed
+        )
+
+
+def serve(args):
+    """Serve a mirror made with `cpm mirror` with the same API as the repository"""
+    local = server.Mirror(args.dir)
+    if not local.catalog_file.exists():
+        logger_user.warning("The mirror at %s is empty. Run `cpm mirror` first.", local.path)
+    httpd = server.serve(local, args.host, args.port, args.url)
+    host, port = httpd.server_address[:2]
+    logger_user.info("Serving %s on http://%s:%d/ (Ctrl+C to stop)", local.path, host, port)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
 def compile(args):
     """Download all packages and compile them into a single file"""
     file = args.file
     packages = download(args)
-    first = args.name.split(",")[0]
+    first = args.name.split(",")[0].strip()
 
-    template = json.loads(packages[first])
-    compiled = _compile(template, packages)
+    # the header comes from the first package, the entries and categories from everyone
+    template = packages[first]
+    try:
+        compiler.compile_file(
+            template, packages.values(), file, fragments, args.conflicts, args.workers
+        )
+    except compiler.CompileError as exc:
+        logger_err.error(exc)
+        logger_user.error("Couldn't compile the packages. %s", exc)
+        raise
+    fragments.gc()
+    return file
+
+
+def stats(args):
+    """Summarize the latency, bytes and errors of past requests by endpoint and host"""
+    if args.reset:
+        try:
+            os.remove(settings.METRICS_FILE)
+        except FileNotFoundError:
+            pass
+        logger_user.info("Metrics cleared.")
+        return
+    data = metrics.load()
+    if not data:
+        logger_user.info("No requests recorded yet.")
+        return
+    for line in metrics.summary(data):
+        print(line)
+
+
+def _follow(file, args):
+    """Print the records appended to the log until interrupted"""
+    show = False
+    line = ""
+    while True:
+        line += file.readline()
+        if not line.endswith("\n"):
+            try:
+                rotated = os.stat(file.name).st_size < file.tell()
+            except FileNotFoundError:
+                rotated = False
+            if rotated:
+                file.close()
+                file = open(file.name, encoding="utf-8", errors="replace")
+            time.sleep(settings.FOLLOW_INTERVAL)
+            continue
+        records = list(parse_log([line]))
+        if records:  # continuation lines (tracebacks) go with the previous record
+            show = log_matches(records[0], args.level, args.logger)
+            if show:
+                print(format_record(records[0]), flush=True)
+        elif show:
+            print(line, end="", flush=True)
+        line = ""
 
-    with open(file, "w") as jfile:
-        json.dump(compiled, jfile)
-    return compiled
 
 def debug(args):
-    print()
-    print("### BEGIN DEBUG LOGS ###")
-    print(_tail(settings.LOG_FILE))
-    print("### END DEBUG LOGS ###")
-    print(f"Log file: {settings.LOG_FILE}")
-    print()
+    """Show the last records of the log. Filter them by level or logger and follow the log"""
+    try:
+        file = open(settings.LOG_FILE, encoding="utf-8", errors="replace")
+    except FileNotFoundError:
+        logger_user.info("Nothing has been logged yet.")
+        return
+    with file:
+        records = deque(
+            (
+                record
+                for record in parse_log(file)
+                if log_matches(record, args.level, args.logger)
+            ),
+            maxlen=args.lines,
+        )
+        print()
+        print("### BEGIN DEBUG LOGS ###")
+        for record in records:
+            print(format_record(record))
+        if not args.follow:
+            print("### END DEBUG LOGS ###")
+            print(f"Log file: {settings.LOG_FILE}")
+            print()
+            return
+        try:
+            _follow(file, args)
+        except KeyboardInterrupt:
+            pass
+
+
+def deps(args):
+    """Show the dependencies of one or more packages without downloading them"""
+    names = list(dict.fromkeys(_.strip() for _ in args.name.split(",")))
+    _configure_cache(args)
+    client.mount_pools(args.jobs)
+    graph = _graph(args.jobs).resolve(names)
+    order, cycles = graph.plan(names)
+
+    if args.json:
+        plan = {
+            "roots": names,
+            "plan": order,
+            "cycles": cycles,
+            "packages": {name: graph.metadata[name] for name in order},
+        }
+        print(codec.dumps(plan).decode("utf-8"))
+    elif args.tree:
+        for name in names:
+            for line in graph.tree(name):
+                print(line)
+    else:
+        for index, name in enumerate(order, 1):
+            print(f"{index:>4}. {name}")
+
+    for cycle in cycles:
+        logger_user.warning("Dependency cycle: %s", " -> ".join(cycle))
+    file_count = sum(
+        bool(graph.metadata[name].get(key)) for name in order for key in ("file", "image")
+    )
+    logger_user.info("%d packages, %d files to download", len(order), file_count)
 
 
 def download(args):
@@ -223,11 +680,25 @@ def download(args):
     Download one or more packages from the repository. Resolving dependencies and zipping
     all files.
     """
-    names = [_.strip() for _ in args.name.split(",")]
-    packages = {}
-    for name in names:
-        if name not in packages.keys():
-            packages = _download(name, packages)
-        else:
-            logger.info("Found duplicate package %s. Ignoring...", name)
+    names = list(dict.fromkeys(_.strip() for _ in args.name.split(",")))
+    _configure_cache(args)
+    meter.reset(getattr(args, "limit_rate", None))
+    files.mount_pools(args.jobs)
+    lockfile = Lockfile()
+    locked = lockfile.load()
+    if args.frozen:
+        try:
+            if not locked:
+                raise LockError(f"There is no lockfile ({lockfile.path}) to reproduce")
+            packages = _download_frozen(names, lockfile, args.jobs)
+        except LockError as exc:
+            logger_err.error(exc)
+            logger_user.error("Couldn't download the locked packages. %s", exc)
+            raise
+    else:
+        client.mount_pools(args.jobs)
+        packages = _download(names, args.jobs, lockfile)
+        lockfile.save(names, packages)
+    meter.report(final=True)
+    store.gc()  # what this command uses is kept
     return packages
@@ -0,0 +1,603 @@
+"""
+Streaming lorebook compiler.
+Each lorebook is parsed once into a fragment (its entries and categories already
+serialized) that is cached by content hash, compiling copies fragments into the
+output. Only one item at a time is kept in memory no matter how big the compile is.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import hashlib
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import re
+import shutil
+import tempfile
+from typing import BinaryIO, Dict, Iterable, Iterator, TextIO, Tuple
+
+from cpm.logging import get_logger
+from cpm import codec, disk, settings
+
+logger = get_logger("audit.compiler")
+logger_user = get_logger("user_info.compiler")
+
+STREAMED = ("entries", "categories")
+POLICIES = ("first", "last", "report")
+SEPARATOR = b","  # between the items of an array
+
+_WHITESPACE = re.compile(r"\s*")
+_STRUCTURE = re.compile(r'["{}\[\]]')
+_STRING = re.compile(r'["\\]')
+_SCALAR_END = re.compile(r"[\s,\]}]")
+
+
+class CompileError(ValueError):
+    """Malformed lorebook. The message points to the exact location (file:line:column)"""
+
+
+class LorebookReader:
+    """
+    Incremental reader for a lorebook (a JSON object).
+    `members` yields the top-level keys one by one, the big arrays
+    are yielded as iterators so their items can be consumed one at a time.
+    """
+
+    def __init__(self, file: TextIO, name: str = "<lorebook>"):
+        self.file = file
+        self.name = name
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.lines = 0  # newlines in the part of the file that was already discarded
+        self.column = 0  # characters after the last discarded newline
+        self._decode = True
+
+    def error(self, message: str, pos: int = None) -> CompileError:
+        pos = self.pos if pos is None else pos
+        before = self.buf[:pos]
+        newlines = before.count("\n")
+        line = self.lines + newlines + 1
+        if newlines:
+            column = pos - before.rfind("\n")
+        else:
+            column = self.column + pos + 1
+        return CompileError(f"{self.name}:{line}:{column}: {message}")
+
+    def _fill(self) -> bool:
+        """Read more of the file. False at EOF"""
+        if self.eof:
+            return False
+        # grow geometrically so huge values aren't rescanned over and over
+        chunk = self.file.read(max(settings.CHUNK_SIZE, len(self.buf) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf += chunk
+        return True
+
+    def _compact(self):
+        """Discard what was already consumed"""
+        if self.pos < settings.CHUNK_SIZE:
+            return
+        dropped = self.buf[: self.pos]
+        newlines = dropped.count("\n")
+        if newlines:
+            self.lines += newlines
+            self.column = len(dropped) - dropped.rfind("\n") - 1
+        else:
+            self.column += len(dropped)
+        self.buf = self.buf[self.pos :]
+        self.pos = 0
+
+    def _peek(self) -> str:
+        """Next non-blank character, empty at EOF"""
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, chars: str) -> str:
+        char = self._peek()
+        if not char or char not in chars:
+            expected = " or ".join(repr(c) for c in chars)
+            got = repr(char) if char else "end of file"
+            raise self.error(f"expected {expected}, got {got}")
+        self.pos += 1
+        return char
+
+    def _end(self) -> int:
+        """Index right after the value that starts at the current position"""
+        char = self._peek()
+        if not char:
+            raise self.error("expected a value, got end of file")
+        if char not in '"{[':
+            while True:
+                match = _SCALAR_END.search(self.buf, self.pos)
+                if match:
+                    return match.start()
+                if not self._fill():
+                    return len(self.buf)
+
+        index = self.pos
+        depth = 0
+        in_string = False
+        while True:
+            match = (_STRING if in_string else _STRUCTURE).search(self.buf, index)
+            if match is None:
+                index = len(self.buf)
+                if not self._fill():
+                    raise self.error("unterminated value")
+                continue
+            index = match.end()
+            token = match.group()
+            if in_string:
+                if token == "\\":
+                    if index >= len(self.buf) and not self._fill():
+                        raise self.error("unterminated value")
+                    index += 1  # escaped character
+                    continue
+                in_string = False
+            elif token == '"':
+                in_string = True
+            elif token in "{[":
+                depth += 1
+            else:
+                depth -= 1
+            if depth <= 0 and not in_string:
+                return index
+
+    def _value(self):
+        end = self._end()
+        start = self.pos
+        self.pos = end
+        if not self._decode:
+            return None
+        try:
+            return codec.loads(self.buf[start:end])
+        except json.JSONDecodeError as exc:
+            raise self.error(exc.msg, start + exc.pos) from exc
+
+    def _items(self) -> Iterator:
+        self._expect("[")
+        if self._peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            self._compact()
+            yield self._value()
+            if self._expect(",]") == "]":
+                return
+
+    def members(self, lazy: Iterable[str] = STREAMED) -> Iterator[Tuple[str, object]]:
+        """
+        Yield (key, value) for the top-level members of the lorebook.
+        The values of `lazy` keys are iterators over the items of the array,
+        whatever isn't consumed is skipped without decoding it.
+        """
+        self._expect("{")
+        if self._peek() == "}":
+            self.pos += 1
+        else:
+            while True:
+                if self._peek() != '"':
+                    raise self.error("expected a key")
+                key = self._value()
+                self._expect(":")
+                if key in lazy:
+                    items = self._items()
+                    yield key, items
+                    self._decode = False
+                    for _ in items:
+                        pass
+                    self._decode = True
+                else:
+                    yield key, self._value()
+                if self._expect(",}") == "}":
+                    break
+        if self._peek():
+            raise self.error("unexpected data after the lorebook")
+
+
+def _read(path, lazy: Iterable[str] = STREAMED) -> Iterator[Tuple[str, object]]:
+    with open(path, encoding="utf-8") as file:
+        yield from LorebookReader(file, str(path)).members(lazy)
+
+
+def _hash(data) -> str:
+    return hashlib.blake2b(codec.dumps(data, sort_keys=True), digest_size=16).hexdigest()
+
+
+def _index(key: str, item, start: int, length: int) -> list:
+    """
+    [content, identity, reference, start, length] of an item.
+    The content hash ignores the "id" so copies of an item uploaded twice match.
+    Entries are identified by their set of keys and reference their category,
+    categories are identified by name and referenced by id.
+    """
+    identity = reference = None
+    content = item
+    if isinstance(item, dict):
+        content = {field: value for field, value in item.items() if field != "id"}
+        if key == "entries":
+            if item.get("keys"):
+                identity = _hash(sorted(set(map(str, item["keys"]))))
+            reference = item.get("category")
+        else:
+            identity = item.get("name")
+            reference = item.get("id")
+    return [_hash(content), identity, reference, start, length]
+
+
+class FragmentCache:
+    """
+    Parsed lorebooks, keyed by the sha256 of their content, so a compile only
+    parses the lorebooks that changed since the last one.
+    A fragment is a header line
+        {"version": 3, "codec": backend, "members": [[key, value (null for the arrays)], ...],
+         "arrays": {key: [count, offset, length]},
+         "items": {key: [[content, identity, reference, start, length], ...]}}
+    followed by the items of each array serialized as they go in the output.
+    Fragments are always written, `enabled` only controls whether they are reused.
+    The least recently used ones are removed once the cache is over `max_bytes`.
+    """
+
+    VERSION = 3
+
+    def __init__(self, path: Path = None, max_bytes: int = None):
+        self.path = Path(path or settings.FRAGMENT_DIR)
+        self.max_bytes = max_bytes or settings.FRAGMENT_MAX_BYTES
+        self.enabled = True
+        self.stats = {"hits": 0, "misses": 0}
+
+    def _fragment(self, digest: str) -> Path:
+        return self.path / digest[:2] / digest
+
+    def get(self, source) -> Tuple[Path, dict]:
+        """
+        The fragment of the lorebook at `source` and its header, parsing it if needed.
+        `header["start"]` is where the items begin in the fragment.
+        """
+        digest = disk.file_digest(source)
+        if digest and self.enabled:
+            fragment = self._fragment(digest)
+            try:
+                with open(fragment, "rb") as file:
+                    header = codec.loads(file.readline())
+                    header["start"] = file.tell()
+                current = (header.get("version"), header.get("codec"))
+                if current == (self.VERSION, codec.BACKEND):
+                    os.utime(fragment)  # LRU
+                    self.stats["hits"] += 1
+                    return fragment, header
+            except (FileNotFoundError, ValueError):
+                pass
+        self.stats["misses"] += 1
+        fragment = self._fragment(digest or "unknown")
+        return fragment, self._build(source, fragment)
+
+    def _build(self, source, fragment: Path) -> dict:
+        members = []
+        arrays = {}
+        items = {key: [] for key in STREAMED}
+        self.path.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=self.path) as tmp:
+            files = {key: open(Path(tmp) / key, "w+b") for key in STREAMED}
+            try:
+                sizes = dict.fromkeys(STREAMED, 0)
+                for key, value in _read(source):
+                    if key not in STREAMED:
+                        members.append((key, value))
+                        continue
+                    members.append((key, None))
+                    for item in value:
+                        if items[key]:
+                            files[key].write(SEPARATOR)
+                            sizes[key] += len(SEPARATOR)
+                        text = codec.dumps(item)
+                        files[key].write(text)
+                        items[key].append(_index(key, item, sizes[key], len(text)))
+                        sizes[key] += len(text)
+
+                offset = 0
+                for key in STREAMED:
+                    arrays[key] = [len(items[key]), offset, sizes[key]]
+                    offset += sizes[key]
+                header = {
+                    "version": self.VERSION,
+                    "codec": codec.BACKEND,
+                    "members": members,
+                    "arrays": arrays,
+                    "items": items,
+                }
+
+                fragment.parent.mkdir(parents=True, exist_ok=True)
+                part = Path(tmp) / "fragment"
+                line = codec.dumps(header) + b"\n"
+                with open(part, "wb") as out:
+                    out.write(line)
+                    for key in STREAMED:
+                        files[key].seek(0)
+                        shutil.copyfileobj(files[key], out, settings.CHUNK_SIZE)
+            finally:
+                for file in files.values():
+                    file.close()
+            os.replace(part, fragment)
+        header["start"] = len(line)
+        return header
+
+    def gc(self):
+        """Remove the least recently used fragments until the cache fits in `max_bytes`"""
+        disk.evict(self.path.glob("??/*"), self.max_bytes)
+
+
+def _get(path: Path, enabled: bool, backend: str, source) -> Tuple[Path, dict, dict]:
+    """FragmentCache.get in a worker process. Returns the fragment, its header and the stats"""
+    codec.use(backend)
+    cache = FragmentCache(path)
+    cache.enabled = enabled
+    fragment, header = cache.get(source)
+    return fragment, header, cache.stats
+
+
+def _get_all(
+    cache: FragmentCache, sources: list, workers: int
+) -> Dict[object, Tuple[Path, dict]]:
+    """
+    The fragments of `sources`. With more than one worker, the lorebooks are
+    hashed and parsed in that many processes. Either way the result is the same.
+    """
+    if workers <= 1 or len(sources) <= 1:
+        return {source: cache.get(source) for source in sources}
+    fragments = {}
+    get = partial(_get, cache.path, cache.enabled, codec.BACKEND)
+    # cpm runs threads (logging, transfers...) and forking a threaded process can deadlock
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(workers, len(sources)), mp_context=context) as pool:
+        for source, (fragment, header, stats) in zip(sources, pool.map(get, sources)):
+            fragments[source] = fragment, header
+            for key, value in stats.items():
+                cache.stats[key] += value
+    return fragments
+
+
+def _read_item(fragment: Path, start: int, length: int):
+    with open(fragment, "rb") as file:
+        file.seek(start)
+        return codec.loads(file.read(length))
+
+
+class Merger:
+    """
+    Dedupes and merges the items of the fragments in one pass with hash indexes:
+    entries by content and by key set, categories by content and by name.
+    Exact copies are dropped. Categories that share a name are merged field by field
+    (the first one keeps its id and the entries of the others are moved to it).
+    Entries of different lorebooks with the same keys but different content and
+    categories with different values for a field are conflicts, resolved by `policy`:
+        first: the first one wins
+        last: the last one wins (in the position of the first)
+        report: nothing is compiled, the conflicts are listed in a CompileError
+    """
+
+    def __init__(self, policy: str = None):
+        self.policy = policy or settings.CONFLICT_POLICY
+        if self.policy not in POLICIES:
+            raise ValueError(f"Unknown conflict policy {self.policy}")
+        self.conflicts = []
+        self.duplicates = 0
+        self.remap = {}  # category id -> id of the category it was merged into
+
+    def _conflict(self, message: str):
+        if self.policy == "report":
+            self.conflicts.append(message)
+        else:
+            logger.warning("Conflict (%s wins): %s", self.policy, message)
+            logger_user.warning("Conflict (%s wins): %s", self.policy, message)
+
+    def categories(self, fragments: Iterable[Tuple[object, Path, dict]]) -> list:
+        """Plan of the categories: copies (fragment, start, length, None) and merged dicts"""
+        plan = []
+        ids = []
+        by_content = {}
+        by_name = {}
+        for source, fragment, header in fragments:
+            offset = header["start"] + header["arrays"]["categories"][1]
+            for content, name, ref, start, length in header["items"]["categories"]:
+                slot = by_content.get(content)
+                duplicate = slot is not None
+                if slot is None and name is not None:
+                    slot = by_name.get(name)
+                if slot is None:
+                    by_content[content] = len(plan)
+                    if name is not None:
+                        by_name[name] = len(plan)
+                    plan.append((fragment, offset + start, length, None))
+                    ids.append(ref)
+                    continue
+                if ref is not None and ref != ids[slot]:
+                    self.remap[ref] = ids[slot]
+                if duplicate:
+                    self.duplicates += 1
+                    continue
+                by_content[content] = slot
+                kept = plan[slot]
+                if isinstance(kept, tuple):
+                    kept = _read_item(*kept[:3])
+                item = _read_item(fragment, offset + start, length)
+                for field, value in item.items():
+                    if field == "id":
+                        continue
+                    if field not in kept:
+                        kept[field] = value
+                    elif kept[field] != value:
+                        self._conflict(f"category {name!r} has a different {field} in {source}")
+                        if self.policy == "last":
+                            kept[field] = value
+                plan[slot] = kept
+        return plan
+
+    def entries(self, fragments: Iterable[Tuple[object, Path, dict]]) -> list:
+        """Plan of the entries: copies (fragment, start, length, category)"""
+        plan = []
+        by_content = {}
+        by_keys = {}  # keys -> (slot, source)
+        for source, fragment, header in fragments:
+            offset = header["start"] + header["arrays"]["entries"][1]
+            for content, keys, ref, start, length in header["items"]["entries"]:
+                if content in by_content:
+                    self.duplicates += 1
+                    continue
+                slot, first = by_keys.get(keys, (None, None))
+                # entries of the same lorebook sharing their keys were written that way
+                if slot is None or first == source:
+                    by_content[content] = len(plan)
+                    if keys is not None:
+                        by_keys.setdefault(keys, (len(plan), source))
+                    plan.append((fragment, offset + start, length, ref))
+                    continue
+                by_content[content] = slot
+                item = _read_item(fragment, offset + start, length)
+                self._conflict(f"entry with keys {item.get('keys')} is different in {source}")
+                if self.policy == "last":
+                    plan[slot] = (fragment, offset + start, length, ref)
+        return plan
+
+    def write(self, plan: list, out: BinaryIO) -> int:
+        """
+        Write the items of a plan, SEPARATOR separated. Runs of consecutive items
+        of a fragment are copied at once. Returns the number of items
+        """
+        segments = []
+        for item in plan:
+            if isinstance(item, dict):
+                segments.append(codec.dumps(item))
+                continue
+            fragment, start, length, ref = item
+            if ref is not None and ref in self.remap:
+                data = _read_item(fragment, start, length)
+                data["category"] = self.remap[ref]
+                segments.append(codec.dumps(data))
+                continue
+            last = segments[-1] if segments else None
+            if isinstance(last, list) and last[0] == fragment and last[2] + len(SEPARATOR) == start:
+                last[2] = start + length  # the separator is already in the fragment
+            else:
+                segments.append([fragment, start, start + length])
+
+        file = current = None
+        try:
+            for index, segment in enumerate(segments):
+                if index:
+                    out.write(SEPARATOR)
+                if isinstance(segment, bytes):
+                    out.write(segment)
+                    continue
+                fragment, start, end = segment
+                if fragment != current:
+                    if file is not None:
+                        file.close()
+                    file = open(fragment, "rb")
+                    current = fragment
+                file.seek(start)
+                while start < end:
+                    chunk = file.read(min(settings.CHUNK_SIZE, end - start))
+                    if not chunk:
+                        raise CompileError(f"{fragment}: truncated fragment")
+                    out.write(chunk)
+                    start += len(chunk)
+        finally:
+            if file is not None:
+                file.close()
+        return len(plan)
+
+
+def compile_lorebooks(
+    template,
+    sources: Iterable,
+    out: BinaryIO,
+    cache: FragmentCache = None,
+    policy: str = None,
+    workers: int = 1,
+) -> dict:
+    """
+    Write a lorebook with the header (everything but entries and categories)
+    of `template` and the entries and categories of every lorebook in `sources`,
+    deduped and merged (see Merger).
+    Lorebooks are parsed once (or not at all if `cache` has them), by `workers`
+    processes, and the fragments are copied into the output.
+
+    Returns the number of items written for each array.
+    """
+    if cache is None:
+        with tempfile.TemporaryDirectory() as tmp:
+            return compile_lorebooks(
+                template, sources, out, FragmentCache(tmp), policy, workers
+            )
+
+    merger = Merger(policy)
+    sources = [source for source in sources if source]
+    before = dict(cache.stats)
+    fragments = _get_all(cache, list(dict.fromkeys([template, *sources])), workers)
+
+    ordered = [(source, *fragments[source]) for source in sources]
+    # the entries may have to be moved to merged categories
+    plans = {"categories": merger.categories(ordered)}
+    plans["entries"] = merger.entries(ordered)
+    if merger.conflicts:
+        raise CompileError(
+            f"{len(merger.conflicts)} conflicts:\n" + "\n".join(merger.conflicts)
+        )
+
+    order = list(fragments[template][1]["members"])
+    keys = [key for key, _ in order]
+    order.extend((key, None) for key in STREAMED if key not in keys)
+
+    counts = dict.fromkeys(STREAMED, 0)
+    out.write(b"{")
+    for index, (key, value) in enumerate(order):
+        if index:
+            out.write(b",")
+        out.write(codec.dumps(key) + b":")
+        if key not in STREAMED:
+            out.write(codec.dumps(value))
+            continue
+        out.write(b"[")
+        counts[key] = merger.write(plans[key], out)
+        out.write(b"]")
+    out.write(b"}")
+    logger.info(
+        "Parsed %d lorebooks, %d found in the cache. %d duplicates removed",
+        cache.stats["misses"] - before["misses"],
+        cache.stats["hits"] - before["hits"],
+        merger.duplicates,
+    )
+    return counts
+
+
+def compile_file(
+    template,
+    sources: Iterable,
+    filename,
+    cache: FragmentCache = None,
+    policy: str = None,
+    workers: int = 1,
+) -> dict:
+    """Compile into `filename`. Nothing is written if any of the lorebooks is malformed"""
+    part = f"{filename}.part"
+    try:
+        with open(part, "wb") as file:
+            counts = compile_lorebooks(template, sources, file, cache, policy, workers)
+    except BaseException:
+        disk.remove(part)
+        raise
+    os.replace(part, filename)
+    logger.info(
+        "Compiled %d entries and %d categories into %s",
+        counts["entries"],
+        counts["categories"],
+        filename,
+    )
+    return counts
@@ -0,0 +1,64 @@
+"""
+Helpers for the files cpm keeps on disk (metadata cache, store, fragments, lockfile):
+removing, hashing and evicting the least recently used ones.
+"""
+import hashlib
+import os
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional
+
+from cpm import settings
+
+
+def remove(path: Path):
+    """Remove `path` if it's still there"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def hash_file(path: Path, digest=None):
+    """Feed the content of `path` to `digest` (a new sha256 by default) and return it"""
+    digest = digest or hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(settings.CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest
+
+
+def file_digest(path) -> Optional[str]:
+    """sha256 of a file, None if it doesn't exist"""
+    try:
+        return hash_file(path).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def evict(
+    files: Iterable[Path], max_bytes: float, keep: Callable[[Path], bool] = None
+) -> List[Path]:
+    """
+    Remove the least recently used (modified) of `files` until they fit in `max_bytes`.
+    Files `keep` is true for count towards the size but are never removed.
+    Returns the removed files.
+    """
+    candidates = []
+    total = 0
+    for file in files:
+        try:
+            stat = file.stat()
+        except FileNotFoundError:
+            continue
+        total += stat.st_size
+        if keep is None or not keep(file):
+            candidates.append((stat.st_mtime, stat.st_size, file))
+    candidates.sort()
+    removed = []
+    for _, size, file in candidates:
+        if total <= max_bytes:
+            break
+        remove(file)
+        total -= size
+        removed.append(file)
+    return removed
@@ -0,0 +1,162 @@
+"""
+Repository endpoints (the main server, mirrors, a `cpm serve` on the LAN...).
+They are ranked by the latency of their /docs, requests go to the fastest one that
+is up and a failed endpoint is left for the next one right away.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+from pathlib import Path
+import threading
+import time
+from typing import Dict, List, Optional
+
+import requests
+
+from cpm.logging import get_logger
+from cpm import settings
+
+logger = get_logger("audit.endpoints")
+
+
+def probe(url: str) -> Optional[float]:
+    """Seconds it takes `url` to answer its /docs, None if it's down"""
+    start = time.perf_counter()
+    try:
+        requests.get(url + "docs", timeout=settings.PROBE_TIMEOUT).raise_for_status()
+    except requests.exceptions.RequestException as exc:
+        logger.info("%s is down: %s", url, exc)
+        return None
+    return time.perf_counter() - start
+
+
+class Endpoints:
+    """
+    The endpoints in the order they should be tried. The ranking is kept in
+    ENDPOINTS_FILE so each command doesn't probe them again: a stale one is used
+    while it's refreshed in the background.
+    Safe to share between the transfer workers.
+    """
+
+    def __init__(self, urls: List[str] = None, path: Path = None):
+        self.urls = list(urls or settings.URLS)
+        self.path = Path(path or settings.ENDPOINTS_FILE)
+        self.ranked = list(self.urls)
+        self.latency: Dict[str, Optional[float]] = {}
+        self.down = set()
+        self._lock = threading.Lock()
+        self._probing = None
+
+    @property
+    def current(self) -> str:
+        """The endpoint to use now"""
+        with self._lock:
+            for url in self.ranked:
+                if url not in self.down:
+                    return url
+            return self.ranked[0]  # all down, maybe not anymore
+
+    @property
+    def primary(self) -> str:
+        """The first endpoint configured, the only one that takes writes (mirrors are read-only)"""
+        return self.urls[0]
+
+    def _key(self) -> str:
+        return ",".join(sorted(self.urls))
+
+    def load(self) -> bool:
+        """Use the ranking on disk. Returns whether it's fresh"""
+        try:
+            with open(self.path) as file:
+                saved = json.load(file)[self._key()]
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            return False
+        with self._lock:
+            self.latency = saved["latency"]
+            self._apply()
+        return time.time() - saved["checked"] < settings.ENDPOINTS_TTL
+
+    def _save(self):
+        try:
+            with open(self.path) as file:
+                saved = json.load(file)
+        except (FileNotFoundError, ValueError):
+            saved = {}
+        saved[self._key()] = {"checked": time.time(), "latency": self.latency}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f".{threading.get_ident()}.tmp")
+        with open(tmp, "w") as file:
+            json.dump(saved, file)
+        tmp.replace(self.path)
+
+    def _apply(self):
+        """Rank by latency, down ones last, keeping the configured order for ties"""
+        position = {url: index for index, url in enumerate(self.urls)}
+        rank = lambda url: (
+            self.latency.get(url) is None,
+            self.latency.get(url) or 0,
+            position[url],
+        )
+        self.ranked = sorted(self.urls, key=rank)
+        self.down = {url for url in self.urls if url in self.latency and self.latency[url] is None}
+
+    def rank(self):
+        """Probe every endpoint and rank them"""
+        with ThreadPoolExecutor(max_workers=len(self.urls)) as pool:
+            latency = dict(zip(self.urls, pool.map(probe, self.urls)))
+        with self._lock:
+            self.latency = latency
+            self._apply()
+            ranked = list(self.ranked)
+        logger.info(
+            "Endpoints: %s",
+            ", ".join(
+                f"{url} (down)" if latency[url] is None else f"{url} ({latency[url] * 1000:.0f}ms)"
+                for url in ranked
+            ),
+        )
+        self._save()
+
+    def start(self):
+        """
+        Keep the ranking fresh from a background thread, probing every ENDPOINTS_TTL
+        seconds (right away if the one on disk is stale). Nothing to do for a single endpoint.
+        """
+        if len(self.urls) < 2 or self._probing:
+            return
+        fresh = self.load()
+
+        def probing():
+            if fresh:
+                time.sleep(settings.ENDPOINTS_TTL)
+            while True:
+                try:
+                    self.rank()
+                except Exception as exc:  # keep the last ranking
+                    logger.warning("Couldn't rank the endpoints: %s", exc)
+                time.sleep(settings.ENDPOINTS_TTL)
+
+        self._probing = threading.Thread(target=probing, name="endpoints", daemon=True)
+        self._probing.start()
+
+    def base(self, url: str) -> Optional[str]:
+        """The endpoint `url` belongs to"""
+        for endpoint in self.urls:
+            if url.startswith(endpoint):
+                return endpoint
+        return None
+
+    def failover(self, url: str) -> Optional[str]:
+        """
+        Mark the endpoint of `url` as down and return the same url on the next one,
+        None if `url` isn't on an endpoint or there are no more left.
+        """
+        failed = self.base(url)
+        if failed is None:
+            return None
+        with self._lock:
+            self.down.add(failed)
+            following = [endpoint for endpoint in self.ranked if endpoint not in self.down]
+        if not following:
+            return None
+        logger.warning("%s is down, switching to %s", failed, following[0])
+        return following[0] + url[len(failed) :]
@@ -0,0 +1,35 @@
+"""
+Stand-ins for objects and modules that are expensive to build or import.
+They are only built the first time one of their attributes is used
+so commands that don't need them (`cpm -h`, `cpm debug`...) start fast.
+"""
+import importlib
+import threading
+from typing import Callable
+
+
+class Lazy:
+    """Proxy that builds the real object with `factory` on first use"""
+
+    def __init__(self, factory: Callable):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_obj", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def _resolve(self):
+        if self._obj is None:
+            with self._lock:
+                if self._obj is None:
+                    object.__setattr__(self, "_obj", self._factory())
+        return self._obj
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+
+def lazy_import(name: str) -> Lazy:
+    """The module, imported when it's first used"""
+    return Lazy(lambda: importlib.import_module(name))
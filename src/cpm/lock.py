@@ -0,0 +1,110 @@
+"""
+Lockfile of `cpm download`: the resolved dependency graph with the metadata of every
+package and the hashes of its files. Later runs only fetch and zip the packages
+that changed and `--frozen` runs reproduce the locked set without asking the server.
+"""
+import json
+from pathlib import Path
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from cpm.disk import file_digest
+from cpm.logging import get_logger
+from cpm import settings
+
+logger = get_logger("audit.lock")
+
+VERSION = 1
+# a package whose metadata differs in any of these has to be fetched again
+KEYS = ("date_updated", "deps", "image", "file")
+
+
+class LockError(ValueError):
+    """The lockfile can't satisfy the request"""
+
+
+class Lockfile:
+    """
+    {
+        "version": 1,
+        "roots": [names requested],
+        "packages": {
+            name: {
+                "metadata": {...},
+                "digests": {url: sha256 of the file},
+                "archive": sha256 of the zip,
+            }
+        }
+    }
+    """
+
+    def __init__(self, path: Path = None):
+        self.path = Path(path or settings.LOCK_FILE)
+        self.roots: List[str] = []
+        self.packages: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> bool:
+        """Read the lockfile. Returns whether there was one"""
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return False
+        except ValueError:
+            logger.warning("Ignoring the corrupted lockfile %s", self.path)
+            return False
+        if data.get("version") != VERSION:
+            logger.warning("Ignoring %s, written by another version", self.path)
+            return False
+        self.roots = data["roots"]
+        self.packages = data["packages"]
+        return True
+
+    def save(self, roots: Iterable[str], names: Iterable[str]):
+        """Write the lock of `names` (and nothing else) downloaded from `roots`"""
+        names = list(names)
+        data = {
+            "version": VERSION,
+            "roots": list(roots),
+            "packages": {name: self.packages[name] for name in names},
+        }
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as file:
+            json.dump(data, file, indent=2)
+        tmp.replace(self.path)
+        logger.info("Locked %d packages in %s", len(names), self.path)
+
+    def current(self, name: str, data: dict, archive) -> Optional[dict]:
+        """The entry of `name` if it matches `data` and `archive` hasn't changed"""
+        entry = self.packages.get(name)
+        if entry is None:
+            return None
+        if any(entry["metadata"].get(key) != data.get(key) for key in KEYS):
+            return None
+        if file_digest(archive) != entry["archive"]:
+            return None
+        return entry
+
+    def record(self, name: str, data: dict, digests: Dict[str, str], archive):
+        """Lock a freshly downloaded package. Safe to call from the transfer workers"""
+        entry = {"metadata": data, "digests": digests, "archive": file_digest(archive)}
+        with self._lock:
+            self.packages[name] = entry
+
+    def resolve(self, roots: Iterable[str]) -> Dict[str, dict]:
+        """
+        Metadata of `roots` and their dependencies, in the order a depth-first walk
+        of the locked graph would find them.
+        """
+        resolved = {}
+        stack = list(reversed(list(roots)))
+        while stack:
+            name = stack.pop()
+            if name in resolved:
+                continue
+            if name not in self.packages:
+                raise LockError(f"{name} is not in {self.path}")
+            resolved[name] = self.packages[name]["metadata"]
+            stack.extend(reversed(resolved[name]["deps"]))
+        return resolved
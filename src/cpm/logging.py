@@ -1,19 +1,129 @@
 """Logging methods"""
-from typing import Callable
+import atexit
+from datetime import datetime
+from typing import Callable, Iterable, Iterator, Optional
 import logging
 import logging.config
+import logging.handlers
+import queue
+import re
 
-from cpm import settings
+from cpm import codec, settings
 
 if settings.DEBUG:
     settings.LOGGERS["handlers"]["audit_file"] = settings.LOGGERS["handlers"]["console"]
+# the files themselves are only opened when the first record is written
+settings.LOG_FILE.parent.mkdir(exist_ok=True)
 logging.config.dictConfig(settings.LOGGERS)
 
+# "{asctime} [{levelname}] -- {name}: {message}" from settings.LOGGERS
+_LINE = re.compile(
+    r"(?P<time>\S+ \S+) \[(?P<level>[A-Z]+)\] -- (?P<logger>[^:]+): (?P<message>.*)"
+)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message (and exc)"""
+
+    def format(self, record):
+        created = datetime.fromtimestamp(record.created)
+        data = {
+            "time": created.isoformat(sep=" ", timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return codec.dumps(data).decode("utf-8")
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueue records as they are. The stock QueueHandler formats them first,
+    which is the expensive part we want off the calling thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class _Families(logging.Filter):
+    """Pass the records of these loggers (and their children)"""
+
+    def __init__(self, names: Iterable[str]):
+        super().__init__()
+        self.names = set(names)
+
+    def filter(self, record):
+        return record.name.split(".")[0] in self.names
+
+
+def _queue_files():
+    """
+    Put the file handlers behind a queue: loggers only enqueue the records
+    and a background thread formats and writes them.
+    The console stays synchronous so messages for the user come out in order.
+    """
+    families = {}
+    records = queue.SimpleQueue()
+    for name in settings.LOGGERS["loggers"]:
+        logger = logging.getLogger(name)
+        for handler in list(logger.handlers):
+            if not isinstance(handler, logging.FileHandler):
+                continue
+            logger.removeHandler(handler)
+            families.setdefault(handler, set()).add(name)
+            if not any(isinstance(h, _LazyQueueHandler) for h in logger.handlers):
+                logger.addHandler(_LazyQueueHandler(records))
+    if not families:
+        return None
+    for handler, names in families.items():
+        handler.addFilter(_Families(names))
+        if settings.LOG_FORMAT == "json":
+            handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(
+        records, *families, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)  # after everyone else's atexit (LIFO), writes what's left
+    return listener
+
+
+LISTENER = _queue_files()
+
 
 def get_logger(name="audit.root"):
     return logging.getLogger(name)
 
 
+class _Mirror:
+    """Send each message to all the loggers (once per logger)"""
+
+    def __init__(self, *loggers: logging.Logger):
+        self.loggers = loggers
+
+    def log(self, level: int, msg, *args, **kwargs):
+        for logger in self.loggers:
+            if logger.isEnabledFor(level):
+                logger.log(level, msg, *args, **kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log(logging.WARNING, msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self.log(logging.ERROR, msg, *args, **kwargs)
+
+    def critical(self, msg, *args, **kwargs):
+        self.log(logging.CRITICAL, msg, *args, **kwargs)
+
+
 def logged(cls) -> Callable:
     """Decorator to log certain methods of each class while giving
     each clas its own logger."""
@@ -23,12 +133,54 @@ def logged(cls) -> Callable:
     cls.logger = logger
     cls.logger_user = logger_user
     cls.logger_error = logging.getLogger("error." + cls.__qualname__)
-    cls.logger_mirror = logging.getLogger("user_info." + cls.__qualname__)
+    # the user and the audit log
+    cls.logger_mirror = _Mirror(logger_user, logger)
+
+    return cls
 
-    def _log_mirror(self, *args, **kwargs):
-        logging.Logger._log(self, *args, kwargs) # pylint: disable=W0212
-        logger._log(*args, **kwargs)# pylint: disable=W0212
 
-    cls.logger_mirror._log = _log_mirror.__get__(logger, logging.Logger) # pylint: disable=E1111,W0212
+def parse(lines: Iterable[str]) -> Iterator[dict]:
+    """
+    Records of a log file (text or JSON Lines) as dicts with time, level,
+    logger and message. Lines that don't start a record (tracebacks...)
+    belong to the previous one.
+    """
+    record = None
+    for line in lines:
+        line = line.rstrip("\n")
+        data = None
+        if line.startswith("{"):
+            try:
+                data = codec.loads(line)
+            except ValueError:
+                pass
+            if not isinstance(data, dict) or not {"level", "logger", "message"} <= data.keys():
+                data = None
+            elif "exc" in data:
+                data["message"] += "\n" + data.pop("exc")
+        else:
+            match = _LINE.match(line)
+            if match:
+                data = match.groupdict()
+        if data is not None:
+            if record:
+                yield record
+            record = data
+        elif record:
+            record["message"] += "\n" + line
+    if record:
+        yield record
 
-    return cls
+
+def matches(record: dict, level: Optional[str] = None, logger: Optional[str] = None) -> bool:
+    """Whether a record is at least `level` and comes from `logger` (or its children)"""
+    if level and logging.getLevelName(record["level"]) < logging.getLevelName(level.upper()):
+        return False
+    name = record["logger"]
+    if logger and not (name == logger or name.startswith(logger + ".")):
+        return False
+    return True
+
+
+def format_record(record: dict) -> str:
+    return f"{record['time']} [{record['level']}] -- {record['logger']}: {record['message']}"
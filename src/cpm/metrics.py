@@ -0,0 +1,168 @@
+"""
+Request metrics: latency histograms, bytes, status codes, retries and cache hits
+per host and endpoint. Saved to a small JSON file and summarized by `cpm stats`.
+"""
+import bisect
+import json
+from pathlib import Path
+import threading
+from typing import Dict, List
+from urllib.parse import urlsplit
+
+from cpm.logging import get_logger
+from cpm import settings
+
+logger = get_logger("audit.metrics")
+
+# upper bounds of the latency buckets, in milliseconds. The last bucket is open
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+
+
+def endpoint(method: str, url: str) -> str:
+    """Series key for a request: host, method and what it hits on the API"""
+    parts = urlsplit(url)
+    api = next(
+        (urlsplit(base) for base in settings.URLS if urlsplit(base).netloc == parts.netloc), None
+    )
+    if api is None:
+        return f"{parts.netloc} {method} file"
+    path = parts.path[len(api.path) :].strip("/")
+    if not path:
+        name = "list"
+    elif path in ("docs", "bulk"):
+        name = path
+    else:
+        name = "item"
+    return f"{parts.netloc} {method} {name}"
+
+
+def _series() -> dict:
+    return {
+        "count": 0,
+        "hist": [0] * (len(BUCKETS) + 1),
+        "bytes": 0,
+        "retries": 0,
+        "status": {},
+    }
+
+
+def percentile(hist: List[int], quantile: float) -> str:
+    """Upper bound of the bucket the quantile falls in"""
+    total = sum(hist)
+    if not total:
+        return "-"
+    seen = 0
+    for index, count in enumerate(hist):
+        seen += count
+        if seen >= quantile * total:
+            break
+    if index == len(BUCKETS):
+        return f">{BUCKETS[-1]}ms"
+    return f"{BUCKETS[index]}ms"
+
+
+class Metrics:
+    """Thread-safe collector. Cheap enough to call on every request"""
+
+    def __init__(self):
+        self.series: Dict[str, dict] = {}
+        self.cache: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(
+        self, method: str, url: str, status, latency: float, size: int = 0, retried: bool = False
+    ):
+        """
+        Record an attempt. `status` is the HTTP status or the name of the error,
+        `retried` whether the attempt is a retry.
+        """
+        key = endpoint(method, url)
+        bucket = bisect.bisect_left(BUCKETS, latency * 1000)
+        with self._lock:
+            series = self.series.setdefault(key, _series())
+            series["count"] += 1
+            series["hist"][bucket] += 1
+            series["bytes"] += size
+            series["retries"] += retried
+            series["status"][str(status)] = series["status"].get(str(status), 0) + 1
+
+    def record_cache(self, url: str, stats: Dict[str, int]):
+        host = urlsplit(url).netloc
+        with self._lock:
+            counts = self.cache.setdefault(host, {})
+            for key, value in stats.items():
+                counts[key] = counts.get(key, 0) + value
+
+    def merge(self, data: dict):
+        """Add metrics saved by previous runs"""
+        with self._lock:
+            for key, saved in data.get("series", {}).items():
+                series = self.series.setdefault(key, _series())
+                for field in ("count", "bytes", "retries"):
+                    series[field] += saved[field]
+                series["hist"] = [a + b for a, b in zip(series["hist"], saved["hist"])]
+                for status, count in saved["status"].items():
+                    series["status"][status] = series["status"].get(status, 0) + count
+            for host, counts in data.get("cache", {}).items():
+                merged = self.cache.setdefault(host, {})
+                for key, value in counts.items():
+                    merged[key] = merged.get(key, 0) + value
+
+    def save(self, path: Path = None):
+        """Add the metrics recorded since the last save to the file"""
+        with self._lock:
+            series, self.series = self.series, {}
+            cache, self.cache = self.cache, {}
+        if not series and not cache:
+            return
+        path = Path(path or settings.METRICS_FILE)
+        total = Metrics()
+        total.merge(load(path))
+        total.merge({"series": series, "cache": cache})
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w") as file:
+            json.dump(
+                {"buckets": BUCKETS, "series": total.series, "cache": total.cache}, file
+            )
+        tmp.replace(path)
+        logger.debug("Metrics saved to %s", path)
+
+
+def load(path: Path = None) -> dict:
+    path = Path(path or settings.METRICS_FILE)
+    try:
+        with open(path) as file:
+            data = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if data.get("buckets") != BUCKETS:
+        logger.warning("Discarding metrics saved with different buckets")
+        return {}
+    return data
+
+
+def summary(data: dict) -> List[str]:
+    """Lines of the report of `cpm stats`"""
+    lines = [
+        f"{'endpoint':<45} {'count':>7} {'p50':>8} {'p95':>8} {'p99':>8}"
+        f" {'MB':>9} {'retries':>7}  status"
+    ]
+    for key, series in sorted(data.get("series", {}).items()):
+        status = ", ".join(f"{code}: {n}" for code, n in sorted(series["status"].items()))
+        lines.append(
+            f"{key:<45} {series['count']:>7}"
+            f" {percentile(series['hist'], 0.5):>8}"
+            f" {percentile(series['hist'], 0.95):>8}"
+            f" {percentile(series['hist'], 0.99):>8}"
+            f" {series['bytes'] / 1e6:>9.2f} {series['retries']:>7}  {status}"
+        )
+    for host, counts in sorted(data.get("cache", {}).items()):
+        lines.append(
+            f"cache {host}: "
+            + ", ".join(f"{key}: {value}" for key, value in sorted(counts.items()))
+        )
+    return lines
+
+
+METRICS = Metrics()
@@ -0,0 +1,111 @@
+"""
+Dependency resolution. Only the metadata is fetched, so the graph of a request
+can be inspected (`cpm deps`) or planned before any file is downloaded.
+"""
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from cpm.logging import get_logger
+from cpm import transfer
+
+logger = get_logger("audit.resolver")
+
+_VISITING, _DONE = 1, 2
+
+
+class Graph:
+    """
+    Metadata of the packages reachable from the roots resolved so far.
+    It's shared by every root, so subgraphs already resolved (the common
+    dependencies of "a, b, c") aren't fetched again.
+
+    :data fetch: gets the names of a level and returns a dict name -> metadata
+    """
+
+    def __init__(self, fetch: Callable[[List[str]], Dict[str, dict]]):
+        self.fetch = fetch
+        self.metadata: Dict[str, dict] = {}
+
+    def deps(self, name: str) -> List[str]:
+        return self.metadata[name]["deps"]
+
+    def resolve(self, roots: Iterable[str], on_level: Optional[Callable] = None):
+        """
+        Fetch the metadata of `roots` and their dependencies, one wave per level.
+        `on_level` gets the metadata of every new level as soon as it's fetched,
+        so the files can be downloaded while the next one is resolved.
+        """
+
+        def fetch(level):
+            fetched = self.fetch(level)
+            self.metadata.update(fetched)
+            if on_level:
+                on_level(fetched)
+            return fetched
+
+        # a known package had its whole subgraph resolved with it
+        transfer.crawl(roots, fetch, lambda data: data["deps"], skip=set(self.metadata))
+        return self
+
+    def preorder(self, roots: Iterable[str]) -> List[str]:
+        """The packages in the order a depth-first walk from `roots` finds them"""
+        found = {}
+        stack = list(reversed(list(roots)))
+        while stack:
+            name = stack.pop()
+            if name in found:
+                continue
+            found[name] = None
+            stack.extend(reversed(self.deps(name)))
+        return list(found)
+
+    def plan(self, roots: Iterable[str]) -> Tuple[List[str], List[List[str]]]:
+        """
+        Topological order of the packages reachable from `roots` (dependencies first)
+        and the cycles found on the way, as paths that start and end on the same package.
+        The edge closing a cycle is ignored for the order.
+        """
+        order = []
+        cycles = []
+        state = {}
+        for root in roots:
+            if root in state:
+                continue
+            state[root] = _VISITING
+            stack = [(root, iter(self.deps(root)))]
+            while stack:
+                name, children = stack[-1]
+                for child in children:
+                    if child not in state:
+                        state[child] = _VISITING
+                        stack.append((child, iter(self.deps(child))))
+                        break
+                    if state[child] == _VISITING:
+                        path = [node for node, _ in stack]
+                        cycles.append(path[path.index(child) :] + [child])
+                        logger.warning("Dependency cycle: %s", " -> ".join(cycles[-1]))
+                else:
+                    stack.pop()
+                    state[name] = _DONE
+                    order.append(name)
+        return order, cycles
+
+    def tree(self, root: str) -> Iterator[str]:
+        """
+        Lines of the dependency tree of `root`. Packages already shown are marked
+        with (*) instead of repeating their subtree, and cycles with (cycle).
+        """
+        shown = set()
+        stack = [(root, 0, ())]
+        while stack:
+            name, depth, path = stack.pop()
+            indent = "    " * depth
+            if name in path:
+                yield f"{indent}{name} (cycle)"
+                continue
+            if name in shown:
+                yield f"{indent}{name} (*)"
+                continue
+            shown.add(name)
+            yield indent + name
+            path = path + (name,)
+            stack.extend((dep, depth + 1, path) for dep in reversed(self.deps(name)))
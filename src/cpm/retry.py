@@ -0,0 +1,99 @@
+"""
+Retry policy for the http client: backoff, Retry-After, a retry budget and per-host circuit breakers.
+"""
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import random
+import threading
+import time
+from typing import Optional
+
+import requests
+
+from cpm import settings
+
+RETRY_STATUS = (429, 503)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """The host failed too many times in a row and isn't being contacted for now"""
+
+
+def backoff(retries: int) -> float:
+    """Exponential backoff with (equal) jitter for the nth retry"""
+    delay = min(settings.BACKOFF_MAX, settings.BACKOFF * 2 ** retries)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def retry_after(response: requests.Response) -> Optional[float]:
+    """
+    Seconds to wait according to the Retry-After header of the response.
+    The header can either be a number of seconds or an HTTP date.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class RetryBudget:
+    """Total number of retries a command is allowed to spend, shared by all workers"""
+
+    def __init__(self, retries: int = None):
+        self.left = settings.RETRY_BUDGET if retries is None else retries
+        self._lock = threading.Lock()
+
+    def spend(self) -> bool:
+        """Take one retry from the budget. False if there is none left"""
+        with self._lock:
+            if self.left <= 0:
+                return False
+            self.left -= 1
+            return True
+
+
+class CircuitBreaker:
+    """
+    Keeps track of consecutive failures per host.
+    After `threshold` failures the host is skipped for `cooldown` seconds, then
+    a single request is let through to check if it's back.
+    """
+
+    def __init__(self, threshold: int = None, cooldown: float = None):
+        self.threshold = threshold or settings.BREAKER_THRESHOLD
+        self.cooldown = settings.BREAKER_COOLDOWN if cooldown is None else cooldown
+        self._failures = {}
+        self._opened = {}
+        self._lock = threading.Lock()
+
+    def allow(self, host: str) -> bool:
+        with self._lock:
+            opened = self._opened.get(host)
+            if opened is None:
+                return True
+            if time.monotonic() - opened < self.cooldown:
+                return False
+            # half-open: let this one through and wait for the result
+            self._opened[host] = time.monotonic()
+            return True
+
+    def success(self, host: str):
+        with self._lock:
+            self._failures.pop(host, None)
+            self._opened.pop(host, None)
+
+    def failure(self, host: str):
+        with self._lock:
+            self._failures[host] = self._failures.get(host, 0) + 1
+            if self._failures[host] >= self.threshold:
+                self._opened[host] = time.monotonic()
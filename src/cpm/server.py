@@ -0,0 +1,276 @@
+"""
+Local mirror of the repository. `Mirror.sync` copies the catalog metadata and every
+file it references into a directory and `serve` exposes them with the HTTP API
+the client uses, so a LAN can point `CPM_URL` at one box instead of the internet.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import math
+import os
+from pathlib import Path
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote, unquote, unquote_plus, urlsplit
+
+from cpm.catalog import Catalog
+from cpm.logging import get_logger
+from cpm.store import BlobStore
+from cpm import codec, settings, transfer
+
+logger = get_logger("audit.server")
+logger_err = get_logger("error.server")
+
+_DIGEST = re.compile(r"[0-9a-f]{64}")
+
+
+def _urls(item: dict) -> List[str]:
+    return [
+        url for url in (item.get("image"), item.get("file")) if url and url.startswith("http")
+    ]
+
+
+class Mirror:
+    """
+    Layout:
+        catalog.sqlite3 -- the metadata, as the index of `cpm search --offline`
+        store/ -- the files, content-addressed (see BlobStore) and never evicted
+    """
+
+    def __init__(self, path: Path = None):
+        self.path = Path(path or settings.MIRROR_DIR)
+        self.store = BlobStore(self.path / "store", max_bytes=math.inf)
+        self._items: Dict[str, dict] = {}
+        self._loaded = None
+        self._lock = threading.Lock()
+
+    @property
+    def catalog_file(self) -> Path:
+        return self.path / "catalog.sqlite3"
+
+    def _fetch(self, files, url: str, version: str = None, meter: transfer.Meter = None) -> bool:
+        """Download `url` into the store unless it's there. Returns whether it is now"""
+        with self.store.lock(url):
+            if self.store.lookup(url, version) is not None:
+                return True
+            part = self.store.partial(url)
+            try:
+                digest = transfer.download(files, url, part, meter)
+            except Exception as exc:
+                logger_err.error("%s: %s", url, exc)
+                return False
+            if digest is None:
+                logger.warning("%s couldn't be downloaded", url)
+                return False
+            self.store.commit(url, part, digest, version)
+            return True
+
+    def sync(
+        self, client, files, jobs: int = 1, meter: transfer.Meter = None
+    ) -> Tuple[int, int, int]:
+        """
+        Bring the mirror up to date with the server: metadata of the packages that changed
+        (from `client`) and the files that aren't in the store yet (from `files`).
+        Files are stored by URL and date_updated of their package, a package updated
+        in place gets its files downloaded again.
+        Returns the packages (re)written, the files downloaded and the files that failed.
+        """
+        items = [item for page in transfer.pages(client.list_item, jobs=jobs) for item in page]
+        catalog = Catalog(self.catalog_file)
+        try:
+            written, removed = catalog.update(items)
+        finally:
+            catalog.close()
+        logger.info("Mirrored %d packages (%d updated, %d removed)", len(items), written, removed)
+
+        missing = list(
+            dict.fromkeys(
+                (url, item.get("date_updated"))
+                for item in items
+                for url in _urls(item)
+                if self.store.lookup(url, item.get("date_updated")) is None
+            )
+        )
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+            done = list(pool.map(lambda missed: self._fetch(files, *missed, meter), missing))
+        return written, sum(done), len(done) - sum(done)
+
+    def items(self) -> Dict[str, dict]:
+        """Metadata by name, read again whenever `sync` changed it"""
+        try:
+            mtime = os.stat(self.catalog_file).st_mtime_ns
+        except FileNotFoundError:
+            return {}
+        with self._lock:
+            if mtime != self._loaded:
+                catalog = Catalog(self.catalog_file)
+                try:
+                    items = catalog.search()
+                finally:
+                    catalog.close()
+                # in the order of the server
+                items.sort(key=lambda item: (item.get("id") or 0, item["name"]))
+                self._items = {item["name"]: item for item in items}
+                self._loaded = mtime
+            return self._items
+
+    def rewrite(self, item: dict, base: str) -> dict:
+        """The item with the URLs of the mirrored files pointing to `base`"""
+        item = dict(item)
+        for key in ("image", "file"):
+            url = item.get(key)
+            blob = self.store.lookup(url, item.get("date_updated")) if url else None
+            if blob is not None:
+                # keep the original name, the client takes the extension from it
+                name = urlsplit(url).path.rstrip("/").split("/")[-1] or "file"
+                item[key] = f"{base}files/{self.store.digest(blob)}/{quote(name)}"
+        return item
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    The part of the repository API the client uses:
+        GET  /docs              urls and item scheme
+        GET  /?page=&name=&tags list (PAGE_SIZE items per page)
+        GET  /<name>            details of a package
+        POST /bulk              details of many packages ({"names": [...]})
+        GET  /files/<digest>/<name>  mirrored files, with Range support
+    It's read-only, publishing has to go to the real server.
+    """
+
+    protocol_version = "HTTP/1.1"
+    mirror: Mirror = None
+    public_url: Optional[str] = None
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        logger.info("%s %s", self.address_string(), format % args)
+
+    def _base(self) -> str:
+        return self.public_url or f"http://{self.headers.get('Host', 'localhost')}/"
+
+    def _send(self, status: int, body: bytes, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _json(self, data, status: int = 200):
+        self._send(status, codec.dumps(data))
+
+    def do_HEAD(self):  # pylint: disable=C0103
+        self.do_GET()
+
+    def do_GET(self):  # pylint: disable=C0103
+        parts = urlsplit(self.path)
+        path = unquote(parts.path).strip("/")
+        if path == "docs":
+            scheme = dict(settings.ITEM_SCHEME, id=0)
+            self._json({"urls": {"/": {"scheme": scheme}, "/bulk": {}}})
+        elif path.startswith("files/"):
+            self._file(path[len("files/") :].split("/")[0])
+        elif path:
+            item = self.mirror.items().get(path)
+            if item is None:
+                self._json({"error": "not found"}, 404)
+            else:
+                self._json(self.mirror.rewrite(item, self._base()))
+        else:
+            self._list(parts.query)
+
+    def do_POST(self):  # pylint: disable=C0103
+        path = unquote(urlsplit(self.path).path).strip("/")
+        if path != "bulk":
+            self._json({"error": "this is a read-only mirror"}, 405)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            names = codec.loads(self.rfile.read(length))["names"]
+        except (ValueError, KeyError, TypeError):
+            self._json({"error": "expected {\"names\": [...]}"}, 400)
+            return
+        items = self.mirror.items()
+        base = self._base()
+        self._json([self.mirror.rewrite(items[name], base) for name in names if name in items])
+
+    def do_PUT(self):  # pylint: disable=C0103
+        self._json({"error": "this is a read-only mirror"}, 405)
+
+    do_DELETE = do_PUT
+
+    def _list(self, query: str):
+        """Same filters as the server: name contains, all the tags (space separated)"""
+        page = 0
+        name = None
+        tags = []
+        for arg in query.split("&") if query else []:
+            if "=" in arg:
+                key, value = arg.split("=", 1)
+                key, value = unquote_plus(key), unquote_plus(value)
+                if key == "page":
+                    if not value.isdigit():
+                        self._json({"error": "page must be a number"}, 400)
+                        return
+                    page = int(value)
+                elif key == "name":
+                    name = value.lower()
+            else:
+                tags.extend(tag.lower() for tag in unquote(arg).split())
+        items = [
+            item
+            for item in self.mirror.items().values()
+            if (name is None or name in item["name"].lower())
+            and all(tag in [t.lower() for t in item.get("tags") or []] for tag in tags)
+        ]
+        size = settings.PAGE_SIZE
+        base = self._base()
+        shown = items[page * size : (page + 1) * size]
+        self._json([self.mirror.rewrite(item, base) for item in shown])
+
+    def _file(self, digest: str):
+        blob = self.mirror.store.get(digest) if _DIGEST.fullmatch(digest) else None
+        if blob is None:
+            self._send(404, b"not found", "text/plain")
+            return
+        size = blob.stat().st_size
+        start = 0
+        status = 200
+        etag = f'"{digest}"'
+        headers = {"Accept-Ranges": "bytes", "ETag": etag}
+        ranges = self.headers.get("Range", "")
+        match = re.fullmatch(r"bytes=(\d+)-", ranges)
+        if match and self.headers.get("If-Range", etag) == etag:
+            start = int(match[1])
+            if start >= size:
+                self._send(416, b"", "text/plain", {"Content-Range": f"bytes */{size}"})
+                return
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{size - 1}/{size}"
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size - start))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        with open(blob, "rb") as file:
+            file.seek(start)
+            for chunk in iter(lambda: file.read(settings.CHUNK_SIZE), b""):
+                self.wfile.write(chunk)
+
+
+def serve(mirror: Mirror, host: str, port: int, public_url: str = None) -> ThreadingHTTPServer:
+    """
+    HTTP server for the mirror (call `serve_forever` on it). File URLs point to
+    `public_url`, or to the address the client used to reach the server.
+    """
+    if public_url and not public_url.endswith("/"):
+        public_url += "/"
+    handler = type("MirrorHandler", (Handler,), {"mirror": mirror, "public_url": public_url})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
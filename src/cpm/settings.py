@@ -9,12 +9,55 @@ BASE_DIR = Path(__file__).parent
 DEBUG = os.environ.get("CPM_DEBUG", False)
 
 # client settings
-RETRIES = 3
-URL = (
+RETRIES = 3  # per request
+RETRY_BUDGET = 20  # per command
+BACKOFF = 0.5  # seconds, doubles on every retry
+BACKOFF_MAX = 30  # also the longest Retry-After we are willing to wait
+BREAKER_THRESHOLD = 3  # consecutive failures before a host is skipped
+BREAKER_COOLDOWN = 60  # seconds
+TIMEOUT = (10, 60)  # seconds to connect and to wait for the next bytes of a response
+JOBS = 4  # transfer workers
+PAGE_SIZE = 10  # items per page of the catalog
+CHUNK_SIZE = 64 * 1024  # bytes read at once when streaming files
+PROGRESS_INTERVAL = 2  # seconds between download progress reports
+JSON_BACKEND = os.environ.get("CPM_JSON")  # json or orjson, the fastest installed if unset
+ZIP_LEVEL = int(os.environ.get("CPM_ZIP_LEVEL", 6))  # deflate level of the packages
+ZIP_STORED = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".zip")  # not deflated
+URL = os.environ.get(
+    "CPM_URL",
     "https://moistcat.pythonanywhere.com/"
     if DEBUG is False
-    else "http://localhost:5050/"
+    else "http://localhost:5050/",
 )
+# mirrors too, comma separated. The fastest one that is up is used (see endpoints.py)
+URLS = [
+    url.strip() if url.strip().endswith("/") else url.strip() + "/"
+    for url in os.environ.get("CPM_URLS", URL).split(",")
+    if url.strip()
+]
+URL = URLS[0]
+PROBE_TIMEOUT = 2  # seconds for an endpoint to answer before it's considered down
+
+# cache settings
+CACHE_DIR = Path(os.environ.get("CPM_CACHE_DIR", BASE_DIR / "cache"))
+CACHE_TTL = 60 * 10  # seconds before metadata is revalidated
+CACHE_MAX_BYTES = 5000000
+STORE_DIR = CACHE_DIR / "store"  # downloaded files
+STORE_MAX_BYTES = 500000000
+FRAGMENT_DIR = CACHE_DIR / "fragments"  # parsed lorebooks, see compiler.FragmentCache
+FRAGMENT_MAX_BYTES = 200000000
+CONFLICT_POLICY = "first"  # for entries and categories that clash, see compiler.Merger
+CATALOG_FILE = CACHE_DIR / "catalog.sqlite3"  # local index for `cpm search --offline`
+METRICS_FILE = CACHE_DIR / "metrics.json"  # see `cpm stats`
+SCHEME_FILE = CACHE_DIR / "scheme.json"  # when the item scheme was last checked
+SCHEME_TTL = 60 * 60 * 24
+ENDPOINTS_FILE = CACHE_DIR / "endpoints.json"  # latency ranking of the endpoints
+ENDPOINTS_TTL = 60 * 10  # seconds between rankings
+LOCK_FILE = "cpm.lock"  # written next to the packages by `cpm download`
+MIRROR_DIR = Path(os.environ.get("CPM_MIRROR_DIR", CACHE_DIR / "mirror"))  # `cpm mirror`
+SERVE_HOST = "0.0.0.0"  # `cpm serve`
+SERVE_PORT = 5050
+
 ITEM_SCHEME = {
     "name": "",
     "deps": [],
@@ -43,6 +86,8 @@ def get_keys():
 # logger settings
 LOG_FILE = BASE_DIR / "logs/client.audit"
 ERROR_FILE = BASE_DIR / "logs/client.error"
+LOG_FORMAT = os.environ.get("CPM_LOG_FORMAT", "text")  # or json (JSON Lines) for the files
+FOLLOW_INTERVAL = 0.5  # seconds between checks of `cpm debug --follow`
 LOGGERS = {
     "version": 1,
     "handlers": {
@@ -57,6 +102,7 @@ LOGGERS = {
             "backupCount": 1,
             "filename": LOG_FILE,
             "encoding": "utf-8",
+            "delay": True,
             "formatter": "basic",
         },
         "error_file": {
@@ -65,6 +111,7 @@ LOGGERS = {
             "backupCount": 1,
             "filename": ERROR_FILE,
             "encoding": "utf-8",
+            "delay": True,
             "formatter": "basic",
         },
     },
@@ -0,0 +1,126 @@
+"""
+Content-addressed store for downloaded files (lorebooks and images).
+Blobs are named after the hash of their content and each source URL points to a blob,
+so a file shared by many packages is only fetched once.
+"""
+import hashlib
+import math
+import os
+from pathlib import Path
+import threading
+from typing import Optional
+
+from cpm.logging import get_logger
+from cpm import disk, settings
+
+logger = get_logger("audit.store")
+
+
+class BlobStore:
+    """
+    Layout:
+        blobs/<2 first chars of the digest>/<sha256 of the content>
+        refs/<sha256 of the url and version> -- contains the digest of the blob
+        partial/<sha256 of the url> -- downloads that haven't finished yet
+    `gc` removes the least recently used blobs once the store is over `max_bytes`,
+    except the ones this run looked up or added: the command may still need them.
+    Downloads are always added to the store, `enabled` only controls whether
+    stored files are reused.
+    """
+
+    def __init__(self, path: Path = None, max_bytes: int = None):
+        self.path = Path(path or settings.STORE_DIR)
+        self.max_bytes = max_bytes or settings.STORE_MAX_BYTES
+        self.enabled = True  # reuse stored files
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._used = set()  # digests referenced by this run
+
+    def _use(self, blob: Path) -> Path:
+        with self._lock:
+            self._used.add(blob.name)
+        return blob
+
+    def _blob(self, digest: str) -> Path:
+        return self.path / "blobs" / digest[:2] / digest
+
+    def _ref(self, url: str, version: str = None) -> Path:
+        key = url if version is None else f"{url}\n{version}"
+        return self.path / "refs" / hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def lookup(self, url: str, version: str = None) -> Optional[Path]:
+        """
+        The blob downloaded from `url` or None. URLs aren't always immutable, with
+        a `version` (the date_updated of the package) only the file of that version is found.
+        """
+        if not self.enabled:
+            return None
+        try:
+            with open(self._ref(url, version)) as file:
+                blob = self._blob(file.read().strip())
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(blob)  # LRU
+        except FileNotFoundError:
+            return None  # garbage collected
+        return self._use(blob)
+
+    def get(self, digest: str) -> Optional[Path]:
+        """The blob with this digest or None"""
+        if not self.enabled or not digest:
+            return None
+        blob = self._blob(digest)
+        try:
+            os.utime(blob)  # LRU
+        except FileNotFoundError:
+            return None
+        return self._use(blob)
+
+    @staticmethod
+    def digest(blob: Path) -> str:
+        """Digest of the content of a blob"""
+        return Path(blob).name
+
+    def lock(self, url: str) -> threading.Lock:
+        """Lock to hold while fetching `url` so workers don't download the same file twice"""
+        with self._lock:
+            return self._locks.setdefault(url, threading.Lock())
+
+    def partial(self, url: str) -> Path:
+        """Where to (keep) download(ing) `url` until it's complete"""
+        part = self.path / "partial" / hashlib.sha256(url.encode("utf-8")).hexdigest()
+        part.parent.mkdir(parents=True, exist_ok=True)
+        return part
+
+    def commit(self, url: str, part: Path, digest: str, version: str = None) -> Path:
+        """Move a complete download (of `version`, see `lookup`) into the store. Returns the blob"""
+        blob = self._blob(digest)
+        if blob.exists():
+            disk.remove(part)
+        else:
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(part, blob)
+
+        ref = self._ref(url, version)
+        ref.parent.mkdir(parents=True, exist_ok=True)
+        tmp = ref.with_suffix(f".{threading.get_ident()}.tmp")
+        with open(tmp, "w") as file:
+            file.write(digest)
+        os.replace(tmp, ref)
+        return self._use(blob)
+
+    def gc(self):
+        """
+        Remove the least recently used blobs until the store fits in `max_bytes`.
+        Call it once the command is done with the files.
+        """
+        if math.isinf(self.max_bytes):
+            return
+        with self._lock:
+            # refs pointing to the removed blobs become misses
+            removed = disk.evict(
+                self.path.glob("blobs/*/*"), self.max_bytes, lambda blob: blob.name in self._used
+            )
+            for blob in removed:
+                logger.info("Removed %s from the local store", blob.name)
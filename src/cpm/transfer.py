@@ -0,0 +1,307 @@
+"""
+Transfer engine. Runs independent transfers (metadata and files) on a bounded pool of workers.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from pathlib import Path
+import re
+import threading
+import time
+from typing import Callable, Dict, Hashable, Iterable, Iterator, Optional
+
+from cpm.logging import get_logger
+from cpm import codec, disk, settings
+
+logger = get_logger("audit.transfer")
+logger_user = get_logger("user_info.transfer")
+
+_RATE = re.compile(r"(\d+(?:\.\d+)?)\s*([kmg]?)b?", re.IGNORECASE)
+
+
+def crawl(
+    roots: Iterable[Hashable],
+    fetch: Callable,
+    children: Callable,
+    skip: Iterable[Hashable] = (),
+) -> Dict:
+    """
+    Walk the graph from `roots` level by level.
+
+    :data fetch: gets every new node of a level at once and returns a dict node -> result,
+    so a whole level can be fetched in a single wave
+    :data children: gets a result and returns the nodes it depends on
+    :data skip: nodes that are already available and shouldn't be fetched again
+
+    Returns a dict node -> result.
+    """
+    results = {}
+    seen = set(skip)
+    level = [root for root in dict.fromkeys(roots) if root not in seen]
+    while level:
+        seen.update(level)
+        fetched = fetch(level)
+        results.update(fetched)
+        following = []
+        for node in level:
+            for child in children(fetched[node]):
+                if child in seen:
+                    logger.info("Found duplicate dependency %s. Ignoring...", child)
+                    continue
+                seen.add(child)
+                following.append(child)
+        level = following
+    return results
+
+
+def pages(fetch: Callable[[int], list], start: int = 0, jobs: int = 1) -> Iterator[list]:
+    """
+    Yield `fetch(start)`, `fetch(start + 1)`... in order, keeping up to `jobs` pages
+    in flight ahead of the consumer. Stops after the first page with less than
+    PAGE_SIZE items since that's the last one.
+    Pages requested past the end are discarded, errors included.
+    """
+    pool = ThreadPoolExecutor(max_workers=max(jobs, 1))
+    pending = deque()
+    following = start
+    try:
+        while True:
+            while len(pending) < max(jobs, 1):
+                pending.append(pool.submit(fetch, following))
+                following += 1
+            data = pending.popleft().result()
+            yield data
+            if len(data) < settings.PAGE_SIZE:
+                return
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+
+def _info(part: Path) -> Path:
+    """What identifies the file being downloaded into `part`, to resume it safely"""
+    return part.with_name(part.name + ".info")
+
+
+def _total(res) -> Optional[int]:
+    """Size of the whole file from the Content-Range or Content-Length of `res`"""
+    match = re.fullmatch(r"bytes \d+-\d+/(\d+)", res.headers.get("Content-Range", ""))
+    if match:
+        return int(match[1])
+    length = res.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+
+def _save_info(part: Path, res):
+    etag = res.headers.get("ETag")
+    if not etag or etag.startswith("W/"):  # weak ETags can't be used with If-Range
+        etag = None
+    info = {"validator": etag or res.headers.get("Last-Modified"), "length": _total(res)}
+    if info["validator"] is None and info["length"] is None:
+        return  # no way to tell if it changed, it won't be resumed
+    with open(_info(part), "wb") as file:
+        file.write(codec.dumps(info))
+
+
+def _load_info(part: Path) -> Optional[dict]:
+    try:
+        with open(_info(part), "rb") as file:
+            return codec.loads(file.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _discard(part: Path):
+    disk.remove(part)
+    disk.remove(_info(part))
+
+
+def parse_rate(text: str) -> int:
+    """Bytes per second from 500000, 500k, 2M or 1.5G (as in curl's --limit-rate)"""
+    match = _RATE.fullmatch(text.strip())
+    if not match or float(match[1]) <= 0:
+        raise ValueError(f"{text} is not a transfer rate (like 500k or 2M)")
+    return int(float(match[1]) * 1024 ** " kmg".index(match[2].lower() or " "))
+
+
+def probe(session, url: str) -> Optional[int]:
+    """Size of the file at `url` as announced by the server (HEAD), None if unknown"""
+    try:
+        res = session.head(url, allow_redirects=True)
+        return int(res.headers["Content-Length"])
+    except Exception as exc:  # only used to plan, the download itself will tell
+        logger.info("Couldn't get the size of %s: %s", url, exc)
+        return None
+
+
+class Meter:
+    """
+    Progress, throughput and ETA of a group of downloads, reported to the user
+    every PROGRESS_INTERVAL seconds. With a `rate` (bytes/s) the downloads
+    are throttled so that all of them together stay under it.
+    Safe to share between the transfer workers.
+    """
+
+    def __init__(self, rate: Optional[int] = None):
+        self._lock = threading.Lock()
+        self.reset(rate)
+
+    def reset(self, rate: Optional[int] = None):
+        with self._lock:
+            self.rate = rate
+            self.sizes: Dict[str, int] = {}
+            self.done = 0  # bytes of the files, resumed ones included
+            self.transferred = 0  # bytes that went over the wire
+            self.start = None
+            self.reported = 0.0
+            self.due = 0.0  # when the bytes received so far are allowed by the rate
+
+    def expect(self, url: str, size: Optional[int]):
+        """Count `size` bytes of `url` in the total, unless it was already counted"""
+        if size is not None:
+            with self._lock:
+                self.sizes.setdefault(url, size)
+
+    def skip(self, size: int):
+        """`size` bytes that were already there (resumed downloads) or, if negative, lost"""
+        with self._lock:
+            self.done += size
+
+    def update(self, size: int):
+        """`size` bytes were received. Blocks as long as the rate limit requires"""
+        with self._lock:
+            now = time.monotonic()
+            if self.start is None:
+                self.start = self.reported = now
+            self.done += size
+            self.transferred += size
+            if self.rate:
+                self.due = max(self.due, now) + size / self.rate
+            due = self.due
+            report = now - self.reported >= settings.PROGRESS_INTERVAL
+            if report:
+                self.reported = now
+        if report:
+            self.report()
+        if due > now:
+            time.sleep(due - now)
+
+    def stats(self) -> Dict[str, float]:
+        """Bytes done, the total (as far as it's known), throughput (bytes/s) and ETA (s)"""
+        with self._lock:
+            elapsed = time.monotonic() - self.start if self.start is not None else 0.0
+            total = max(sum(self.sizes.values()), self.done)
+            throughput = self.transferred / elapsed if elapsed > 0 else 0.0
+            eta = (total - self.done) / throughput if throughput else None
+            return {
+                "done": self.done,
+                "total": total,
+                "throughput": throughput,
+                "eta": eta,
+                "elapsed": elapsed,
+            }
+
+    def report(self, final: bool = False):
+        stats = self.stats()
+        if final:
+            if not stats["done"]:
+                return
+            args = (
+                "Downloaded %.1f MB in %.1fs (%.2f MB/s)",
+                stats["done"] / 1e6,
+                stats["elapsed"],
+                stats["throughput"] / 1e6,
+            )
+        else:
+            percent = 100 * stats["done"] / stats["total"] if stats["total"] else 100
+            eta = f"{stats['eta']:.0f}s" if stats["eta"] is not None else "?"
+            args = (
+                "Downloaded %.1f/%.1f MB (%d%%) at %.2f MB/s, ETA %s",
+                stats["done"] / 1e6,
+                stats["total"] / 1e6,
+                percent,
+                stats["throughput"] / 1e6,
+                eta,
+            )
+        logger.info(*args)
+        logger_user.info(*args)
+
+
+def download(session, url: str, part: Path, meter: Meter = None) -> Optional[str]:
+    """
+    Stream `url` into `part` in chunks, hashing it on the way.
+    If `part` already has data (an interrupted download) only the rest is requested
+    with a Range header. Connections that drop mid-transfer are resumed the same way.
+    The ETag (or Last-Modified) and size of the file are kept next to `part` and sent
+    as If-Range, so a file that changed on the server is downloaded again from the start.
+    The progress is counted (and throttled) by `meter`.
+
+    Returns the sha256 of the file or None if the server refused to send it.
+    """
+    import requests  # pylint: disable=C0415 # slow, keep it off the startup path
+
+    counted = 0  # bytes of this file in the meter
+    for attempt in range(settings.RETRIES + 1):
+        digest = hashlib.sha256()
+        offset = part.stat().st_size if part.exists() else 0
+        info = _load_info(part) if offset else None
+        headers = {}
+        if info is not None:
+            headers["Range"] = f"bytes={offset}-"
+            if info["validator"]:
+                headers["If-Range"] = info["validator"]
+        else:
+            offset = 0  # unknown origin, start over
+        try:
+            res = session.get(url, stream=True, headers=headers)
+        except requests.exceptions.HTTPError as exc:
+            if offset and exc.response is not None and exc.response.status_code == 416:
+                # what we have doesn't match the file anymore
+                _discard(part)
+                continue
+            raise
+        with res:
+            if not res.ok:
+                return None
+            resumed = bool(offset) and res.status_code == 206
+            if resumed and (
+                not res.headers.get("Content-Range", "").startswith(f"bytes {offset}-")
+                or info["length"] not in (None, _total(res))
+            ):
+                logger.warning("%s changed since the download started. Starting over...", url)
+                _discard(part)
+                continue
+            if resumed:
+                logger.info("Resuming %s from byte %d", url, offset)
+                disk.hash_file(part, digest)
+            elif res.status_code == 206:
+                _discard(part)  # a range we didn't ask for
+                continue
+            else:
+                _save_info(part, res)
+            if meter:
+                length = res.headers.get("Content-Length")
+                if length and length.isdigit():
+                    meter.expect(url, int(length) + (offset if resumed else 0))
+                meter.skip((offset if resumed else 0) - counted)
+                counted = offset if resumed else 0
+            try:
+                with open(part, "ab" if resumed else "wb") as file:
+                    for chunk in res.iter_content(settings.CHUNK_SIZE):
+                        digest.update(chunk)
+                        file.write(chunk)
+                        if meter:
+                            meter.update(len(chunk))
+                            counted += len(chunk)
+            except (
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.ConnectionError,
+            ) as exc:
+                if attempt == settings.RETRIES:
+                    raise
+                logger.warning("Download of %s interrupted (%s). Resuming...", url, exc)
+                continue
+        disk.remove(_info(part))
+        return digest.hexdigest()
+    return None
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import time
+import unittest
+
+from cpm.cache import MetadataCache
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = MetadataCache(self.dir.name, ttl=60, max_bytes=10000)
+        self.pkg = {
+            "name": "remilia",
+            "deps": [],
+            "date_updated": "2022-08-02T10:00:00",
+        }
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_put_load(self):
+        self.cache.put("remilia", self.pkg, {"ETag": '"abc"'})
+        entry = self.cache.load("remilia")
+
+        self.assertTrue(self.cache.fresh(entry))
+        self.assertEqual(self.cache.hit("remilia", entry), self.pkg)
+        self.assertEqual(self.cache.validators(entry), {"If-None-Match": '"abc"'})
+        self.assertEqual(self.cache.stats["hits"], 1)
+
+    def test_expired(self):
+        self.cache.put("remilia", self.pkg)
+        entry = self.cache.load("remilia")
+        self.cache.ttl = 0
+
+        self.assertFalse(self.cache.fresh(entry))
+        # no validators from the server, fall back to date_updated
+        self.assertEqual(
+            self.cache.validators(entry),
+            {"If-Modified-Since": "Tue, 02 Aug 2022 10:00:00 GMT"},
+        )
+        self.cache.revalidated("remilia", entry)
+        self.assertEqual(self.cache.stats["revalidated"], 1)
+
+    def test_disabled(self):
+        self.cache.enabled = False
+        self.cache.put("remilia", self.pkg)
+
+        self.assertIsNone(self.cache.load("remilia"))
+        self.assertFalse(os.path.exists(self.cache._file("remilia")))
+
+    def test_evict(self):
+        self.cache.put("remilia", self.pkg)
+        old = time.time() - 100
+        os.utime(self.cache._file("remilia"), (old, old))
+        self.cache.max_bytes = os.path.getsize(self.cache._file("remilia")) + 10
+
+        self.cache.put("sakuya", dict(self.pkg, name="sakuya"))
+
+        self.assertIsNone(self.cache.load("remilia"))
+        self.assertIsNotNone(self.cache.load("sakuya"))
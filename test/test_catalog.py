@@ -0,0 +1,59 @@
+import unittest
+from unittest.mock import Mock
+
+from cpm.catalog import Catalog
+
+
+def item(name, desc="", tags=(), date="2022-08-02"):
+    return {"name": name, "desc": desc, "tags": list(tags), "date_updated": date}
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.catalog = Catalog(":memory:")
+        self.catalog.update(
+            [
+                item("Hakurei Reimu", "Shrine maiden of paradise", ["touhou", "character"]),
+                item("Kirisame Marisa", "Ordinary magician", ["touhou", "character"]),
+                item("gensokio", "The land of fantasy. Home of Reimu", ["touhou", "setting"]),
+            ]
+        )
+
+    def tearDown(self):
+        self.catalog.close()
+
+    def names(self, *args, **kwargs):
+        return [data["name"] for data in self.catalog.search(*args, **kwargs)]
+
+    def test_search(self):
+        self.assertEqual(self.names(name="reim"), ["Hakurei Reimu"])
+        # the name is the most relevant match
+        self.assertEqual(self.names("reimu"), ["Hakurei Reimu", "gensokio"])
+        self.assertEqual(
+            self.names(tags=["touhou", "character"]), ["Hakurei Reimu", "Kirisame Marisa"]
+        )
+        self.assertEqual(self.names("reimu", tags=["setting"]), ["gensokio"])
+        self.assertEqual(self.names('"; DROP TABLE'), [])
+
+    def test_update_incremental(self):
+        written, removed = self.catalog.update(
+            [
+                item("Hakurei Reimu", "Shrine maiden of paradise", ["touhou", "character"]),
+                item("Kirisame Marisa", "Human magician", ["touhou"], "2022-08-03"),
+            ]
+        )
+
+        self.assertEqual((written, removed), (1, 1))
+        self.assertEqual(self.names("human"), ["Kirisame Marisa"])
+        self.assertEqual(self.names(tags=["setting"]), [])
+
+    def test_sync(self):
+        client = Mock()
+        client.list_item.side_effect = [
+            [item(f"card {n}") for n in range(10)],
+            [item("card 10")],
+        ]
+        self.catalog.sync(client)
+
+        self.assertEqual(len(self.catalog), 11)
+        self.assertEqual(client.list_item.call_count, 2)
@@ -0,0 +1,113 @@
+import atexit
+import tempfile
+import unittest
+from unittest.mock import patch, Mock
+
+from cpm import client, codec, metrics
+from cpm.cache import MetadataCache
+from cpm.endpoints import Endpoints
+
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        patcher = patch.object(client, "METRICS", metrics.Metrics())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with patch.object(client.settings, "DEBUG", True):
+            self.client = client.Client()
+        atexit.unregister(self.client._report)
+        self.client.cache = MetadataCache(self.dir.name)
+        self.client.get = Mock(side_effect=self.get)
+        self.client.post = Mock()
+
+    def tearDown(self):
+        self.client.close()
+        self.dir.cleanup()
+
+    def get(self, url, headers=None):
+        name = url[len(self.client.URL) :]
+        return Mock(status_code=200, headers={}, content=codec.dumps({"name": name}))
+
+    def test_get_items(self):
+        res = self.client.get_items(["remilia", "sakuya", "remilia"], jobs=4)
+
+        self.assertEqual(res, {"remilia": {"name": "remilia"}, "sakuya": {"name": "sakuya"}})
+        self.assertEqual(self.client.get.call_count, 2)
+
+        # cached now
+        self.client.get_items(["remilia", "sakuya"])
+        self.assertEqual(self.client.get.call_count, 2)
+
+    def test_get_items_order(self):
+        self.client.get_items(["sakuya"])
+
+        res = self.client.get_items(["remilia", "sakuya", "patchouli"], jobs=1)
+
+        # sakuya came from the cache, but keeps its place
+        self.assertEqual(list(res), ["remilia", "sakuya", "patchouli"])
+
+    def test_get_items_bulk(self):
+        self.client.bulk = True
+        self.client.post.return_value.content = codec.dumps([{"name": "remilia"}])
+
+        res = self.client.get_items(["remilia", "sakuya"])
+
+        self.client.post.assert_called_once_with(
+            self.client.BULK_URL,
+            data=b'{"names":["remilia","sakuya"]}',
+            headers={"Content-Type": "application/json"},
+        )
+        # the server didn't know about sakuya, ask again
+        self.assertEqual(res["sakuya"], {"name": "sakuya"})
+        self.assertEqual(self.client.get.call_count, 1)
+
+    def test_writes_to_primary(self):
+        # the mirror answers faster but is read-only
+        self.client.endpoints = Endpoints(["https://main.host/", "http://mirror.lan/"])
+        self.client.endpoints.latency = {"https://main.host/": 0.3, "http://mirror.lan/": 0.01}
+        self.client.endpoints._apply()
+        self.client.post.return_value.content = codec.dumps({"name": "remilia", "tags": ["a"]})
+        self.assertEqual(self.client.URL, "http://mirror.lan/")
+
+        self.client.create_item({"name": "remilia"})
+        self.assertEqual(self.client.post.call_args.args[0], "https://main.host/")
+        self.client.update_item({"tags": ["a"]}, "remilia")
+        self.assertEqual(self.client.post.call_args.args[0], "https://main.host/remilia")
+
+    def test_loggedmethod_kwargs(self):
+        res = self.client.get_items(names=["remilia"], jobs=1)
+
+        self.assertEqual(res, {"remilia": {"name": "remilia"}})
+
+
+class TestFiles(unittest.TestCase):
+    def test_sessions(self):
+        with patch.object(client, "METRICS", metrics.Metrics()):
+            files = client.Files(size=2)
+            atexit.unregister(client.METRICS.save)
+        self.addCleanup(files.close)
+
+        catbox = files.session("https://files.catbox.moe/a.png")
+        self.assertIs(files.session("https://files.catbox.moe/b.png"), catbox)
+        self.assertIsNot(files.session("https://i.imgur.com/c.png"), catbox)
+        # third parties never see the API key
+        self.assertNotIn("Authorization", catbox.headers)
+
+        files.mount_pools(8)
+        adapter = catbox.get_adapter("https://files.catbox.moe/")
+        self.assertEqual(adapter._pool_maxsize, 8)
+        self.assertEqual(files.session("https://new.host/d").pool_size, 8)
+
+    def test_timeout(self):
+        with patch.object(client, "METRICS", metrics.Metrics()):
+            files = client.Files(size=1)
+            atexit.unregister(client.METRICS.save)
+            self.addCleanup(files.close)
+            session = files.session("https://files.catbox.moe/a.png")
+            with patch("requests.Session.request") as request:
+                session.get("https://files.catbox.moe/a.png")
+                session.get("https://files.catbox.moe/a.png", timeout=1)
+
+        self.assertEqual(request.call_args_list[0].kwargs["timeout"], client.settings.TIMEOUT)
+        self.assertEqual(request.call_args_list[1].kwargs["timeout"], 1)
@@ -0,0 +1,33 @@
+import json
+import unittest
+
+from cpm import codec
+
+
+class TestCodec(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(codec.use, codec.BACKEND)
+        self.data = {"name": "remilia", "tags": ["vampire", "é"], "n": 1.5, "ok": None}
+
+    def test_backends_agree(self):
+        outputs = set()
+        for name in codec.BACKENDS:
+            codec.use(name)
+            text = codec.dumps(self.data)
+            self.assertIsInstance(text, bytes)
+            self.assertEqual(codec.loads(text), self.data)
+            self.assertEqual(codec.loads(text.decode("utf-8")), self.data)
+            outputs.add(codec.dumps(self.data, sort_keys=True))
+        self.assertEqual(len(outputs), 1)
+
+    def test_fallback(self):
+        for name in codec.BACKENDS:
+            codec.use(name)
+            self.assertEqual(codec.loads(codec.dumps({"big": 2**70})), {"big": 2**70})
+            self.assertTrue(codec.loads(b"[NaN]")[0] != codec.loads(b"[NaN]")[0])
+            with self.assertRaises(json.JSONDecodeError):
+                codec.loads(b'{"a": }')
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            codec.use("simplejson")
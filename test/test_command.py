@@ -1,7 +1,13 @@
+import os
+import tempfile
 import unittest
-from unittest.mock import patch, Mock, mock_open
+from unittest.mock import patch, Mock, MagicMock, mock_open
+import zipfile
 
 from cpm import command
+from cpm.lazy import lazy_import
+
+package = command._package  # mocked below
 
 
 class TestCommand(unittest.TestCase):
@@ -11,10 +17,17 @@ class TestCommand(unittest.TestCase):
         self.mock_input = command.input
         command.client = Mock()
         self.mock_client = command.client
+        command.files = Mock()
+        self.mock_files = command.files
+        command.store = MagicMock()
+        command.store.lookup.return_value = None
+        self.mock_store = command.store
+        patcher = patch.object(command.transfer, "download", return_value="digest")
+        self.mock_download = patcher.start()
+        self.addCleanup(patcher.stop)
 
         command.open = mock_open()
         self.open = command.open
-        command.json.load = Mock()
         command.yaml = Mock()
 
         # mocking zipfile is more trouble than what is
@@ -42,40 +55,212 @@ class TestCommand(unittest.TestCase):
             return self.pkg
 
         command.client.get_item = test_items
+        command.client.get_items = lambda names, jobs=None: {
+            name: command.client.get_item(name) for name in names
+        }
 
     def tearDown(self):
         pass
 
     def test_dump_file(self):
-        res = command._dump_file(self.image_url, self.image_name)
+        res = command._dump_file(self.image_url)
+
+        self.mock_download.assert_called_with(
+            self.mock_files,
+            self.image_url,
+            self.mock_store.partial.return_value,
+            command.meter,
+        )
+        # nothing is written outside of the store
+        assert not self.open.called
+        self.assertEqual(res, self.mock_store.commit.return_value)
+
+    def test_dump_file_stored(self):
+        self.mock_store.lookup.return_value = "blob"
+        res = command._dump_file(self.image_url)
 
-        self.open.assert_called()
-        self.mock_client.get.assert_called()
+        assert not self.mock_download.called
+        self.assertEqual(res, "blob")
 
-        self.assertEqual(res._mock_name, self.mock_client.content._mock_name)
+    def test_dump_file_failed(self):
+        self.mock_download.return_value = None
+        res = command._dump_file(self.image_url)
+
+        assert not self.mock_store.commit.called
+        assert not res
 
     def test_dump_file_bad_url(self):
-        res = command._dump_file(
-            self.image_url.replace("https", "fpt"), self.image_name
-        )
+        res = command._dump_file(self.image_url.replace("https", "fpt"))
 
         assert not self.open.called
         assert not self.mock_client.get.called
+        assert not self.mock_download.called
 
         assert not res
 
     def test_download_low(self):
-        res = command._download(self.pkg)
+        res = command._download(["remilia"])
 
-        # the test package doesn't have an image url, therefore
-        # 1 call to dump the json
-        # 1 call to dump the file
-        # 2 * (parent + dependencies)
-        self.assertEqual(self.open.call_count, 2 * (1 + len(self.pkg["deps"])))
+        # files are streamed into the store and zipped from there
+        assert not self.open.called
+        self.assertEqual(self.mock_download.call_count, 1 + len(self.pkg["deps"]))
+        self.assertEqual(command._package.call_count, 1 + len(self.pkg["deps"]))
+        entries, filename = command._package.call_args_list[0].args
+        self.assertEqual(filename, "remilia.zip")
+        self.assertEqual(
+            [name for name, _ in entries], ["remilia.lorebook", "remilia.json"]
+        )
         self.assertEqual(set((self.pkg["name"], *self.pkg["deps"])), res.keys())
         for el in res.values():
-            # they are all the return value of res.content
-            self.assertEqual(el._mock_name, self.mock_client.content._mock_name)
+            # they are all paths in the store
+            self.assertEqual(el, self.mock_store.commit.return_value)
+
+    def test_download_order(self):
+        # the order of the packages must not depend on the number of workers
+        graph = {
+            "remilia": ["gensokio", "scarlet devil mansion"],
+            "gensokio": ["hakurei shrine"],
+            "scarlet devil mansion": ["gensokio", "sakuya"],
+            "hakurei shrine": [],
+            "sakuya": ["remilia"],
+        }
+
+        def test_items(name):
+            return {"name": name, "file": "", "image": "", "deps": graph[name]}
+
+        command.client.get_item = test_items
+        command.client.get_items = lambda names, jobs=None: {
+            name: command.client.get_item(name) for name in names
+        }
+        serial = command._download(["remilia"], jobs=1)
+        parallel = command._download(["remilia"], jobs=4)
+
+        self.assertEqual(
+            list(serial),
+            ["remilia", "gensokio", "hakurei shrine", "scarlet devil mansion", "sakuya"],
+        )
+        self.assertEqual(list(serial), list(parallel))
+
+    def test_download_names(self):
+        # the server has its own spelling of "sakuya"
+        self.pkg["deps"] = ["sakuya"]
+        def test_items(name):
+            return dict(self.pkg, name="Sakuya Izayoi", deps=[]) if name == "sakuya" else self.pkg
+
+        command.client.get_item = test_items
+        self.mock_store.digest.return_value = "digest"
+        with tempfile.TemporaryDirectory() as tmp:
+            lockfile = command.Lockfile(os.path.join(tmp, "cpm.lock"))
+            res = command._download(["remilia"], lockfile=lockfile)
+            lockfile.save(["remilia"], res)
+
+            self.assertEqual(list(res), ["remilia", "sakuya"])
+            self.assertEqual(list(lockfile.packages), ["remilia", "sakuya"])
+            self.assertEqual(command._download_frozen(["remilia"], lockfile).keys(), res.keys())
+
+    def test_largest_first(self):
+        sizes = {"https://a.com/small": 10, "https://a.com/big": 1000, "https://a.com/img": 500}
+        command.files.head = lambda url, **kwargs: Mock(
+            headers={"Content-Length": str(sizes[url])}
+        )
+        metadata = {
+            "small": {"image": "", "file": "https://a.com/small"},
+            "big": {"image": "", "file": "https://a.com/big"},
+            "medium": {"image": "https://a.com/img", "file": "https://a.com/small"},
+            "empty": {"image": "", "file": ""},
+        }
+
+        order = command._largest_first(metadata, jobs=2)
+
+        self.assertEqual(order, ["big", "medium", "small", "empty"])
+
+    def test_package(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            image = os.path.join(tmp, "blob")
+            with open(image, "wb") as file:
+                file.write(b"\x89PNG" * 100)
+            filename = os.path.join(tmp, "remilia.zip")
+
+            package(
+                [("remilia.png", image), ("remilia.json", b'{"name": "remilia"}')],
+                filename,
+            )
+
+            with zipfile.ZipFile(filename) as zfile:
+                png, data = zfile.infolist()
+                self.assertEqual(png.compress_type, zipfile.ZIP_STORED)
+                self.assertEqual(data.compress_type, zipfile.ZIP_DEFLATED)
+                self.assertEqual(zfile.read("remilia.png"), b"\x89PNG" * 100)
+            # no leftovers
+            self.assertEqual(sorted(os.listdir(tmp)), ["blob", "remilia.zip"])
+
+    def cards(self, tmp):
+        with open(os.path.join(tmp, "remilia.yaml"), "w") as file:
+            file.write("name: remilia\ntags: vampire, scarlet\nfile: https://a.com/r\n")
+        with open(os.path.join(tmp, "maids.yml"), "w") as file:
+            file.write("name: sakuya\n---\nname: meiling\ndeps: [sakuya]\n")
+        with open(os.path.join(tmp, "notes.txt"), "w") as file:
+            file.write("not a card")
+
+    def test_documents(self):
+        command.yaml = lazy_import("yaml")
+        del command.open
+        with tempfile.TemporaryDirectory() as tmp:
+            self.cards(tmp)
+            documents = command._documents(tmp)
+
+        self.assertEqual(
+            [os.path.basename(label) for label, _ in documents],
+            ["maids.yml#1", "maids.yml#2", "remilia.yaml"],
+        )
+        items, errors = command._validate(documents)
+        self.assertEqual(errors, [])
+        self.assertEqual(list(items), ["sakuya", "meiling", "remilia"])
+        self.assertEqual(items["remilia"]["tags"], ["vampire", "scarlet"])
+
+    def test_validate(self):
+        _, errors = command._validate(
+            [
+                ("a", {"name": "remilia", "colour": "red"}),
+                ("b", {"name": "sakuya", "deps": 3}),
+                ("c", {"desc": "no name"}),
+                ("d", {"name": "remilia"}),
+                ("e", ["not", "a", "mapping"]),
+            ]
+        )
+        self.assertEqual(
+            errors,
+            [
+                "a: unknown key colour",
+                "b: deps should be a list",
+                "c: the name is missing",
+                "d: remilia is repeated",
+                "e: not a mapping",
+            ],
+        )
+
+    def test_publish(self):
+        busy = Exception("busy")
+        busy.response = Mock(status_code=503)
+        bad = Exception("bad")
+        bad.response = Mock(status_code=400)
+        answers = {"remilia": [busy, {"name": "remilia"}], "sakuya": [bad, bad]}
+
+        def send(name, data):
+            answer = answers[name].pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        results = command._publish(
+            {"remilia": {}, "sakuya": {}}, send, jobs=2, retries=2
+        )
+
+        self.assertEqual(results["remilia"], (2, {"name": "remilia"}))
+        # rejected by the server, not sent again
+        self.assertEqual(results["sakuya"], (1, bad))
+        with self.assertRaises(SystemExit):
+            command._summary(results)
 
     def test_get_data(self):
         # Here we rely on the fact that lists are mutable in Python
@@ -96,14 +281,3 @@ class TestCommand(unittest.TestCase):
         command.yaml.safe_load = Mock(return_value=self.pkg)
         data = command._get_data("mock.yaml")
         self.assertEqual(data, self.pkg)
-
-    def test_compile(self):
-        template = {"entries": [], "categories": []}
-        packages = {
-            "remlia": '{"entries": ["dummy_entry"], "categories": []}',
-            "sakuya": '{"entries": ["dummy_entry2"], "categories": ["dummy_category"]}',
-        }
-        res = command._compile(template, packages)
-
-        self.assertEqual(len(res["entries"]), 2, res["entries"])
-        self.assertEqual(len(res["categories"]), 1, res["categories"])
@@ -0,0 +1,211 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from cpm import compiler
+
+
+class TestCompiler(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def lorebook(self, name, content):
+        path = os.path.join(self.dir.name, name)
+        with open(path, "w") as file:
+            file.write(content if isinstance(content, str) else json.dumps(content, indent=4))
+        return path
+
+    def test_compile(self):
+        template = self.lorebook(
+            "template.lorebook",
+            {"lorebookVersion": 4, "entries": [], "settings": {}, "categories": []},
+        )
+        packages = [
+            self.lorebook("remlia.lorebook", {"entries": ["dummy_entry"], "categories": []}),
+            self.lorebook(
+                "sakuya.lorebook",
+                {"entries": ["dummy_entry2"], "categories": ["dummy_category"]},
+            ),
+        ]
+        out = io.BytesIO()
+        counts = compiler.compile_lorebooks(template, packages, out)
+        res = json.loads(out.getvalue())
+
+        self.assertEqual(list(res), ["lorebookVersion", "entries", "settings", "categories"])
+        self.assertEqual(res["entries"], ["dummy_entry", "dummy_entry2"])
+        self.assertEqual(res["categories"], ["dummy_category"])
+        self.assertEqual(counts, {"entries": 2, "categories": 1})
+
+    def test_small_chunks(self):
+        lore = {
+            "entries": [
+                {"text": 'say "hi" \\ {not a [bracket', "keys": ["a", str(n)], "n": 12345}
+                for n in range(50)
+            ],
+            "categories": [{"name": "c", "n": -1.5e3, "ok": True, "none": None}],
+        }
+        path = self.lorebook("lore.lorebook", lore)
+        out = io.BytesIO()
+        with patch.object(compiler.settings, "CHUNK_SIZE", 7):
+            compiler.compile_lorebooks(path, [path], out)
+
+        self.assertEqual(json.loads(out.getvalue()), lore)
+
+    def test_malformed(self):
+        path = self.lorebook(
+            "broken.lorebook",
+            '{\n  "entries": [\n    {"text": "a"},\n    {"text": "b",}\n  ],\n  "categories": []\n}',
+        )
+        with self.assertRaises(compiler.CompileError) as exc:
+            compiler.compile_lorebooks(path, [path], io.BytesIO())
+        self.assertIn("broken.lorebook:4:", str(exc.exception))
+
+    def test_truncated(self):
+        path = self.lorebook("truncated.lorebook", '{"entries": [{"text": "a"}, {"te')
+        with self.assertRaises(compiler.CompileError):
+            compiler.compile_lorebooks(path, [path], io.BytesIO())
+
+    def test_compile_file_no_output_on_error(self):
+        path = self.lorebook("broken.lorebook", '{"entries": [1 2]}')
+        out = os.path.join(self.dir.name, "compiled.lorebook")
+        with self.assertRaises(compiler.CompileError):
+            compiler.compile_file(path, [path], out)
+        self.assertFalse(os.path.exists(out))
+        self.assertFalse(os.path.exists(out + ".part"))
+
+    def test_compile_file_keeps_the_error(self):
+        path = self.lorebook("lore.lorebook", {"entries": [1]})
+        out = os.path.join(self.dir.name, "compiled.lorebook")
+
+        def fail(*args):
+            os.remove(out + ".part")  # gone already (another process, the user...)
+            raise compiler.CompileError("broken")
+
+        with patch.object(compiler, "compile_lorebooks", fail):
+            with self.assertRaises(compiler.CompileError):
+                compiler.compile_file(path, [path], out)
+
+    def test_fragment_cache(self):
+        cache = compiler.FragmentCache(os.path.join(self.dir.name, "fragments"))
+        template = self.lorebook("template.lorebook", {"lorebookVersion": 4, "entries": []})
+        packages = [
+            self.lorebook(f"{n}.lorebook", {"entries": [n], "categories": [{"name": n}]})
+            for n in ("remilia", "sakuya", "patchouli")
+        ]
+        out = io.BytesIO()
+        compiler.compile_lorebooks(template, [template, *packages], out, cache)
+        first = json.loads(out.getvalue())
+        self.assertEqual(cache.stats, {"hits": 0, "misses": 4})
+
+        # only the lorebook that changed is parsed again
+        self.lorebook("sakuya.lorebook", {"entries": ["maid"], "categories": []})
+        out = io.BytesIO()
+        counts = compiler.compile_lorebooks(template, [template, *packages], out, cache)
+        second = json.loads(out.getvalue())
+        self.assertEqual(cache.stats, {"hits": 3, "misses": 4 + 1})
+
+        self.assertEqual(first["entries"], ["remilia", "sakuya", "patchouli"])
+        self.assertEqual(second["entries"], ["remilia", "maid", "patchouli"])
+        self.assertEqual(second["categories"], [{"name": "remilia"}, {"name": "patchouli"}])
+        self.assertEqual(list(second), ["lorebookVersion", "entries", "categories"])
+        self.assertEqual(counts, {"entries": 3, "categories": 2})
+
+    def test_fragment_cache_gc(self):
+        cache = compiler.FragmentCache(os.path.join(self.dir.name, "fragments"), max_bytes=1)
+        path = self.lorebook("lore.lorebook", {"entries": [1, 2, 3]})
+        compiler.compile_lorebooks(path, [path], io.BytesIO(), cache)
+        cache.gc()
+        self.assertEqual(list(cache.path.glob("??/*")), [])
+
+    def merge(self, lorebooks, policy="first"):
+        paths = [
+            self.lorebook(f"{index}.lorebook", lorebook)
+            for index, lorebook in enumerate(lorebooks)
+        ]
+        out = io.BytesIO()
+        compiler.compile_lorebooks(paths[0], paths, out, policy=policy)
+        return json.loads(out.getvalue())
+
+    def test_dedupe(self):
+        entry = {"id": "1", "keys": ["remilia"], "text": "vampire"}
+        root = {"entries": [entry], "categories": [{"id": "a", "name": "scarlet"}]}
+        copy = {"entries": [dict(entry, id="2")], "categories": [{"id": "b", "name": "scarlet"}]}
+
+        res = self.merge([root, root, copy])
+
+        self.assertEqual(res["entries"], [entry])
+        self.assertEqual(res["categories"], [{"id": "a", "name": "scarlet"}])
+
+    def test_merge_categories(self):
+        root = {
+            "entries": [{"keys": ["remilia"], "category": "a"}],
+            "categories": [{"id": "a", "name": "scarlet", "enabled": True}],
+        }
+        other = {
+            "entries": [{"keys": ["sakuya"], "category": "b"}],
+            "categories": [{"id": "b", "name": "scarlet", "enabled": False, "open": True}],
+        }
+
+        first = self.merge([root, other])
+        last = self.merge([root, other], "last")
+
+        self.assertEqual(
+            first["categories"], [{"id": "a", "name": "scarlet", "enabled": True, "open": True}]
+        )
+        self.assertEqual(last["categories"][0]["enabled"], False)
+        # the entries follow their category
+        self.assertEqual([entry["category"] for entry in first["entries"]], ["a", "a"])
+
+    def test_conflicts(self):
+        root = {"entries": [{"keys": ["remilia", "vampire"], "text": "a"}, {"keys": [], "text": "x"}]}
+        other = {"entries": [{"keys": ["vampire", "remilia"], "text": "b"}, {"keys": [], "text": "y"}]}
+
+        first = self.merge([root, other])
+        last = self.merge([root, other], "last")
+
+        self.assertEqual([entry["text"] for entry in first["entries"]], ["a", "x", "y"])
+        self.assertEqual([entry["text"] for entry in last["entries"]], ["b", "x", "y"])
+        with self.assertRaises(compiler.CompileError) as exc:
+            self.merge([root, other], "report")
+        self.assertIn("1 conflicts", str(exc.exception))
+
+    def test_same_keys_in_one_lorebook(self):
+        root = {"entries": [{"keys": ["reimu"], "text": "a"}, {"keys": ["reimu"], "text": "b"}]}
+
+        for policy in compiler.POLICIES:
+            res = self.merge([root], policy)
+            self.assertEqual([entry["text"] for entry in res["entries"]], ["a", "b"])
+
+    def test_workers(self):
+        paths = [
+            self.lorebook(
+                f"{n}.lorebook",
+                {
+                    "lorebookVersion": 4,
+                    "entries": [{"keys": [str(n), str(i)], "text": "x"} for i in range(20)],
+                    "categories": [{"name": "shared", "n": n}],
+                },
+            )
+            for n in range(5)
+        ]
+        serial = io.BytesIO()
+        parallel = io.BytesIO()
+        compiler.compile_lorebooks(paths[0], paths, serial)
+        cache = compiler.FragmentCache(os.path.join(self.dir.name, "fragments"))
+        compiler.compile_lorebooks(paths[0], paths, parallel, cache, workers=3)
+
+        self.assertEqual(serial.getvalue(), parallel.getvalue())
+        self.assertEqual(cache.stats, {"hits": 0, "misses": 5})
+
+    def test_workers_error(self):
+        good = self.lorebook("good.lorebook", {"entries": [1]})
+        broken = self.lorebook("broken.lorebook", '{"entries": [1 2]}')
+        with self.assertRaises(compiler.CompileError) as exc:
+            compiler.compile_lorebooks(good, [good, broken], io.BytesIO(), workers=2)
+        self.assertIn("broken.lorebook:1:", str(exc.exception))
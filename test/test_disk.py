@@ -0,0 +1,39 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from cpm import disk
+
+
+class TestDisk(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, name, size, mtime):
+        file = self.path / name
+        file.write_bytes(b"x" * size)
+        os.utime(file, (mtime, mtime))
+        return file
+
+    def test_file_digest(self):
+        self.assertIsNone(disk.file_digest(self.path / "missing"))
+        file = self.write("a", 10, 1)
+        self.assertEqual(disk.file_digest(file), hashlib.sha256(b"x" * 10).hexdigest())
+
+    def test_evict(self):
+        old = self.write("old", 40, 1)
+        kept = self.write("kept", 40, 2)
+        new = self.write("new", 40, 3)
+
+        removed = disk.evict(self.path.glob("*"), 50, lambda file: file.name == "kept")
+
+        # the oldest that isn't kept goes first
+        self.assertEqual(removed, [old, new])
+        self.assertEqual(list(self.path.iterdir()), [kept])
+        self.assertEqual(disk.evict(self.path.glob("*"), 50), [])
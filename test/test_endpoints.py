@@ -0,0 +1,53 @@
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from cpm import endpoints
+from cpm.endpoints import Endpoints
+
+URLS = ["https://main.host/", "https://mirror.host/", "http://lan.host/"]
+
+
+class TestEndpoints(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = f"{self.dir.name}/endpoints.json"
+        self.latency = {URLS[0]: 0.3, URLS[1]: None, URLS[2]: 0.01}
+        patcher = patch.object(endpoints, "probe", side_effect=self.latency.get)
+        self.probe = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rank(self):
+        urls = Endpoints(URLS, self.path)
+        self.assertEqual(urls.current, URLS[0])  # configured order until probed
+
+        urls.rank()
+
+        self.assertEqual(urls.ranked, [URLS[2], URLS[0], URLS[1]])
+        self.assertEqual(urls.current, URLS[2])
+        self.assertEqual(urls.down, {URLS[1]})
+
+    def test_cached(self):
+        Endpoints(URLS, self.path).rank()
+        self.probe.reset_mock()
+
+        urls = Endpoints(URLS, self.path)
+        self.assertTrue(urls.load())
+        self.assertEqual(urls.current, URLS[2])
+        self.probe.assert_not_called()
+        # another set of endpoints has its own ranking
+        self.assertFalse(Endpoints(URLS[:2], self.path).load())
+
+    def test_failover(self):
+        urls = Endpoints(URLS, self.path)
+        urls.rank()
+
+        self.assertEqual(urls.failover("http://lan.host/remilia"), "https://main.host/remilia")
+        self.assertEqual(urls.current, URLS[0])
+        # nothing left
+        self.assertIsNone(urls.failover("https://main.host/remilia"))
+        self.assertIsNone(urls.failover("https://files.catbox.moe/a.png"))
+        # a new ranking brings them back
+        urls.rank()
+        self.assertEqual(urls.current, URLS[2])
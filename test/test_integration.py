@@ -0,0 +1,212 @@
+import json
+import os
+import shutil
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import zipfile
+
+import requests
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT / "bench"))
+
+from server import Repository, graph, serve  # pylint: disable=C0413,E0401
+
+from cpm import server  # pylint: disable=C0413
+
+
+class TestIntegration(unittest.TestCase):
+    """The CLI against the stand-in server of the benchmarks"""
+
+    def setUp(self):
+        self.repo = Repository()
+        self.server = serve(self.repo)
+        self.dir = tempfile.TemporaryDirectory()
+        self.env = dict(
+            os.environ,
+            PYTHONPATH=str(ROOT / "src"),
+            CPM_URL=self.repo.url,
+            CPM_CACHE_DIR=os.path.join(self.dir.name, "cache"),
+        )
+        self.env.pop("CPM_DEBUG", None)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
+
+    def cpm(self, *argv, script=False):
+        """Run the CLI as `python -m cpm` or, with `script`, through the installed script"""
+        command = [str(ROOT / "cpm")] if script else ["-m", "cpm"]
+        return subprocess.run(
+            [sys.executable, *command, *argv],
+            env=self.env,
+            cwd=self.dir.name,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+
+    def test_compile(self):
+        root = graph(self.repo, "diamond", 3, entries=2, image=100)
+        self.cpm("compile", root, "--jobs", "4")
+
+        files = sorted(path.name for path in Path(self.dir.name).glob("*.zip"))
+        self.assertEqual(files, ["base.zip", "middle 0.zip", "middle 1.zip", "middle 2.zip", "root.zip"])
+        # nothing but the archives, the output and the cache
+        others = {path.name for path in Path(self.dir.name).iterdir()} - set(files)
+        self.assertEqual(others, {"compiled.lorebook", "cache", "cpm.lock"})
+        with open(os.path.join(self.dir.name, "compiled.lorebook")) as file:
+            compiled = json.load(file)
+        self.assertEqual(compiled["lorebookVersion"], 4)
+        # one per package, the root isn't repeated
+        self.assertEqual(len(compiled["categories"]), 5)
+        self.assertEqual(len(compiled["entries"]), 5 * 2)
+
+        # everything is cached now
+        self.repo.reset_counters()
+        self.cpm("download", root)
+        self.assertEqual(self.repo.requests, 0)
+
+    def test_compile_workers(self):
+        root = graph(self.repo, "diamond", 2, entries=2, image=100)
+        self.cpm("compile", root, "--workers", "2", script=True)
+
+        with open(os.path.join(self.dir.name, "compiled.lorebook")) as file:
+            compiled = json.load(file)
+        self.assertEqual(len(compiled["entries"]), 4 * 2)
+
+    def test_deps(self):
+        root = graph(self.repo, "diamond", 3, entries=2, image=100)
+        self.repo.reset_counters()
+        out = self.cpm("deps", root, "--json").stdout
+
+        plan = json.loads(out)
+        self.assertEqual(plan["plan"][0], "base")
+        self.assertEqual(plan["plan"][-1], root)
+        self.assertEqual(plan["cycles"], [])
+        # metadata only: the docs and one request per package, no files
+        self.assertEqual(self.repo.requests, 1 + 5)
+        self.assertEqual(list(Path(self.dir.name).glob("*.zip")), [])
+
+        tree = self.cpm("deps", root, "--tree").stdout.splitlines()
+        self.assertEqual(tree[0], root)
+        self.assertEqual(tree.count("        base (*)"), 2)
+
+    def test_lockfile(self):
+        root = graph(self.repo, "wide", 3, entries=2)
+        self.cpm("download", root)
+
+        # only the package that changed is fetched again
+        self.repo.items["leaf 1"]["date_updated"] = "2023-01-01T00:00:00"
+        self.repo.items["leaf 1"]["file"] += "2"
+        self.repo.files["leaf 1.lorebook2"] = self.repo.files["leaf 1.lorebook"].replace(
+            b"lorem", b"ipsum"
+        )
+        shutil.rmtree(os.path.join(self.dir.name, "cache", "meta"))  # stale metadata
+        self.repo.reset_counters()
+        self.cpm("download", root)
+        self.assertEqual(self.repo.requests, 4 + 2)  # metadata + size and lorebook of leaf 1
+
+        with open(os.path.join(self.dir.name, "cpm.lock")) as file:
+            lock = json.load(file)
+        self.assertEqual(lock["roots"], ["root"])
+        self.assertEqual(list(lock["packages"]), ["root", "leaf 0", "leaf 1", "leaf 2"])
+
+        # no metadata requests at all
+        self.repo.reset_counters()
+        os.remove(os.path.join(self.dir.name, "leaf 2.zip"))
+        self.cpm("download", root, "--frozen")
+        self.assertEqual(self.repo.requests, 0)
+        self.assertTrue(os.path.exists(os.path.join(self.dir.name, "leaf 2.zip")))
+
+        # the locked files changed on the server
+        self.repo.files["leaf 0.lorebook"] = b"{}"
+        shutil.rmtree(os.path.join(self.dir.name, "cache", "store"))
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.cpm("download", root, "--frozen")
+
+    def test_updated_in_place(self):
+        root = graph(self.repo, "wide", 2, entries=2)
+        self.cpm("download", root)
+
+        # a new lorebook uploaded to the same url
+        self.repo.items["leaf 1"]["date_updated"] = "2023-01-01T00:00:00"
+        self.repo.files["leaf 1.lorebook"] = self.repo.files["leaf 1.lorebook"].replace(
+            b"lorem", b"dolor"
+        )
+        shutil.rmtree(os.path.join(self.dir.name, "cache", "meta"))  # stale metadata
+        self.cpm("download", root)
+
+        with zipfile.ZipFile(os.path.join(self.dir.name, "leaf 1.zip")) as archive:
+            self.assertNotIn(b"lorem", archive.read("leaf 1.lorebook"))
+
+    def test_bulk_publish(self):
+        cards = os.path.join(self.dir.name, "cards")
+        os.mkdir(cards)
+        with open(os.path.join(cards, "remilia.yaml"), "w") as file:
+            file.write("name: remilia\ntags: vampire\nfile: https://a.com/r\n")
+        with open(os.path.join(cards, "maids.yaml"), "w") as file:
+            file.write("name: sakuya\ntags: maid\n---\nname: meiling\ntags: guard\n")
+
+        res = self.cpm("upload", "--dir", cards, "--jobs", "3")
+        self.assertEqual(res.stdout.count("OK"), 3)
+        self.assertEqual(set(self.repo.items), {"remilia", "sakuya", "meiling"})
+
+        with open(os.path.join(cards, "changes.yaml"), "w") as file:
+            file.write("name: sakuya\ndesc: Head maid\n---\nname: meiling\ndesc: Gatekeeper\n")
+        self.cpm("update", "--file", os.path.join(cards, "changes.yaml"))
+        self.assertEqual(self.repo.items["sakuya"]["desc"], "Head maid")
+        self.assertEqual(self.repo.items["meiling"]["desc"], "Gatekeeper")
+        self.assertEqual(self.repo.items["meiling"]["tags"], ["guard"])
+
+        # nothing is sent if any document is invalid
+        with open(os.path.join(cards, "broken.yaml"), "w") as file:
+            file.write("name: patchouli\ncolour: purple\n")
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.cpm("upload", "--dir", cards)
+        self.assertNotIn("patchouli", self.repo.items)
+
+    def test_mirror(self):
+        root = graph(self.repo, "diamond", 2, entries=2, image=100)
+        mirror_dir = os.path.join(self.dir.name, "mirror")
+        self.cpm("mirror", "--dir", mirror_dir, "--jobs", "2")
+
+        # incremental: nothing to download the second time
+        res = self.cpm("mirror", "--dir", mirror_dir)
+        self.assertIn("0 packages updated, 0 files downloaded", res.stderr)
+
+        local = server.serve(server.Mirror(mirror_dir), "127.0.0.1", 0)
+        threading.Thread(target=local.serve_forever, daemon=True).start()
+        self.addCleanup(local.server_close)
+        self.addCleanup(local.shutdown)
+        self.env["CPM_URL"] = "http://127.0.0.1:%d/" % local.server_address[1]
+
+        for query, status in (("page=0", 200), ("page=", 400), ("page=x", 400)):
+            res = requests.get(f"{self.env['CPM_URL']}?{query}", timeout=5)
+            self.assertEqual(res.status_code, status, query)
+
+        # everything comes from the mirror
+        self.repo.reset_counters()
+        self.cpm("download", root)
+        self.assertEqual(self.repo.requests, 0)
+        files = sorted(path.name for path in Path(self.dir.name).glob("*.zip"))
+        self.assertEqual(files, ["base.zip", "middle 0.zip", "middle 1.zip", "root.zip"])
+        with zipfile.ZipFile(os.path.join(self.dir.name, "root.zip")) as archive:
+            self.assertEqual(
+                archive.read("root.lorebook"), self.repo.files["root.lorebook"]
+            )
+            self.assertIn("root.png", archive.namelist())
+
+    def test_failover(self):
+        root = graph(self.repo, "wide", 2, entries=2)
+        # nothing listens on the first one
+        self.env["CPM_URLS"] = "http://127.0.0.1:9/," + self.repo.url
+        self.cpm("download", root)
+
+        files = sorted(path.name for path in Path(self.dir.name).glob("*.zip"))
+        self.assertEqual(files, ["leaf 0.zip", "leaf 1.zip", "root.zip"])
@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+from cpm.lock import Lockfile, LockError
+
+
+class TestLockfile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.lockfile = Lockfile(os.path.join(self.dir.name, "cpm.lock"))
+        self.archive = os.path.join(self.dir.name, "remilia.zip")
+        with open(self.archive, "wb") as file:
+            file.write(b"zip")
+        self.data = {
+            "name": "remilia",
+            "deps": ["sakuya"],
+            "image": "",
+            "file": "https://files.catbox.moe/fwefw22",
+            "date_updated": "2022-08-02T10:00:00",
+        }
+        self.lockfile.record("remilia", self.data, {self.data["file"]: "abc"}, self.archive)
+        self.lockfile.record(
+            "sakuya", dict(self.data, name="sakuya", deps=[]), {}, self.archive
+        )
+
+    def test_roundtrip(self):
+        self.lockfile.save(["remilia"], ["remilia", "sakuya"])
+        lockfile = Lockfile(self.lockfile.path)
+
+        self.assertTrue(lockfile.load())
+        self.assertEqual(lockfile.roots, ["remilia"])
+        self.assertEqual(lockfile.packages, self.lockfile.packages)
+
+    def test_current(self):
+        self.assertIsNotNone(self.lockfile.current("remilia", self.data, self.archive))
+
+        updated = dict(self.data, date_updated="2023-01-01T00:00:00")
+        self.assertIsNone(self.lockfile.current("remilia", updated, self.archive))
+
+        with open(self.archive, "wb") as file:
+            file.write(b"changed")
+        self.assertIsNone(self.lockfile.current("remilia", self.data, self.archive))
+        self.assertIsNone(self.lockfile.current("patchouli", self.data, self.archive))
+
+    def test_resolve(self):
+        self.assertEqual(list(self.lockfile.resolve(["remilia"])), ["remilia", "sakuya"])
+        with self.assertRaises(LockError):
+            self.lockfile.resolve(["patchouli"])
@@ -0,0 +1,69 @@
+import logging
+import queue
+import tempfile
+import unittest
+from pathlib import Path
+
+from cpm import codec
+from cpm.logging import JsonFormatter, _LazyQueueHandler, _Mirror, matches, parse
+
+
+class TestLogging(unittest.TestCase):
+    def test_parse_text(self):
+        lines = [
+            "2024-01-01 10:00:00,000 [INFO] -- audit.command: Zipping\n",
+            "2024-01-01 10:00:01,000 [ERROR] -- error.Client: Boom\n",
+            "Traceback (most recent call last):\n",
+            '  File "x.py", line 1\n',
+        ]
+        records = list(parse(lines))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]["logger"], "audit.command")
+        self.assertEqual(records[1]["level"], "ERROR")
+        self.assertTrue(records[1]["message"].endswith('File "x.py", line 1'))
+
+    def test_parse_json(self):
+        record = logging.LogRecord("audit.lock", logging.WARNING, "", 0, "a %s", ("b",), None)
+        line = JsonFormatter().format(record)
+        self.assertEqual(codec.loads(line)["message"], "a b")
+        # a message that happens to look like JSON is a continuation, not a record
+        (parsed,) = parse([line + "\n", '{"not": "a record"}\n'])
+        self.assertEqual(parsed["level"], "WARNING")
+        self.assertEqual(parsed["message"], 'a b\n{"not": "a record"}')
+
+    def test_matches(self):
+        record = {"level": "WARNING", "logger": "audit.Client.sub", "message": ""}
+        self.assertTrue(matches(record))
+        self.assertTrue(matches(record, level="info", logger="audit.Client"))
+        self.assertFalse(matches(record, level="ERROR"))
+        self.assertFalse(matches(record, logger="audit.Cli"))
+
+    def test_mirror(self):
+        loggers = [logging.getLogger("test.mirror.a"), logging.getLogger("test.mirror.b")]
+        for logger in loggers:
+            logger.setLevel(logging.INFO)
+        with self.assertLogs("test.mirror", level="INFO") as logs:
+            mirror = _Mirror(*loggers)
+            mirror.info("once")
+            mirror.debug("never")
+        self.assertEqual(logs.output, ["INFO:test.mirror.a:once", "INFO:test.mirror.b:once"])
+
+    def test_queued_file(self):
+        records = queue.SimpleQueue()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "log"
+            handler = logging.FileHandler(path, delay=True)
+            handler.setFormatter(JsonFormatter())
+            logger = logging.getLogger("test.queued")
+            logger.propagate = False
+            logger.addHandler(_LazyQueueHandler(records))
+            self.addCleanup(logger.handlers.clear)
+            logger.warning("%d items", 3)
+            # the caller only enqueued the record, still unformatted
+            record = records.get_nowait()
+            self.assertEqual(record.msg, "%d items")
+            self.assertFalse(path.exists())
+            handler.handle(record)
+            handler.close()
+            (parsed,) = parse(path.read_text().splitlines())
+            self.assertEqual(parsed["message"], "3 items")
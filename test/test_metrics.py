@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+
+from cpm import metrics, settings
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "metrics.json")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_endpoint(self):
+        self.assertEqual(
+            metrics.endpoint("GET", settings.URL + "remilia").split(" ", 1)[1], "GET item"
+        )
+        self.assertEqual(
+            metrics.endpoint("GET", settings.URL + "?page=2").split(" ", 1)[1], "GET list"
+        )
+        self.assertEqual(
+            metrics.endpoint("GET", "https://files.catbox.moe/fwefw22"),
+            "files.catbox.moe GET file",
+        )
+
+    def test_save_merge(self):
+        for run in range(2):
+            collector = metrics.Metrics()
+            for latency in (0.003, 0.004, 0.150, 2.5):
+                collector.record("GET", "https://files.catbox.moe/a", 200, latency, 100)
+            collector.record("GET", "https://files.catbox.moe/a", 503, 0.1, retried=True)
+            collector.record_cache(settings.URL, {"hits": 3})
+            collector.save(self.path)
+            collector.save(self.path)  # nothing new to add
+
+        data = metrics.load(self.path)
+        series = data["series"]["files.catbox.moe GET file"]
+
+        self.assertEqual(series["count"], 10)
+        self.assertEqual(series["bytes"], 800)
+        self.assertEqual(series["retries"], 2)
+        self.assertEqual(series["status"], {"200": 8, "503": 2})
+        self.assertEqual(metrics.percentile(series["hist"], 0.5), "100ms")
+        self.assertEqual(metrics.percentile(series["hist"], 0.99), "5000ms")
+        self.assertEqual(list(data["cache"].values()), [{"hits": 6}])
+        self.assertEqual(len(metrics.summary(data)), 3)
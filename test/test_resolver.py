@@ -0,0 +1,81 @@
+import unittest
+
+from cpm.resolver import Graph
+
+
+class TestGraph(unittest.TestCase):
+    def setUp(self):
+        self.graph = {
+            "remilia": ["gensokio", "scarlet devil mansion"],
+            "flandre": ["scarlet devil mansion"],
+            "gensokio": ["hakurei shrine"],
+            "scarlet devil mansion": ["gensokio", "sakuya"],
+            "hakurei shrine": [],
+            "sakuya": [],
+        }
+        self.levels = []
+
+        def fetch(level):
+            self.levels.append(list(level))
+            return {name: {"name": name, "deps": self.graph[name]} for name in level}
+
+        self.resolver = Graph(fetch)
+
+    def test_levels(self):
+        self.resolver.resolve(["remilia"])
+
+        self.assertEqual(
+            self.levels,
+            [["remilia"], ["gensokio", "scarlet devil mansion"], ["hakurei shrine", "sakuya"]],
+        )
+
+    def test_memoized(self):
+        self.resolver.resolve(["remilia"])
+        self.resolver.resolve(["flandre", "remilia"])
+
+        # the subgraph of the mansion was already there
+        self.assertEqual(self.levels[-1], ["flandre"])
+        self.assertEqual(len(self.resolver.metadata), 6)
+
+    def test_plan(self):
+        order, cycles = self.resolver.resolve(["remilia", "flandre"]).plan(["remilia", "flandre"])
+
+        self.assertEqual(cycles, [])
+        self.assertEqual(sorted(order), sorted(self.graph))
+        for name in order:
+            for dep in self.graph[name]:
+                self.assertLess(order.index(dep), order.index(name))
+
+    def test_cycle(self):
+        self.graph["sakuya"] = ["remilia"]
+        order, cycles = self.resolver.resolve(["remilia"]).plan(["remilia"])
+
+        self.assertEqual(cycles, [["remilia", "scarlet devil mansion", "sakuya", "remilia"]])
+        self.assertEqual(len(order), 5)
+
+    def test_deep(self):
+        # deeper than the recursion limit
+        self.graph = {str(i): [str(i + 1)] for i in range(5000)}
+        self.graph["5000"] = []
+        order, cycles = self.resolver.resolve(["0"]).plan(["0"])
+
+        self.assertEqual(order[0], "5000")
+        self.assertEqual(order[-1], "0")
+        self.assertEqual(len(self.resolver.preorder(["0"])), 5001)
+
+    def test_tree(self):
+        self.graph["sakuya"] = ["remilia"]
+        lines = list(self.resolver.resolve(["remilia"]).tree("remilia"))
+
+        self.assertEqual(
+            lines,
+            [
+                "remilia",
+                "    gensokio",
+                "        hakurei shrine",
+                "    scarlet devil mansion",
+                "        gensokio (*)",
+                "        sakuya",
+                "            remilia (cycle)",
+            ],
+        )
@@ -0,0 +1,112 @@
+import unittest
+from unittest.mock import patch, Mock
+
+import requests
+
+from cpm import client, metrics, retry
+from cpm.endpoints import Endpoints
+
+
+class TestRetry(unittest.TestCase):
+    def setUp(self):
+        self.response = Mock(status_code=200, headers={}, content=b"")
+        self.request = Mock(return_value=self.response)
+        self.session = Mock()
+        self.session.budget = retry.RetryBudget(10)
+        self.session.breaker = retry.CircuitBreaker(threshold=2, cooldown=60)
+        self.session.endpoints = Endpoints(["https://example.com/"])
+        self.send = client.check_errors(self.request)
+
+        # keep the attempts of the tests out of `cpm stats`
+        patcher = patch.object(client, "METRICS", metrics.Metrics())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch("cpm.client.time.sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_no_delay_on_success(self):
+        res = self.send(self.session, "GET", "https://example.com/")
+
+        self.assertIs(res, self.response)
+        self.sleep.assert_not_called()
+
+    def test_backoff_on_connection_error(self):
+        self.request.side_effect = [
+            requests.exceptions.ConnectionError(),
+            self.response,
+        ]
+        self.send(self.session, "GET", "https://example.com/")
+
+        self.assertEqual(self.sleep.call_count, 1)
+        self.assertEqual(self.session.budget.left, 9)
+
+    def test_timeout(self):
+        self.request.side_effect = [requests.exceptions.ReadTimeout(), self.response]
+
+        res = self.send(self.session, "GET", "https://example.com/")
+
+        self.assertIs(res, self.response)
+        self.assertEqual(self.sleep.call_count, 1)
+
+    def test_no_retry_for_write_timeouts(self):
+        self.request.side_effect = [requests.exceptions.ReadTimeout(), self.response]
+
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            self.send(self.session, "POST", "https://example.com/")
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_retry_after(self):
+        busy = Mock(status_code=429, headers={"Retry-After": "2"}, content=b"")
+        busy.raise_for_status.side_effect = requests.exceptions.HTTPError()
+        self.request.side_effect = [busy, self.response]
+
+        self.send(self.session, "GET", "https://example.com/")
+
+        self.sleep.assert_called_once_with(2.0)
+
+    def test_budget(self):
+        self.session.budget = retry.RetryBudget(0)
+        self.request.side_effect = requests.exceptions.ConnectionError()
+
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.send(self.session, "GET", "https://example.com/")
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_circuit_breaker(self):
+        self.request.side_effect = requests.exceptions.ConnectionError()
+
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.send(self.session, "GET", "https://dead.host/a")
+        calls = self.request.call_count
+        self.assertEqual(calls, 2)  # threshold
+
+        with self.assertRaises(retry.CircuitOpenError):
+            self.send(self.session, "GET", "https://dead.host/b")
+        self.assertEqual(self.request.call_count, calls)
+
+        # other hosts are unaffected
+        self.request.side_effect = None
+        self.send(self.session, "GET", "https://example.com/")
+
+    def test_failover(self):
+        self.session.endpoints = Endpoints(["https://main.host/", "https://mirror.host/"])
+        self.request.side_effect = [requests.exceptions.ConnectionError(), self.response]
+
+        self.send(self.session, "GET", "https://main.host/remilia")
+
+        # straight to the mirror, without waiting or spending retries
+        self.assertEqual(self.request.call_args.args[2], "https://mirror.host/remilia")
+        self.sleep.assert_not_called()
+        self.assertEqual(self.session.budget.left, 10)
+        self.assertEqual(self.session.endpoints.current, "https://mirror.host/")
+
+    def test_no_failover_for_writes(self):
+        self.session.endpoints = Endpoints(["https://main.host/", "https://mirror.host/"])
+        self.request.side_effect = [requests.exceptions.ConnectionError(), self.response]
+
+        self.send(self.session, "POST", "https://main.host/")
+
+        self.assertEqual(self.request.call_args.args[2], "https://main.host/")
+        self.assertEqual(self.session.endpoints.current, "https://main.host/")
@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+import time
+import unittest
+from pathlib import Path
+
+SRC = str(Path(__file__).parent.parent / "src")
+
+# offline subcommands (-h, debug) must start within this many seconds
+STARTUP_TARGET = 0.5
+
+
+def run(*code):
+    env = dict(os.environ, PYTHONPATH=SRC)
+    return subprocess.run(
+        [sys.executable, *code], env=env, capture_output=True, text=True, check=True
+    )
+
+
+class TestStartup(unittest.TestCase):
+    def test_no_heavy_imports(self):
+        res = run(
+            "-c",
+            "import sys; from cpm import __main__;"
+            "print(sorted({'requests', 'yaml', 'cpm.client'} & set(sys.modules)))",
+        )
+        self.assertEqual(res.stdout.strip(), "[]")
+
+    def test_startup_time(self):
+        for argv in (["-h"], ["debug"]):
+            timings = []
+            for _ in range(3):
+                start = time.perf_counter()
+                run("-m", "cpm", *argv)
+                timings.append(time.perf_counter() - start)
+            self.assertLess(min(timings), STARTUP_TARGET, argv)
@@ -0,0 +1,74 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+from cpm.store import BlobStore
+
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = BlobStore(self.dir.name, max_bytes=100)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def put(self, url, content):
+        part = self.store.partial(url)
+        with open(part, "wb") as file:
+            file.write(content)
+        return self.store.commit(url, part, hashlib.sha256(content).hexdigest())
+
+    def test_commit(self):
+        url = "https://files.catbox.moe/fwefw22"
+        self.assertIsNone(self.store.lookup(url))
+
+        blob = self.put(url, b"lore")
+
+        self.assertEqual(self.store.lookup(url), blob)
+        self.assertEqual(blob.read_bytes(), b"lore")
+
+    def test_version(self):
+        url = "https://files.catbox.moe/fwefw22"
+        part = self.store.partial(url)
+        part.write_bytes(b"lore")
+        blob = self.store.commit(url, part, hashlib.sha256(b"lore").hexdigest(), "2022")
+
+        self.assertEqual(self.store.lookup(url, "2022"), blob)
+        # the file may have been replaced in a later version
+        self.assertIsNone(self.store.lookup(url, "2023"))
+        self.assertIsNone(self.store.lookup(url))
+
+    def test_disabled(self):
+        url = "https://files.catbox.moe/fwefw22"
+        self.store.enabled = False
+        self.put(url, b"lore")
+
+        self.assertIsNone(self.store.lookup(url))
+
+    def test_dedupe(self):
+        first = self.put("https://a.com/file", b"lore")
+        second = self.put("https://b.com/file", b"lore")
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(list(self.store.path.glob("blobs/*/*"))), 1)
+
+    def test_gc(self):
+        a = self.put("https://a.com/file", b"a" * 60)
+        old = 0
+        os.utime(a, (old, old))
+        self.put("https://b.com/file", b"b" * 60)
+
+        # both are used by this run
+        self.store.gc()
+        self.assertTrue(a.exists())
+
+        # the next run only needs b
+        self.store = BlobStore(self.dir.name, max_bytes=100)
+        self.store.lookup("https://b.com/file")
+        self.store.gc()
+
+        self.assertFalse(a.exists())
+        self.assertIsNone(self.store.lookup("https://a.com/file"))
+        self.assertIsNotNone(self.store.lookup("https://b.com/file"))
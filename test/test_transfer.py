@@ -0,0 +1,186 @@
+import hashlib
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import Mock, patch
+
+import requests
+
+from cpm import transfer
+
+
+class TestDownload(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.part = Path(self.dir.name) / "part"
+        self.session = Mock()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def response(self, status, chunks, headers=None):
+        res = Mock(ok=True, status_code=status, headers=headers or {})
+        res.__enter__ = Mock(return_value=res)
+        res.__exit__ = Mock(return_value=False)
+        res.iter_content.return_value = chunks
+        return res
+
+    def test_stream(self):
+        self.session.get.return_value = self.response(200, [b"lo", b"re"])
+
+        digest = transfer.download(self.session, "https://a.com/file", self.part)
+
+        self.assertEqual(self.part.read_bytes(), b"lore")
+        self.assertEqual(digest, hashlib.sha256(b"lore").hexdigest())
+
+    def interrupted(self, content: bytes):
+        """A download of `content` (4 bytes, ETag "v1") that stopped halfway"""
+        self.session.get.return_value = self.response(
+            200, [content[:2]], {"ETag": '"v1"', "Content-Length": "4"}
+        )
+        self.session.get.return_value.iter_content.side_effect = lambda size: self.broken(
+            content[:2]
+        )
+        with patch.object(transfer.settings, "RETRIES", 0):
+            with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+                transfer.download(self.session, "https://a.com/file", self.part)
+
+    @staticmethod
+    def broken(chunk):
+        yield chunk
+        raise requests.exceptions.ChunkedEncodingError()
+
+    def test_resume(self):
+        self.interrupted(b"lore")
+        self.session.get.return_value = self.response(
+            206, [b"re"], {"Content-Range": "bytes 2-3/4"}
+        )
+
+        digest = transfer.download(self.session, "https://a.com/file", self.part)
+
+        self.session.get.assert_called_with(
+            "https://a.com/file", stream=True, headers={"Range": "bytes=2-", "If-Range": '"v1"'}
+        )
+        self.assertEqual(self.part.read_bytes(), b"lore")
+        self.assertEqual(digest, hashlib.sha256(b"lore").hexdigest())
+        self.assertEqual(list(self.part.parent.iterdir()), [self.part])
+
+    def test_resume_changed(self):
+        self.interrupted(b"lore")
+        # If-Range didn't match, the whole new file comes back
+        self.session.get.return_value = self.response(
+            200, [b"ne", b"wer"], {"ETag": '"v2"', "Content-Length": "5"}
+        )
+
+        digest = transfer.download(self.session, "https://a.com/file", self.part)
+
+        self.assertEqual(self.part.read_bytes(), b"newer")
+        self.assertEqual(digest, hashlib.sha256(b"newer").hexdigest())
+
+    def test_resume_other_length(self):
+        self.interrupted(b"lore")
+        # a server that ignores If-Range
+        self.session.get.side_effect = [
+            self.response(206, [b"wer"], {"Content-Range": "bytes 2-4/5"}),
+            self.response(200, [b"newer"], {"Content-Length": "5"}),
+        ]
+
+        digest = transfer.download(self.session, "https://a.com/file", self.part)
+
+        self.assertEqual(self.session.get.call_args.kwargs["headers"], {})
+        self.assertEqual(digest, hashlib.sha256(b"newer").hexdigest())
+
+    def test_unknown_partial(self):
+        self.part.write_bytes(b"lo")  # from who knows where
+        self.session.get.return_value = self.response(200, [b"lore"])
+
+        digest = transfer.download(self.session, "https://a.com/file", self.part)
+
+        self.session.get.assert_called_with("https://a.com/file", stream=True, headers={})
+        self.assertEqual(digest, hashlib.sha256(b"lore").hexdigest())
+
+    def test_interrupted(self):
+        def broken():
+            yield b"lo"
+            raise requests.exceptions.ChunkedEncodingError()
+
+        first = self.response(200, None, {"Content-Length": "4"})
+        first.iter_content.side_effect = lambda size: broken()
+        second = self.response(206, [b"re"], {"Content-Range": "bytes 2-3/4"})
+        self.session.get.side_effect = [first, second]
+
+        digest = transfer.download(self.session, "https://a.com/file", self.part)
+
+        self.assertEqual(self.part.read_bytes(), b"lore")
+        self.assertEqual(digest, hashlib.sha256(b"lore").hexdigest())
+
+
+    def test_meter(self):
+        self.interrupted(b"lore")
+        self.session.get.return_value = self.response(
+            206, [b"re"], {"Content-Range": "bytes 2-3/4", "Content-Length": "2"}
+        )
+        meter = transfer.Meter()
+
+        transfer.download(self.session, "https://a.com/file", self.part, meter)
+
+        stats = meter.stats()
+        self.assertEqual((stats["done"], stats["total"]), (4, 4))
+        # only what went over the wire counts for the throughput
+        self.assertEqual(meter.transferred, 2)
+
+
+class TestMeter(unittest.TestCase):
+    def test_parse_rate(self):
+        self.assertEqual(transfer.parse_rate("500000"), 500000)
+        self.assertEqual(transfer.parse_rate("500k"), 500 * 1024)
+        self.assertEqual(transfer.parse_rate("1.5M"), int(1.5 * 1024**2))
+        for text in ("fast", "0", "-2M"):
+            with self.assertRaises(ValueError):
+                transfer.parse_rate(text)
+
+    def test_progress(self):
+        meter = transfer.Meter()
+        meter.expect("a", 300)
+        meter.expect("b", 100)
+        meter.expect("a", 1000)  # counted already
+        meter.update(100)
+
+        stats = meter.stats()
+        self.assertEqual((stats["done"], stats["total"]), (100, 400))
+        self.assertIsNotNone(stats["eta"])
+
+    def test_limit_rate(self):
+        meter = transfer.Meter(rate=1000000)
+        start = time.monotonic()
+        for _ in range(4):
+            meter.update(100000)
+        self.assertGreater(time.monotonic() - start, 0.39)
+
+
+class TestPages(unittest.TestCase):
+    def test_pages(self):
+        catalog = list(range(25))
+        fetched = []
+
+        def fetch(page):
+            fetched.append(page)
+            return catalog[page * 10 : page * 10 + 10]
+
+        res = list(transfer.pages(fetch, jobs=4))
+
+        self.assertEqual([item for page in res for item in page], catalog)
+        self.assertEqual(len(res), 3)
+        # pages past the end may have been requested, but never yielded
+        self.assertTrue({0, 1, 2} <= set(fetched))
+
+    def test_past_the_end_errors(self):
+        def fetch(page):
+            if page > 1:
+                raise requests.exceptions.HTTPError("404")
+            return [0] * (10 if page == 0 else 3)
+
+        res = list(transfer.pages(fetch, jobs=4))
+
+        self.assertEqual([len(page) for page in res], [10, 3])